@@ -1,17 +1,46 @@
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, Response, g, jsonify, request, render_template
+from datetime import datetime, timedelta
 import logging
 from logging.handlers import RotatingFileHandler
+import math
 import os
+import time
 
 # Импорт сервисов
-from services.product_service import get_product_details
+from services.product_service import (
+    get_product_details,
+    get_products_details,
+    setup_stock_tracking,
+    get_stock_tracking,
+    stop_stock_tracking,
+    get_stock_history,
+    get_stock_changes
+)
 from services.position_service import (
     search_product_position, 
+    search_products_positions,
+    search_product_position_regions,
+    search_products_positions_regions,
     setup_tracking_job,
     get_position_history_data,
+    get_position_history_rollup,
+    get_position_at,
+    iter_position_history_ndjson,
     get_active_tracking_jobs,
-    stop_tracking_job
+    stop_tracking_job,
+    stream_tracking_events,
+    SCAN_MODES,
+    SCAN_STRATEGIES
 )
+from services.cache import get_cache_stats
+from services.history_export import EXPORT_FORMATS, iter_history_export
+from services.history_writer import get_history_writer
+from services.http_client import get_http_stats
+from services.metrics import Histogram, render_metrics
+from services.rate_limiter import RateLimitExceeded
+from services.rollups import BUCKETS
+from services.scheduler import get_scheduler
+from services.tracker import LEASE_NAME, get_tracker, start_tracker, tracker_mode
 
 # Создание и настройка приложения
 app = Flask(__name__)
@@ -29,12 +58,54 @@ file_handler.setFormatter(logging.Formatter(
 file_handler.setLevel(logging.INFO)
 app.logger.addHandler(file_handler)
 app.logger.setLevel(logging.INFO)
+
+# Сообщения сервисов (например, планировщика) пишутся в тот же лог
+services_logger = logging.getLogger('services')
+services_logger.addHandler(file_handler)
+services_logger.setLevel(logging.INFO)
 app.logger.info('Wildberries API запущен')
 
 # Инициализация директорий для хранения данных
 os.makedirs("reports", exist_ok=True)
 os.makedirs("data", exist_ok=True)
 
+# Координатор отслеживания: расписание выполняет один процесс, удерживающий аренду.
+# При WB_TRACKER_MODE=external расписание выполняет отдельный процесс python -m services.tracker
+if tracker_mode() == "embedded":
+    start_tracker()
+
+# Длительность обработки запросов по маршрутам
+ROUTE_LATENCY = Histogram(
+    "wb_route_duration_seconds",
+    "Длительность обработки запроса к API",
+    ("method", "route", "status")
+)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        ROUTE_LATENCY.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=route,
+            status=response.status_code
+        )
+    return response
+
+def rate_limited_response(error):
+    """Ответ 429, когда Wildberries ограничивает частоту запросов"""
+    app.logger.warning(str(error))
+    response = jsonify({"error": str(error), "retry_after": round(error.retry_after, 1)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+    return response
+
 # API маршруты
 
 @app.route('/')
@@ -46,13 +117,57 @@ def index():
 @app.route('/api/product/<article_id>', methods=['GET'])
 def get_product(article_id):
     """Получение детальной информации о товаре по артикулу"""
+    max_age = request.args.get('max_age', type=float)
+    dest = request.args.get('dest')
+    
     try:
-        product_info = get_product_details(article_id)
+        product_info = get_product_details(article_id, max_age=max_age, dest=dest)
         return jsonify(product_info)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
     except Exception as e:
         app.logger.error(f"Ошибка при получении информации о товаре {article_id}: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# API для пакетного получения информации о товарах
+@app.route('/api/products', methods=['GET', 'POST'])
+def get_products():
+    """Получение детальной информации о нескольких товарах по списку артикулов"""
+    if request.method == 'POST':
+        data = request.json
+        
+        if not data:
+            return jsonify({"error": "Необходимо предоставить данные в формате JSON"}), 400
+        
+        article_ids = data.get('nm')
+        dest = data.get('dest')
+        if isinstance(article_ids, str):
+            article_ids = article_ids.replace(',', ';').split(';')
+    else:
+        dest = request.args.get('dest')
+        # Поддерживаются nm=1;2;3, nm=1,2,3 и повторяющийся параметр nm
+        article_ids = []
+        for value in request.args.getlist('nm'):
+            article_ids.extend(value.replace(',', ';').split(';'))
+    
+    if isinstance(article_ids, list):
+        article_ids = [article_id for article_id in article_ids if str(article_id).strip()]
+    
+    if not article_ids or not isinstance(article_ids, list):
+        return jsonify({"error": "Необходимо указать список артикулов nm"}), 400
+    
+    try:
+        return jsonify(get_products_details(article_ids, dest=dest))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except Exception as e:
+        app.logger.error(f"Ошибка при получении информации о товарах: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 # API для поиска позиции товара
 @app.route('/api/position', methods=['GET'])
 def get_position():
@@ -60,17 +175,84 @@ def get_position():
     sku = request.args.get('sku')
     query = request.args.get('query')
     max_pages = int(request.args.get('max_pages', 10))
+    mode = request.args.get('mode', 'sequential')
+    window = request.args.get('window', type=int)
+    strategy = request.args.get('strategy', 'linear')
+    dest = request.args.get('dest')
+    regions = request.args.get('regions')
     
     if not sku or not query:
         return jsonify({"error": "Необходимо указать параметры sku и query"}), 400
     
+    if mode not in SCAN_MODES:
+        return jsonify({"error": "mode должен быть 'sequential' или 'parallel'"}), 400
+    
+    if strategy not in SCAN_STRATEGIES:
+        return jsonify({"error": "strategy должен быть 'linear' или 'guided'"}), 400
+    
     try:
-        result = search_product_position(query, sku, max_pages)
+        if regions:
+            result = search_product_position_regions(
+                query, sku, regions, max_pages, mode=mode, window=window, strategy=strategy
+            )
+        else:
+            result = search_product_position(
+                query, sku, max_pages, mode=mode, window=window, strategy=strategy, dest=dest
+            )
         return jsonify(result)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
     except Exception as e:
         app.logger.error(f"Ошибка при поиске позиции товара {sku} по запросу '{query}': {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# API для пакетного поиска позиций товаров
+@app.route('/api/positions/batch', methods=['POST'])
+def get_positions_batch():
+    """Поиск позиций нескольких товаров по одному запросу за один обход выдачи"""
+    data = request.json
+    
+    if not data:
+        return jsonify({"error": "Необходимо предоставить данные в формате JSON"}), 400
+    
+    query = data.get('query')
+    skus = data.get('skus')
+    max_pages = int(data.get('max_pages', 10))
+    mode = data.get('mode', 'sequential')
+    window = data.get('window')
+    strategy = data.get('strategy', 'linear')
+    dest = data.get('dest')
+    regions = data.get('regions')
+    
+    if not query or not skus or not isinstance(skus, list):
+        return jsonify({"error": "Необходимо указать query и непустой список skus"}), 400
+    
+    if mode not in SCAN_MODES:
+        return jsonify({"error": "mode должен быть 'sequential' или 'parallel'"}), 400
+    
+    if strategy not in SCAN_STRATEGIES:
+        return jsonify({"error": "strategy должен быть 'linear' или 'guided'"}), 400
+    
+    try:
+        if regions:
+            result = search_products_positions_regions(
+                query, skus, regions, max_pages, mode=mode, window=window, strategy=strategy
+            )
+        else:
+            result = search_products_positions(
+                query, skus, max_pages, mode=mode, window=window, strategy=strategy, dest=dest
+            )
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RateLimitExceeded as e:
+        return rate_limited_response(e)
+    except Exception as e:
+        app.logger.error(f"Ошибка при пакетном поиске позиций по запросу '{query}': {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 # API для настройки отслеживания позиции
 @app.route('/api/tracking', methods=['POST'])
 def setup_tracking():
@@ -85,6 +267,7 @@ def setup_tracking():
     interval = int(data.get('interval', 60))
     interval_type = data.get('interval_type', 'minutes')
     max_pages = int(data.get('max_pages', 10))
+    regions = data.get('regions')
     
     if not sku or not query:
         return jsonify({"error": "Необходимо указать параметры sku и query"}), 400
@@ -93,12 +276,14 @@ def setup_tracking():
         return jsonify({"error": "interval_type должен быть 'minutes' или 'hours'"}), 400
     
     try:
-        tracking_id = setup_tracking_job(query, sku, interval, interval_type, max_pages)
+        tracking_id = setup_tracking_job(query, sku, interval, interval_type, max_pages, regions=regions)
         return jsonify({
             "success": True,
             "tracking_id": tracking_id,
             "message": f"Отслеживание настроено с интервалом {interval} {interval_type}"
         })
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         app.logger.error(f"Ошибка при настройке отслеживания для {sku}: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -110,17 +295,145 @@ def get_history():
     sku = request.args.get('sku')
     query = request.args.get('query')
     days = int(request.args.get('days', 30))
+    limit = request.args.get('limit', type=int)
+    after = request.args.get('after')
+    dest = request.args.get('dest')
+    output_format = request.args.get('format', 'json')
     
     if not sku:
         return jsonify({"error": "Необходимо указать параметр sku"}), 400
     
+    if output_format not in ['json', 'ndjson']:
+        return jsonify({"error": "format должен быть 'json' или 'ndjson'"}), 400
+    
+    if limit is not None and limit < 1:
+        return jsonify({"error": "limit должен быть положительным числом"}), 400
+    
     try:
-        history_data = get_position_history_data(sku, query, days)
+        if output_format == 'ndjson':
+            return Response(
+                iter_position_history_ndjson(sku, query, days, limit=limit, after=after, dest=dest),
+                mimetype='application/x-ndjson'
+            )
+        
+        history_data = get_position_history_data(sku, query, days, limit=limit, after=after, dest=dest)
         return jsonify(history_data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         app.logger.error(f"Ошибка при получении истории для {sku}: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# API для получения агрегатов истории позиций
+@app.route('/api/history/rollup', methods=['GET'])
+def get_history_rollup():
+    """Получение часовых или дневных агрегатов истории позиций товара"""
+    sku = request.args.get('sku')
+    query = request.args.get('query')
+    bucket = request.args.get('bucket', '1h')
+    days = int(request.args.get('days', 30))
+    dest = request.args.get('dest')
+    
+    if not sku:
+        return jsonify({"error": "Необходимо указать параметр sku"}), 400
+    
+    if bucket not in BUCKETS:
+        return jsonify({"error": "bucket должен быть '1h' или '1d'"}), 400
+    
+    try:
+        return jsonify(get_position_history_rollup(sku, query, bucket, days, dest=dest))
+    except Exception as e:
+        app.logger.error(f"Ошибка при получении агрегатов истории для {sku}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# API для массовой выгрузки истории позиций
+@app.route('/api/history/export', methods=['GET', 'POST'])
+def export_history():
+    """Выгрузка истории позиций многих товаров одним потоком Parquet, Arrow IPC или CSV"""
+    if request.method == 'POST':
+        params = request.get_json(silent=True)
+        
+        if not isinstance(params, dict):
+            return jsonify({"error": "Необходимо предоставить данные в формате JSON"}), 400
+        
+        skus = params.get('skus')
+    else:
+        params = request.args
+        # Поддерживаются skus=1,2,3 и повторяющийся параметр skus
+        skus = ",".join(request.args.getlist('skus')) or None
+    
+    output_format = params.get('format', 'parquet')
+    since = params.get('since')
+    days = params.get('days')
+    
+    if output_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"format должен быть одним из: {', '.join(EXPORT_FORMATS)}"}), 400
+    
+    if days is not None and not since:
+        try:
+            since = datetime.now() - timedelta(days=float(days))
+        except (TypeError, ValueError):
+            return jsonify({"error": "days должен быть числом"}), 400
+    
+    try:
+        chunks = iter_history_export(
+            skus, params.get('query'), since=since, until=params.get('until'), dest=params.get('dest'),
+            output_format=output_format
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Ошибка при выгрузке истории позиций: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+    
+    mimetype, extension = EXPORT_FORMATS[output_format]
+    return Response(
+        chunks,
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="history{extension}"'}
+    )
+
+# API для определения позиции по сохраненным снимкам выдачи
+@app.route('/api/snapshots/position', methods=['GET'])
+def get_snapshot_position():
+    """Позиция любого товара по запросу на момент времени по снимкам выдачи, без запросов к Wildberries"""
+    sku = request.args.get('sku')
+    query = request.args.get('query')
+    at = request.args.get('at')
+    dest = request.args.get('dest')
+    max_age = request.args.get('max_age', type=float)
+    
+    if not sku or not query:
+        return jsonify({"error": "Необходимо указать параметры sku и query"}), 400
+    
+    try:
+        return jsonify(get_position_at(sku, query, at=at, dest=dest, max_age=max_age))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Ошибка при поиске позиции {sku} по снимкам запроса '{query}': {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# Поток результатов отслеживания
+@app.route('/api/tracking/stream', methods=['GET'])
+def tracking_stream():
+    """Результаты задач отслеживания по мере выполнения (Server-Sent Events)"""
+    tracking_id = request.args.get('tracking_id')
+    sku = request.args.get('sku')
+    query = request.args.get('query')
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    
+    try:
+        events = stream_tracking_events(tracking_id, sku, query, last_event_id=last_event_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    return Response(
+        events,
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 # API для получения списка активных отслеживаний
 @app.route('/api/tracking', methods=['GET'])
 def get_tracking_jobs():
@@ -155,5 +468,142 @@ def stop_tracking(tracking_id):
         app.logger.error(f"Ошибка при остановке отслеживания {tracking_id}: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# API для настройки отслеживания остатков и цен
+@app.route('/api/stock/tracking', methods=['POST'])
+def setup_stock():
+    """Регулярные снимки остатков и цен товаров по карточкам"""
+    data = request.json
+    
+    if not data:
+        return jsonify({"error": "Необходимо предоставить данные в формате JSON"}), 400
+    
+    article_ids = data.get('nm')
+    if isinstance(article_ids, str):
+        article_ids = article_ids.replace(',', ';').split(';')
+    
+    if isinstance(article_ids, list):
+        article_ids = [article_id for article_id in article_ids if str(article_id).strip()]
+    
+    if not article_ids or not isinstance(article_ids, list):
+        return jsonify({"error": "Необходимо указать список артикулов nm"}), 400
+    
+    try:
+        result = setup_stock_tracking(article_ids, dest=data.get('dest'), interval=data.get('interval'))
+        return jsonify({
+            "success": True,
+            **result,
+            "message": f"Отслеживание остатков настроено с интервалом {result['interval']} минут"
+        })
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Ошибка при настройке отслеживания остатков: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# API для получения списка отслеживаемых остатков
+@app.route('/api/stock/tracking', methods=['GET'])
+def get_stock_tracking_items():
+    """Получение отслеживаемых товаров и задач снимков остатков"""
+    try:
+        return jsonify(get_stock_tracking())
+    except Exception as e:
+        app.logger.error(f"Ошибка при получении списка отслеживаемых остатков: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# API для остановки отслеживания остатков
+@app.route('/api/stock/tracking/<article_id>', methods=['DELETE'])
+def stop_stock(article_id):
+    """Остановка снимков остатков и цен товара"""
+    dest = request.args.get('dest')
+    
+    try:
+        if stop_stock_tracking(article_id, dest=dest):
+            return jsonify({
+                "success": True,
+                "message": f"Отслеживание остатков товара {article_id} остановлено"
+            })
+        return jsonify({
+            "success": False,
+            "message": f"Остатки товара {article_id} не отслеживаются"
+        }), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Ошибка при остановке отслеживания остатков {article_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# API для получения остатков и цен на момент времени
+@app.route('/api/stock/history', methods=['GET'])
+def stock_history():
+    """Остатки и цены товара на момент времени, восстановленные по сохраненным изменениям"""
+    article_id = request.args.get('nm')
+    at = request.args.get('at')
+    dest = request.args.get('dest')
+    
+    if not article_id:
+        return jsonify({"error": "Необходимо указать параметр nm"}), 400
+    
+    try:
+        return jsonify(get_stock_history(article_id, at=at, dest=dest))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Ошибка при получении остатков товара {article_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# API для получения изменений остатков и цен
+@app.route('/api/stock/changes', methods=['GET'])
+def stock_changes():
+    """Изменения остатков и цен товара за период"""
+    article_id = request.args.get('nm')
+    days = request.args.get('days', 7, type=float)
+    dest = request.args.get('dest')
+    
+    if not article_id:
+        return jsonify({"error": "Необходимо указать параметр nm"}), 400
+    
+    try:
+        return jsonify(get_stock_changes(article_id, days=days, dest=dest))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Ошибка при получении изменений остатков товара {article_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# API для получения статистики кэшей
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """Получение счетчиков попаданий и промахов кэшей"""
+    return jsonify(get_cache_stats())
+
+# API для получения статистики HTTP-клиента
+@app.route('/api/http/stats', methods=['GET'])
+def http_stats():
+    """Получение счетчиков запросов и переиспользования соединений"""
+    return jsonify(get_http_stats())
+
+# API для получения состояния буфера отложенной записи истории
+@app.route('/api/history/stats', methods=['GET'])
+def history_writer_stats():
+    """Получение размера буфера и счетчиков сбросов истории позиций"""
+    return jsonify(get_history_writer().stats())
+
+# API для получения состояния планировщика задач отслеживания
+@app.route('/api/scheduler/stats', methods=['GET'])
+def scheduler_stats():
+    """Получение числа задач, длины очереди и задержки запусков планировщика"""
+    tracker = get_tracker()
+    stats = get_scheduler().stats()
+    stats["mode"] = tracker_mode()
+    stats["is_leader"] = tracker.is_leader
+    stats["leader"] = tracker.store.lease_owner(LEASE_NAME)
+    return jsonify(stats)
+
+# Метрики в текстовом формате Prometheus
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Получение метрик процесса для Prometheus"""
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True) 
\ No newline at end of file
@@ -0,0 +1,70 @@
+# Сравнение двух отчетов benchmarks.run
+#
+# Запуск:
+#   python -m benchmarks.compare reports/before.json reports/after.json [--threshold 0.1]
+#
+# Замеры сопоставляются по имени и параметрам; для каждого выводится
+# отношение медиан (после / до). Код возврата 1, если какой-либо замер
+# замедлился больше чем на threshold.
+import argparse
+import json
+import sys
+
+
+def _key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True, ensure_ascii=False)
+
+
+def compare_reports(before, after):
+    """
+    Сопоставляет замеры двух отчетов
+
+    Args:
+        before (dict): Отчет до изменения
+        after (dict): Отчет после изменения
+
+    Returns:
+        list: Кортежи (имя, параметры, медиана до, медиана после, отношение)
+    """
+    baseline = {_key(result): result for result in before["results"]}
+    rows = []
+
+    for result in after["results"]:
+        key = _key(result)
+        if key not in baseline:
+            continue
+        old = baseline[key]["median"]
+        new = result["median"]
+        rows.append((key[0], key[1], old, new, new / old if old else None))
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение отчетов замеров производительности")
+    parser.add_argument("before", help="Отчет до изменения")
+    parser.add_argument("after", help="Отчет после изменения")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Допустимое замедление (0.1 - 10%%)")
+    args = parser.parse_args()
+
+    with open(args.before, encoding="utf-8") as f:
+        before = json.load(f)
+    with open(args.after, encoding="utf-8") as f:
+        after = json.load(f)
+
+    print(f"До: {before.get('revision')}  После: {after.get('revision')}")
+    regressions = 0
+
+    for name, params, old, new, ratio in compare_reports(before, after):
+        mark = ""
+        if ratio is not None and ratio > 1 + args.threshold:
+            mark = "  ЗАМЕДЛЕНИЕ"
+            regressions += 1
+        ratio_text = f"{ratio:6.2f}x" if ratio is not None else "     -"
+        print(f"{name:<30} {params:<45} {old * 1000:10.3f} ms -> {new * 1000:10.3f} ms  {ratio_text}{mark}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
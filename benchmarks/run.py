@@ -0,0 +1,352 @@
+# Замеры производительности сервисов на локальной заглушке API Wildberries
+#
+# Запуск (полный набор, история до 1 млн записей):
+#   python -m benchmarks.run --output reports/benchmark.json
+#
+# Быстрый прогон:
+#   python -m benchmarks.run --sizes 1000,100000 --iterations 200
+#
+# Сравнение двух отчетов:
+#   python -m benchmarks.compare reports/before.json reports/after.json
+#
+# Сервисы читают настройки при импорте, поэтому адреса API, пути к базам
+# и параметры кэша задаются в окружении до импорта модулей services.
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.stub_server import PAGE_SIZE, StubServer, load_fixture, sku_at
+
+# Версия формата отчета
+REPORT_VERSION = 1
+
+# Размеры синтетической истории по умолчанию
+DEFAULT_SIZES = (1000, 100000, 1000000)
+
+# Записей истории, добавляемых одной транзакцией при подготовке данных
+HISTORY_BATCH = 50000
+
+
+def measure(func, iterations, warmup=1):
+    """
+    Замеряет время выполнения функции
+
+    Args:
+        func (callable): Замеряемая функция без аргументов
+        iterations (int): Количество замеров
+        warmup (int): Количество прогревочных вызовов без замера
+
+    Returns:
+        dict: Минимум, медиана, среднее, 95-й перцентиль и максимум в секундах
+    """
+    for _ in range(warmup):
+        func()
+
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+
+    timings.sort()
+    total = sum(timings)
+    return {
+        "iterations": iterations,
+        "min": timings[0],
+        "median": statistics.median(timings),
+        "mean": total / iterations,
+        "p95": timings[min(int(iterations * 0.95), iterations - 1)],
+        "max": timings[-1],
+        "ops_per_sec": iterations / total if total else None
+    }
+
+
+def _result(name, params, stats):
+    print(f"{name:<40} {json.dumps(params, ensure_ascii=False):<45} "
+          f"median {stats['median'] * 1000:10.3f} ms  p95 {stats['p95'] * 1000:10.3f} ms")
+    return {"name": name, "params": params, **stats}
+
+
+def bench_find_product_by_sku(stub, iterations):
+    from services.position_service import find_product_by_sku
+    from services.serp import parse_search_page
+
+    page = parse_search_page(stub.search_page(1))
+    target = str(sku_at(min(PAGE_SIZE, stub.depth)))
+
+    stats = measure(lambda: find_product_by_sku(page, target), iterations)
+    return [_result("find_product_by_sku", {"page_size": len(page), "target": "last"}, stats)]
+
+
+def bench_parse_search_page(stub, iterations):
+    from services.serp import parse_search_page
+
+    raw = stub.search_page(1)
+    results = []
+
+    # Полный разбор в словари - для сравнения с компактной страницей
+    stats = measure(lambda: json.loads(raw), iterations)
+    results.append(_result("parse_search_page", {"parser": "json", "bytes": len(raw)}, stats))
+
+    stats = measure(lambda: parse_search_page(raw), iterations)
+    results.append(_result("parse_search_page", {"parser": "serp", "bytes": len(raw)}, stats))
+
+    return results
+
+
+def bench_format_product_data(iterations):
+    from services.product_service import format_product_data
+
+    product = load_fixture("card_product.json")
+
+    stats = measure(lambda: format_product_data(product), iterations)
+    return [_result("format_product_data", {"sizes": len(product["sizes"])}, stats)]
+
+
+def bench_search_product_position(stub, iterations):
+    from services.position_service import search_product_position
+
+    max_pages = (stub.depth + PAGE_SIZE - 1) // PAGE_SIZE
+    target = str(sku_at(stub.depth))
+    results = []
+
+    for mode in ("sequential", "parallel"):
+        def scan():
+            result = search_product_position("бенчмарк", target, max_pages, mode=mode)
+            if not result["found"]:
+                raise RuntimeError("Заглушка не вернула искомый товар")
+
+        stats = measure(scan, iterations)
+        results.append(_result(
+            "search_product_position",
+            {"mode": mode, "pages": max_pages, "latency_ms": stub.latency * 1000},
+            stats
+        ))
+
+    # Повторный обход от последней известной страницы (как в задачах отслеживания)
+    def guided_scan():
+        result = search_product_position("бенчмарк", target, max_pages, strategy="guided")
+        if not result["found"]:
+            raise RuntimeError("Заглушка не вернула искомый товар")
+
+    stats = measure(guided_scan, iterations)
+    results.append(_result(
+        "search_product_position",
+        {"mode": "sequential", "strategy": "guided", "pages": max_pages, "latency_ms": stub.latency * 1000},
+        stats
+    ))
+
+    return results
+
+
+def bench_search_regions(stub, iterations):
+    from services.position_service import search_product_position_regions
+
+    max_pages = (stub.depth + PAGE_SIZE - 1) // PAGE_SIZE
+    target = str(sku_at(stub.depth))
+    results = []
+
+    # Обход одного и восьми регионов: регионы обходятся одновременно
+    for count in (1, 8):
+        regions = [str(-1257786 - index) for index in range(count)]
+
+        def scan():
+            result = search_product_position_regions("бенчмарк", target, regions, max_pages)
+            if result["found_count"] != count:
+                raise RuntimeError("Заглушка не вернула искомый товар во всех регионах")
+
+        stats = measure(scan, iterations)
+        results.append(_result(
+            "search_product_position_regions",
+            {"regions": count, "pages": max_pages, "latency_ms": stub.latency * 1000},
+            stats
+        ))
+
+    return results
+
+
+def generate_history(store, sku, size, days=29):
+    """
+    Заполняет хранилище синтетической историей товара
+
+    Записи равномерно распределены по последним days дням.
+
+    Args:
+        store: Хранилище истории
+        sku (int): Артикул товара
+        size (int): Количество записей
+        days (int): Период истории в днях
+
+    Returns:
+        float: Время подготовки в секундах
+    """
+    started = time.perf_counter()
+    end = datetime.now()
+    step = timedelta(days=days) / size
+
+    batch = []
+    for index in range(size):
+        position = 1 + index % 500
+        batch.append({
+            'timestamp': end - step * (size - index),
+            'sku': sku,
+            'query': "бенчмарк",
+            'organic_position': position,
+            'promo_position': position // 2 or 1,
+            'price': 999.0 + index % 50,
+            'cpm': 650 if index % 3 == 0 else None,
+            'ad_type': "Аукцион" if index % 3 == 0 else "Органика",
+            'page': (position - 1) // PAGE_SIZE + 1,
+            'position_on_page': (position - 1) % PAGE_SIZE + 1,
+            'boost_cost': None
+        })
+        if len(batch) >= HISTORY_BATCH:
+            store.append(batch)
+            batch = []
+
+    if batch:
+        store.append(batch)
+
+    return time.perf_counter() - started
+
+
+def bench_history(sizes, iterations):
+    from services.history_store import get_history_store
+    from services.position_service import get_position_history_data
+
+    store = get_history_store()
+    results = []
+
+    for size in sizes:
+        sku = 900000000 + size
+        elapsed = generate_history(store, sku, size)
+        print(f"Синтетическая история {size} записей подготовлена за {elapsed:.1f} с")
+
+        # Полная выборка за 30 дней и первая страница курсорной выборки
+        full_iterations = max(2, min(iterations, int(iterations * 1000 / size)))
+        stats = measure(lambda: get_position_history_data(str(sku), days=30), full_iterations)
+        results.append(_result("get_position_history_data", {"rows": size, "limit": None}, stats))
+
+        stats = measure(lambda: get_position_history_data(str(sku), days=30, limit=1000), min(iterations, 50))
+        results.append(_result("get_position_history_data", {"rows": size, "limit": 1000}, stats))
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure_environment(stub, workdir):
+    """
+    Направляет сервисы на заглушку и временные базы
+
+    Args:
+        stub (StubServer): Запущенная заглушка
+        workdir (str): Директория для баз истории
+    """
+    os.environ.update({
+        "WB_SEARCH_API_URL": stub.search_url,
+        "WB_CARD_API_URL": stub.card_url,
+        "WB_DATA_DIR": workdir,
+        "WB_HISTORY_BACKEND": "sqlite",
+        "WB_HISTORY_DB_PATH": os.path.join(workdir, "history.sqlite3"),
+        "WB_ROLLUP_DB_PATH": os.path.join(workdir, "history.sqlite3"),
+        "WB_TRACKING_DB_PATH": os.path.join(workdir, "tracking.sqlite3"),
+        # Каждый обход должен доходить до заглушки, а не до кэша
+        "WB_SEARCH_CACHE_TTL": "0",
+        "WB_PRODUCT_CACHE_TTL": "0",
+        # Ограничитель частоты не должен влиять на замеры
+        "WB_RATE_LIMIT_DB_PATH": "",
+        "WB_RATE_LIMIT_INITIAL_RATE": "1000000",
+        "WB_RATE_LIMIT_MAX_RATE": "1000000",
+        "WB_RATE_LIMIT_BURST": "1000000"
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности на локальной заглушке API")
+    parser.add_argument("--output", default=os.path.join("reports", "benchmark.json"), help="Файл отчета JSON")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="Размеры синтетической истории через запятую")
+    parser.add_argument("--iterations", type=int, default=1000, help="Замеров для быстрых функций")
+    parser.add_argument("--scan-iterations", type=int, default=10, help="Замеров обхода выдачи")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Задержка ответа заглушки, миллисекунд")
+    parser.add_argument("--depth", type=int, default=1000, help="Глубина выдачи заглушки (искомый товар - последний)")
+    parser.add_argument("--only", action="append",
+                        choices=["parse_search_page", "find_product_by_sku", "format_product_data",
+                                 "search_product_position", "search_product_position_regions",
+                                 "get_position_history_data"],
+                        help="Запустить только указанные замеры (можно указать несколько раз)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    selected = set(args.only or [])
+
+    def enabled(name):
+        return not selected or name in selected
+
+    stub = StubServer(latency=args.latency_ms / 1000, depth=args.depth).start()
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix="wb-bench-") as workdir:
+        configure_environment(stub, workdir)
+
+        try:
+            if enabled("parse_search_page"):
+                results += bench_parse_search_page(stub, args.iterations)
+            if enabled("find_product_by_sku"):
+                results += bench_find_product_by_sku(stub, args.iterations)
+            if enabled("format_product_data"):
+                results += bench_format_product_data(args.iterations)
+            if enabled("search_product_position"):
+                results += bench_search_product_position(stub, args.scan_iterations)
+            if enabled("search_product_position_regions"):
+                results += bench_search_regions(stub, args.scan_iterations)
+            if enabled("get_position_history_data"):
+                results += bench_history(sizes, args.iterations)
+        finally:
+            stub.stop()
+
+    report = {
+        "version": REPORT_VERSION,
+        "created_at": datetime.now().isoformat(),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "latency_ms": args.latency_ms,
+            "depth": args.depth,
+            "sizes": sizes,
+            "iterations": args.iterations,
+            "scan_iterations": args.scan_iterations
+        },
+        "results": results
+    }
+
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"Отчет сохранен: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+# Локальная заглушка API Wildberries для замеров производительности
+#
+# Отдает страницы поисковой выдачи и карточки товаров, собранные из
+# записанных ответов search.wb.ru и card.wb.ru (benchmarks/fixtures).
+# Глубина выдачи (сколько товаров находится по запросу) и задержка ответа
+# настраиваются, поэтому замеры не зависят от сети и состояния Wildberries.
+#
+# Отдельный запуск:
+#   python -m benchmarks.stub_server --port 8099 --latency-ms 50 --depth 1000
+import argparse
+import copy
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# Путь выдачи и карточек, как у настоящего API
+SEARCH_PATH = "/exactmatch/ru/common/v13/search"
+CARD_PATH = "/cards/detail"
+
+# Товаров на странице выдачи
+PAGE_SIZE = 100
+
+# Артикул первого товара выдачи; товар на позиции N имеет артикул FIRST_SKU + N - 1
+FIRST_SKU = 100000000
+
+
+def load_fixture(name):
+    """
+    Загружает записанный ответ API
+
+    Args:
+        name (str): Имя файла в benchmarks/fixtures
+
+    Returns:
+        dict: Данные фикстуры
+    """
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def sku_at(position):
+    """
+    Возвращает артикул товара на позиции выдачи заглушки
+
+    Args:
+        position (int): Позиция в выдаче, начиная с 1
+
+    Returns:
+        int: Артикул товара
+    """
+    return FIRST_SKU + position - 1
+
+
+class StubServer:
+    """HTTP-заглушка API поиска и карточек в фоновом потоке"""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, depth=1000, ad_every=10):
+        """
+        Args:
+            host (str): Адрес прослушивания
+            port (int): Порт (0 - любой свободный)
+            latency (float): Задержка каждого ответа в секундах
+            depth (int): Количество товаров, находимых по любому запросу
+            ad_every (int): Каждый ad_every-й товар выдачи отмечается как рекламный
+        """
+        self.latency = latency
+        self.depth = depth
+        self.ad_every = ad_every
+        self.requests = 0
+
+        self._search_template = load_fixture("search_product.json")
+        self._card_template = load_fixture("card_product.json")
+        self._pages = {}
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def search_url(self):
+        return self.base_url + SEARCH_PATH
+
+    @property
+    def card_url(self):
+        return self.base_url + CARD_PATH
+
+    def start(self):
+        """Запускает заглушку в фоновом потоке"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="wb-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Останавливает заглушку"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def search_page(self, page):
+        """
+        Формирует ответ поиска для страницы (ответы кэшируются по номеру страницы)
+
+        Args:
+            page (int): Номер страницы
+
+        Returns:
+            bytes: Тело ответа
+        """
+        with self._lock:
+            body = self._pages.get(page)
+        if body is not None:
+            return body
+
+        products = []
+        first = (page - 1) * PAGE_SIZE + 1
+        for position in range(first, min(first + PAGE_SIZE, self.depth + 1)):
+            product = copy.deepcopy(self._search_template)
+            product["id"] = sku_at(position)
+            product["__sort"] = position
+            if self.ad_every and position % self.ad_every == 0:
+                product["log"]["position"] = position + self.ad_every
+                product["log"]["promoPosition"] = position
+            else:
+                del product["log"]
+            products.append(product)
+
+        body = json.dumps({"state": 0, "version": 2, "data": {"products": products}}, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            self._pages[page] = body
+        return body
+
+    def cards(self, ids):
+        """
+        Формирует ответ API карточек
+
+        Args:
+            ids (list): Запрошенные артикулы
+
+        Returns:
+            bytes: Тело ответа
+        """
+        products = []
+        for article_id in ids:
+            product = copy.deepcopy(self._card_template)
+            product["id"] = article_id
+            products.append(product)
+
+        return json.dumps({"state": 0, "data": {"products": products}}, ensure_ascii=False).encode("utf-8")
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                url = urlsplit(self.path)
+                params = parse_qs(url.query)
+
+                if url.path == SEARCH_PATH:
+                    body = stub.search_page(int(params.get("page", ["1"])[0]))
+                elif url.path == CARD_PATH:
+                    ids = [int(value) for value in params.get("nm", [""])[0].split(";") if value]
+                    body = stub.cards(ids)
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка API Wildberries")
+    parser.add_argument("--host", default="127.0.0.1", help="Адрес прослушивания")
+    parser.add_argument("--port", type=int, default=8099, help="Порт")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Задержка ответа, миллисекунд")
+    parser.add_argument("--depth", type=int, default=1000, help="Товаров в выдаче по любому запросу")
+    args = parser.parse_args()
+
+    stub = StubServer(args.host, args.port, args.latency_ms / 1000, args.depth)
+    print(f"Заглушка запущена: WB_SEARCH_API_URL={stub.search_url} WB_CARD_API_URL={stub.card_url}")
+    try:
+        stub._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
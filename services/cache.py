@@ -0,0 +1,287 @@
+# Общий кэш процесса для ответов API Wildberries
+import threading
+import time
+from collections import OrderedDict
+
+from services.metrics import register_collector
+
+# Реестр всех созданных кэшей (имя -> кэш) для вывода статистики
+_caches = {}
+_registry_lock = threading.Lock()
+
+# Состояния записи кэша
+_MISSING = "missing"
+_FRESH = "fresh"
+_STALE = "stale"
+
+
+class _Flight:
+    """Загрузка значения, которую ожидают конкурентные вызовы"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """
+    Потокобезопасный LRU-кэш с временем жизни записей
+
+    Конкурентные промахи по одному ключу объединяются: загрузку выполняет
+    только первый вызов, остальные ждут его результата (single-flight).
+    Ошибки загрузки и значения None не кэшируются.
+
+    Если задан stale_ttl, устаревшая запись еще stale_ttl секунд отдается
+    из get_or_load как есть, а обновление выполняется одной фоновой
+    загрузкой (stale-while-revalidate).
+    """
+
+    def __init__(self, name, ttl, max_entries, stale_ttl=0):
+        """
+        Args:
+            name (str): Имя кэша для статистики
+            ttl (float): Время жизни записи в секундах (0 - кэширование отключено)
+            max_entries (int): Максимальное количество записей
+            stale_ttl (float): Сколько секунд после истечения ttl отдавать устаревшую запись
+        """
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self._data = OrderedDict()  # ключ -> (значение, момент сохранения, момент истечения)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "loads": 0,
+            "load_errors": 0,
+            "stale_hits": 0,
+            "refreshes": 0,
+            "evictions": 0,
+            "expirations": 0
+        }
+
+        with _registry_lock:
+            _caches[name] = self
+
+    def get(self, key):
+        """
+        Возвращает значение из кэша без загрузки
+
+        Args:
+            key: Ключ записи
+
+        Returns:
+            Значение или None, если записи нет или она устарела
+        """
+        with self._lock:
+            value, state = self._lookup(key)
+            if state == _FRESH:
+                self._stats["hits"] += 1
+                return value
+
+            self._stats["misses"] += 1
+            return None
+
+    def set(self, key, value, ttl=None):
+        """
+        Сохраняет значение в кэш
+
+        Args:
+            key: Ключ записи
+            value: Значение
+            ttl (float, optional): Время жизни записи вместо значения по умолчанию
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def get_or_load(self, key, loader, ttl=None, max_age=None):
+        """
+        Возвращает значение из кэша или загружает его через loader
+
+        Args:
+            key: Ключ записи
+            loader (callable): Функция без аргументов, возвращающая значение
+            ttl (float, optional): Время жизни записи вместо значения по умолчанию
+            max_age (float, optional): Максимальный возраст записи в секундах;
+                более старая запись (в том числе устаревшая) загружается заново
+
+        Returns:
+            Значение из кэша или результат loader()
+        """
+        ttl = self.ttl if ttl is None else ttl
+
+        with self._lock:
+            value, state = self._lookup(key, max_age)
+            if state == _FRESH:
+                self._stats["hits"] += 1
+                return value
+
+            if state == _STALE:
+                self._stats["stale_hits"] += 1
+                if key not in self._flights:
+                    flight = _Flight()
+                    self._flights[key] = flight
+                    self._stats["refreshes"] += 1
+                    threading.Thread(
+                        target=self._load,
+                        args=(key, loader, ttl, flight),
+                        name=f"cache-refresh-{self.name}",
+                        daemon=True
+                    ).start()
+                return value
+
+            self._stats["misses"] += 1
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._stats["coalesced"] += 1
+                leader = False
+            else:
+                flight = _Flight()
+                self._flights[key] = flight
+                leader = True
+
+        if leader:
+            self._load(key, loader, ttl, flight)
+        else:
+            flight.event.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def age(self, key):
+        """
+        Возвращает возраст записи в секундах
+
+        Args:
+            key: Ключ записи
+
+        Returns:
+            float: Возраст записи или None, если записи нет
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            return time.monotonic() - entry[1]
+
+    def invalidate(self, key=None):
+        """
+        Удаляет запись из кэша или очищает кэш целиком
+
+        Args:
+            key (optional): Ключ записи; если не указан, кэш очищается полностью
+        """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        """
+        Возвращает счетчики кэша
+
+        Returns:
+            dict: Статистика попаданий, промахов и размера кэша
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._data)
+
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else None
+        stats["ttl"] = self.ttl
+        stats["stale_ttl"] = self.stale_ttl
+        stats["max_entries"] = self.max_entries
+        return stats
+
+    def _load(self, key, loader, ttl, flight):
+        # Выполняет загрузку и будит всех ожидающих ее результата
+        try:
+            flight.value = loader()
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                self._stats["load_errors"] += 1
+        else:
+            with self._lock:
+                self._stats["loads"] += 1
+                if flight.value is not None and ttl > 0 and self.max_entries > 0:
+                    self._store(key, flight.value, ttl)
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    def _lookup(self, key, max_age=None):
+        # Вызывается под блокировкой; возвращает (значение, состояние записи)
+        entry = self._data.get(key)
+        if entry is None:
+            return None, _MISSING
+
+        value, stored_at, expires_at = entry
+        now = time.monotonic()
+        if expires_at + self.stale_ttl <= now:
+            del self._data[key]
+            self._stats["expirations"] += 1
+            return None, _MISSING
+
+        if max_age is not None and now - stored_at > max_age:
+            return None, _MISSING
+
+        self._data.move_to_end(key)
+        return value, (_FRESH if now < expires_at else _STALE)
+
+    def _store(self, key, value, ttl):
+        # Вызывается под блокировкой
+        now = time.monotonic()
+        self._data[key] = (value, now, now + ttl)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self._stats["evictions"] += 1
+
+
+def get_cache_stats():
+    """
+    Возвращает статистику всех кэшей процесса
+
+    Returns:
+        dict: Словарь имя кэша -> статистика
+    """
+    with _registry_lock:
+        caches = list(_caches.values())
+
+    return {cache.name: cache.stats() for cache in caches}
+
+
+def _collect_cache_metrics():
+    stats = get_cache_stats()
+    families = []
+
+    for name, kind, documentation in (
+        ("hits", "counter", "Попаданий в кэш"),
+        ("misses", "counter", "Промахов кэша"),
+        ("stale_hits", "counter", "Отдач устаревших записей"),
+        ("evictions", "counter", "Вытеснений по размеру"),
+        ("size", "gauge", "Записей в кэше"),
+        ("hit_ratio", "gauge", "Доля попаданий в кэш")
+    ):
+        metric = f"wb_cache_{name}_total" if kind == "counter" else f"wb_cache_{name}"
+        samples = [({"cache": cache}, values[name]) for cache, values in sorted(stats.items())]
+        families.append((metric, kind, documentation, samples))
+
+    return families
+
+
+register_collector(_collect_cache_metrics)
@@ -0,0 +1,156 @@
+# Настройки сервисов
+# Все значения можно переопределить через переменные окружения или файл .env
+import os
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+
+def env_int(name, default):
+    """
+    Читает целочисленную настройку из окружения
+
+    Args:
+        name (str): Имя переменной окружения
+        default (int): Значение по умолчанию
+
+    Returns:
+        int: Значение настройки
+    """
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"Переменная окружения {name} должна быть целым числом")
+
+
+def env_float(name, default):
+    """
+    Читает дробную настройку из окружения
+
+    Args:
+        name (str): Имя переменной окружения
+        default (float): Значение по умолчанию
+
+    Returns:
+        float: Значение настройки
+    """
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f"Переменная окружения {name} должна быть числом")
+
+
+# Адреса API Wildberries (переопределяются, например, для локальной заглушки в benchmarks/)
+SEARCH_API_URL = os.environ.get("WB_SEARCH_API_URL", "https://search.wb.ru/exactmatch/ru/common/v13/search")
+CARD_API_URL = os.environ.get("WB_CARD_API_URL", "https://card.wb.ru/cards/detail")
+
+# Регион выдачи по умолчанию (Москва)
+DEFAULT_DEST = os.environ.get("WB_DEST", "-1257786")
+
+# Сортировка поисковой выдачи по умолчанию
+DEFAULT_SORT = os.environ.get("WB_SORT", "popular")
+
+# Кэш страниц поисковой выдачи
+SEARCH_CACHE_TTL = env_float("WB_SEARCH_CACHE_TTL", 60.0)  # секунды, 0 - кэш отключен
+SEARCH_CACHE_MAX_ENTRIES = env_int("WB_SEARCH_CACHE_MAX_ENTRIES", 2000)
+
+# Параллельный обход страниц выдачи
+SCAN_WINDOW = env_int("WB_SCAN_WINDOW", 3)  # страниц в окне по умолчанию
+SCAN_MAX_WORKERS = env_int("WB_SCAN_MAX_WORKERS", 8)  # потоков в общем пуле
+TRACKING_SCAN_STRATEGY = os.environ.get("WB_TRACKING_SCAN_STRATEGY", "guided")  # порядок обхода в задачах отслеживания
+GUIDED_CONFIRM_MAX_AGE = env_float("WB_GUIDED_CONFIRM_MAX_AGE", 3600.0)  # секунды: снимки для проверки пропущенных страниц
+
+# Одновременный обход выдачи в нескольких регионах
+REGION_MAX_WORKERS = env_int("WB_REGION_MAX_WORKERS", 8)  # потоков в общем пуле регионов
+MAX_REGIONS = env_int("WB_MAX_REGIONS", 32)  # регионов в одном запросе или задаче отслеживания
+
+# HTTP-клиент для запросов к API Wildberries
+HTTP_TIMEOUT = env_float("WB_HTTP_TIMEOUT", 10.0)  # секунды
+HTTP_POOL_CONNECTIONS = env_int("WB_HTTP_POOL_CONNECTIONS", 4)  # пулов (хостов) на сессию
+HTTP_POOL_MAXSIZE = env_int("WB_HTTP_POOL_MAXSIZE", 8)  # соединений в пуле одного хоста
+HTTP_RETRIES = env_int("WB_HTTP_RETRIES", 2)  # повторов при сетевых ошибках и 429/5xx
+HTTP_BACKOFF_FACTOR = env_float("WB_HTTP_BACKOFF_FACTOR", 0.5)  # базовая задержка между повторами
+
+# Адаптивное ограничение частоты запросов к каждому хосту API
+RATE_LIMIT_INITIAL_RATE = env_float("WB_RATE_LIMIT_INITIAL_RATE", 5.0)  # запросов в секунду при старте
+RATE_LIMIT_MIN_RATE = env_float("WB_RATE_LIMIT_MIN_RATE", 0.5)  # запросов в секунду
+RATE_LIMIT_MAX_RATE = env_float("WB_RATE_LIMIT_MAX_RATE", 50.0)  # запросов в секунду
+RATE_LIMIT_BURST = env_float("WB_RATE_LIMIT_BURST", 5.0)  # запросов подряд без ожидания
+RATE_LIMIT_INCREASE = env_float("WB_RATE_LIMIT_INCREASE", 0.5)  # прирост скорости за секунду без ошибок
+RATE_LIMIT_DECREASE = env_float("WB_RATE_LIMIT_DECREASE", 0.5)  # множитель скорости при 429/5xx
+RATE_LIMIT_MAX_WAIT = env_float("WB_RATE_LIMIT_MAX_WAIT", 30.0)  # секунды ожидания токена до ответа 429
+
+# Пакетные запросы карточек товаров
+CARD_BATCH_SIZE = env_int("WB_CARD_BATCH_SIZE", 100)  # артикулов в одном запросе
+CARD_MAX_WORKERS = env_int("WB_CARD_MAX_WORKERS", 4)  # одновременных запросов пачек
+
+# Кэш карточек товаров
+PRODUCT_CACHE_TTL = env_float("WB_PRODUCT_CACHE_TTL", 300.0)  # секунды, 0 - кэш отключен
+PRODUCT_CACHE_STALE_TTL = env_float("WB_PRODUCT_CACHE_STALE_TTL", 1800.0)  # секунды отдачи устаревших данных
+PRODUCT_CACHE_MAX_ENTRIES = env_int("WB_PRODUCT_CACHE_MAX_ENTRIES", 10000)
+
+# Хранилище истории позиций
+DATA_DIR = os.environ.get("WB_DATA_DIR", "data")
+HISTORY_BACKEND = os.environ.get("WB_HISTORY_BACKEND", "sqlite")  # "sqlite" или "csv"
+HISTORY_DB_PATH = os.environ.get("WB_HISTORY_DB_PATH", os.path.join(DATA_DIR, "history.sqlite3"))
+HISTORY_STREAM_CHUNK = env_int("WB_HISTORY_STREAM_CHUNK", 5000)  # записей в части потоковой выдачи
+HISTORY_EXPORT_CHUNK = env_int("WB_HISTORY_EXPORT_CHUNK", 100000)  # записей в группе строк массовой выгрузки
+ROLLUP_DB_PATH = os.environ.get("WB_ROLLUP_DB_PATH", HISTORY_DB_PATH)  # база часовых и дневных агрегатов
+
+# Отложенная запись истории позиций
+HISTORY_WRITE_BEHIND = env_int("WB_HISTORY_WRITE_BEHIND", 1) == 1  # 0 - запись на пути запроса
+HISTORY_FLUSH_ROWS = env_int("WB_HISTORY_FLUSH_ROWS", 500)  # записей в буфере до немедленного сброса
+HISTORY_FLUSH_INTERVAL = env_float("WB_HISTORY_FLUSH_INTERVAL", 1.0)  # секунды между сбросами буфера
+HISTORY_BUFFER_MAX_ROWS = env_int("WB_HISTORY_BUFFER_MAX_ROWS", 100000)  # предельный размер буфера
+HISTORY_FSYNC = os.environ.get("WB_HISTORY_FSYNC", "flush")  # "flush" - fsync при каждом сбросе, "off" - на усмотрение ОС
+
+# Уплотнение истории позиций в сжатые помесячные разделы и сроки хранения
+HISTORY_ARCHIVE_DIR = os.environ.get("WB_HISTORY_ARCHIVE_DIR", os.path.join(DATA_DIR, "archive"))
+HISTORY_HOT_DAYS = env_float("WB_HISTORY_HOT_DAYS", 30.0)  # дни в основном хранилище, 0 - без уплотнения
+HISTORY_RAW_RETENTION_DAYS = env_float("WB_HISTORY_RAW_RETENTION_DAYS", 0.0)  # дни хранения записей, 0 - без ограничения
+HISTORY_ROLLUP_RETENTION_DAYS = env_float("WB_HISTORY_ROLLUP_RETENTION_DAYS", 0.0)  # дни хранения агрегатов, 0 - без ограничения
+HISTORY_COMPACT_INTERVAL = env_float("WB_HISTORY_COMPACT_INTERVAL", 3600.0)  # секунды между уплотнениями, 0 - только вручную
+
+# Общее для всех процессов состояние ограничителя частоты запросов (например, data/ratelimit.sqlite3).
+# По умолчанию пусто - состояние только в памяти процесса: общий файл добавляет транзакцию
+# SQLite к каждому запросу к API и выстраивает запросы всех воркеров в очередь
+RATE_LIMIT_DB_PATH = os.environ.get("WB_RATE_LIMIT_DB_PATH", "")
+
+# Снимки страниц поисковой выдачи
+SNAPSHOTS_ENABLED = env_int("WB_SNAPSHOTS", 1) == 1  # 0 - снимки не сохраняются
+SNAPSHOT_DB_PATH = os.environ.get("WB_SNAPSHOT_DB_PATH", os.path.join(DATA_DIR, "snapshots.sqlite3"))
+SNAPSHOT_RETENTION_DAYS = env_float("WB_SNAPSHOT_RETENTION_DAYS", 14.0)  # дни хранения снимков
+SNAPSHOT_MAX_AGE = env_float("WB_SNAPSHOT_MAX_AGE", 86400.0)  # секунды: самый старый снимок, пригодный для ответа
+
+# Отслеживание остатков и цен по карточкам товаров
+STOCK_DB_PATH = os.environ.get("WB_STOCK_DB_PATH", os.path.join(DATA_DIR, "stock.sqlite3"))
+STOCK_TRACKING_INTERVAL = env_int("WB_STOCK_TRACKING_INTERVAL", 15)  # минуты между снимками по умолчанию
+
+# Планировщик задач отслеживания
+SCHEDULER_MAX_WORKERS = env_int("WB_SCHEDULER_MAX_WORKERS", 4)  # одновременно выполняемых задач
+SCHEDULER_JOB_TIMEOUT = env_float("WB_SCHEDULER_JOB_TIMEOUT", 300.0)  # секунды на один запуск
+SCHEDULER_MAX_JITTER = env_float("WB_SCHEDULER_MAX_JITTER", 30.0)  # секунды случайного сдвига запуска
+SCHEDULER_COALESCE_WINDOW = env_float("WB_SCHEDULER_COALESCE_WINDOW", 15.0)  # секунды объединения задач одного запроса
+
+# Реестр задач отслеживания
+TRACKING_DB_PATH = os.environ.get("WB_TRACKING_DB_PATH", HISTORY_DB_PATH)
+TRACKER_LEASE_TTL = env_float("WB_TRACKER_LEASE_TTL", 30.0)  # секунды аренды права запуска расписания
+TRACKER_MODE = os.environ.get("WB_TRACKER_MODE", "embedded")  # "embedded" - в веб-процессах, "external" - python -m services.tracker
+TRACKER_POLL_INTERVAL = env_float("WB_TRACKER_POLL_INTERVAL", 2.0)  # секунды между сверками расписания с реестром
+TRACKER_METRICS_PORT = env_int("WB_TRACKER_METRICS_PORT", 0)  # порт /metrics процесса отслеживания, 0 - отключено
+
+# Поток результатов отслеживания (Server-Sent Events)
+EVENTS_DB_PATH = os.environ.get("WB_EVENTS_DB_PATH", TRACKING_DB_PATH)  # база событий отслеживания
+EVENTS_RETENTION_HOURS = env_float("WB_EVENTS_RETENTION_HOURS", 24.0)  # часы хранения событий для возобновления потока
+EVENTS_POLL_INTERVAL = env_float("WB_EVENTS_POLL_INTERVAL", 0.5)  # секунды между проверками новых событий
+EVENTS_HEARTBEAT = env_float("WB_EVENTS_HEARTBEAT", 15.0)  # секунды между комментариями keep-alive в потоке
+EVENTS_BUFFER_SIZE = env_int("WB_EVENTS_BUFFER_SIZE", 1000)  # последних событий в памяти процесса
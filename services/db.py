@@ -0,0 +1,54 @@
+# Подключения к встроенной базе SQLite
+import os
+import sqlite3
+import threading
+
+_local = threading.local()
+
+
+def get_connection(path):
+    """
+    Возвращает подключение к базе SQLite для текущего потока
+
+    Подключения создаются по одному на поток и файл базы, в режиме WAL,
+    чтобы чтение истории не блокировалось записью из других потоков и процессов.
+
+    Args:
+        path (str): Путь к файлу базы
+
+    Returns:
+        sqlite3.Connection: Подключение к базе
+    """
+    pid = os.getpid()
+    connections = getattr(_local, "connections", None)
+    if connections is None or getattr(_local, "pid", None) != pid:
+        connections = {}
+        _local.connections = connections
+        _local.pid = pid
+
+    connection = connections.get(path)
+    if connection is None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        connection = sqlite3.connect(path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connections[path] = connection
+
+    return connection
+
+
+def table_columns(connection, table):
+    """
+    Возвращает имена колонок таблицы
+
+    Args:
+        connection (sqlite3.Connection): Подключение к базе
+        table (str): Имя таблицы
+
+    Returns:
+        set: Имена колонок (пустое множество, если таблицы нет)
+    """
+    return {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
@@ -0,0 +1,512 @@
+# Уплотнение истории позиций в сжатые помесячные разделы
+#
+# Основное хранилище истории (SQLite или CSV) содержит только записи за
+# последние WB_HISTORY_HOT_DAYS дней. Более старые записи фоновое уплотнение
+# переносит в разделы {WB_HISTORY_ARCHIVE_DIR}/{sku}/{YYYY-MM}.csv.gz, а при
+# выборке истории читаются только разделы, пересекающиеся с запрошенным
+# периодом. Поэтому объем чтения зависит от периода запроса, а не от всей
+# истории товара.
+#
+# Сроки хранения:
+#   WB_HISTORY_RAW_RETENTION_DAYS - разделы старше удаляются целиком (по месяцам);
+#       за этот период остаются только часовые и дневные агрегаты (services.rollups)
+#   WB_HISTORY_ROLLUP_RETENTION_DAYS - удаляются и агрегаты
+#
+# Уплотнение выполняет процесс, удерживающий аренду расписания отслеживания,
+# раз в WB_HISTORY_COMPACT_INTERVAL секунд, или вручную:
+#   python -m services.history_archive --compact
+import argparse
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка файлов недоступна
+    fcntl = None
+
+from services import config
+from services.history_store import HISTORY_FIELDS, CsvHistoryStore, get_history_store
+from services.metrics import Counter
+from services.rollups import get_rollup_store
+
+logger = logging.getLogger(__name__)
+
+# Расширение файлов разделов
+PARTITION_SUFFIX = ".csv.gz"
+
+# Оглавление разделов товара: границы времени и количество записей каждого раздела
+MANIFEST_NAME = "manifest.json"
+
+# Формат времени в разделах (микросекунды сохраняются всегда)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+HISTORY_ARCHIVED = Counter(
+    "wb_history_archived_rows_total",
+    "Записей истории, перенесенных в сжатые разделы"
+)
+
+
+def next_month(timestamp):
+    """
+    Возвращает начало следующего месяца
+
+    Args:
+        timestamp (datetime): Момент времени
+
+    Returns:
+        datetime: Полночь первого числа следующего месяца
+    """
+    if timestamp.month == 12:
+        return datetime(timestamp.year + 1, 1, 1)
+    return datetime(timestamp.year, timestamp.month + 1, 1)
+
+
+class HistoryArchive:
+    """Сжатые помесячные разделы истории позиций"""
+
+    def __init__(self, path, fsync=True):
+        """
+        Args:
+            path (str): Директория разделов
+            fsync (bool): Дожидаться записи раздела на диск перед заменой
+        """
+        self.path = path
+        self.fsync = fsync
+
+    def _directory(self, sku):
+        return os.path.join(self.path, str(sku))
+
+    def _read_manifest(self, sku):
+        try:
+            with open(os.path.join(self._directory(sku), MANIFEST_NAME), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_manifest(self, sku, manifest):
+        filename = os.path.join(self._directory(sku), MANIFEST_NAME)
+        with open(filename + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(filename + ".tmp", filename)
+
+    def partitions(self, sku, since=None, until=None):
+        """
+        Возвращает разделы товара, пересекающиеся с периодом
+
+        Пересечение проверяется по границам записей раздела из оглавления, а
+        без оглавления - по границам месяца.
+
+        Args:
+            sku (str): Артикул товара
+            since (datetime, optional): Нижняя граница времени (не включительно)
+            until (datetime, optional): Верхняя граница времени (включительно)
+
+        Returns:
+            list: Кортежи (начало месяца, путь к файлу) в порядке времени
+        """
+        directory = self._directory(sku)
+        if not os.path.isdir(directory):
+            return []
+
+        manifest = self._read_manifest(sku) if since is not None or until is not None else {}
+
+        result = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(PARTITION_SUFFIX):
+                continue
+            key = name[:-len(PARTITION_SUFFIX)]
+            try:
+                month = datetime.strptime(key, "%Y-%m")
+            except ValueError:
+                continue
+
+            first, last = month, next_month(month)
+            if key in manifest:
+                first = datetime.fromisoformat(manifest[key]["first"])
+                last = datetime.fromisoformat(manifest[key]["last"])
+
+            if since is not None and last <= since:
+                continue
+            if until is not None and first > until:
+                continue
+            result.append((month, os.path.join(directory, name)))
+
+        return result
+
+    def has_history(self, sku):
+        """
+        Args:
+            sku (str): Артикул товара
+
+        Returns:
+            bool: True, если у товара есть разделы
+        """
+        return bool(self.partitions(sku))
+
+    def list_skus(self):
+        """
+        Returns:
+            list: Артикулы, для которых есть разделы
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path) if self.has_history(name))
+
+    def read(self, sku, query=None, since=None, until=None, dest=None):
+        """
+        Читает записи из разделов, пересекающихся с периодом
+
+        Args:
+            sku (str): Артикул товара
+            query (str, optional): Поисковый запрос
+            since (datetime, optional): Нижняя граница времени (не включительно)
+            until (datetime, optional): Верхняя граница времени (включительно)
+            dest (str, optional): Регион выдачи (по умолчанию - все регионы)
+
+        Yields:
+            pandas.DataFrame: Записи одного раздела в порядке времени
+        """
+        import pandas as pd
+
+        for _, filename in self.partitions(sku, since, until):
+            df = CsvHistoryStore._filter(self._read_partition(pd, filename), query, since, until, dest)
+            if not df.empty:
+                yield df
+
+    def write(self, sku, df):
+        """
+        Добавляет записи товара в разделы
+
+        Раздел месяца переписывается целиком (временный файл с заменой), записи
+        с уже сохраненными (timestamp, query, dest) не дублируются, поэтому
+        повторный перенос тех же записей безопасен.
+
+        Args:
+            sku (str): Артикул товара
+            df (pandas.DataFrame): Записи истории с полями HISTORY_FIELDS
+
+        Returns:
+            int: Количество записанных разделов
+        """
+        import pandas as pd
+
+        if df.empty:
+            return 0
+
+        directory = self._directory(sku)
+        os.makedirs(directory, exist_ok=True)
+        manifest = self._read_manifest(sku)
+
+        written = 0
+        for period, part in df.groupby(df['timestamp'].dt.to_period('M')):
+            filename = os.path.join(directory, f"{period.strftime('%Y-%m')}{PARTITION_SUFFIX}")
+            if os.path.isfile(filename):
+                part = pd.concat([self._read_partition(pd, filename), part], ignore_index=True)
+
+            part = part.drop_duplicates(subset=['timestamp', 'query', 'dest'], keep='last')
+            part = part.sort_values('timestamp', kind='stable')
+
+            temporary = filename + ".tmp"
+            part.to_csv(temporary, index=False, columns=HISTORY_FIELDS, compression='gzip',
+                        date_format=TIMESTAMP_FORMAT)
+            if self.fsync:
+                with open(temporary, 'rb') as f:
+                    os.fsync(f.fileno())
+            os.replace(temporary, filename)
+            written += 1
+
+            manifest[period.strftime('%Y-%m')] = {
+                "first": part['timestamp'].iloc[0].isoformat(),
+                "last": part['timestamp'].iloc[-1].isoformat(),
+                "rows": len(part)
+            }
+
+        self._write_manifest(sku, manifest)
+        return written
+
+    def drop_before(self, cutoff):
+        """
+        Удаляет разделы месяцев, целиком предшествующих cutoff
+
+        Args:
+            cutoff (datetime): Граница срока хранения
+
+        Returns:
+            int: Количество удаленных разделов
+        """
+        removed = 0
+
+        for sku in self.list_skus():
+            expired = [(month, filename) for month, filename in self.partitions(sku) if next_month(month) <= cutoff]
+            if not expired:
+                continue
+
+            manifest = self._read_manifest(sku)
+            for month, filename in expired:
+                os.remove(filename)
+                manifest.pop(month.strftime('%Y-%m'), None)
+                removed += 1
+
+            # Каталог удаляется, только если в нем не осталось разделов: оглавление
+            # может быть потеряно или повреждено и не служит признаком пустоты
+            if self.partitions(sku):
+                self._write_manifest(sku, manifest)
+                continue
+
+            directory = self._directory(sku)
+            try:
+                os.remove(os.path.join(directory, MANIFEST_NAME))
+            except FileNotFoundError:
+                pass
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # В каталоге остались посторонние файлы
+                pass
+
+        return removed
+
+    def stats(self):
+        """
+        Returns:
+            dict: Количество товаров, разделов и их общий размер в байтах
+        """
+        skus = self.list_skus()
+        partitions = [filename for sku in skus for _, filename in self.partitions(sku)]
+        return {
+            "skus": len(skus),
+            "partitions": len(partitions),
+            "bytes": sum(os.path.getsize(filename) for filename in partitions)
+        }
+
+    @contextmanager
+    def lock(self, shared=False):
+        """
+        Блокировка уплотнения: одновременно разделы переписывает один процесс
+
+        Args:
+            shared (bool): Разделяемая блокировка для чтения: несколько читателей
+                не мешают друг другу, но уплотнение ждет их завершения
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, ".lock"), 'a') as lockfile:
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def _read_partition(pd, filename):
+        return pd.read_csv(filename, parse_dates=['timestamp'], dtype={'dest': str}, compression='gzip')
+
+
+class ArchivedHistoryStore:
+    """Хранилище истории, дополняющее выборки записями из сжатых разделов"""
+
+    def __init__(self, hot, archive):
+        """
+        Args:
+            hot: Основное хранилище истории (SqliteHistoryStore или CsvHistoryStore)
+            archive (HistoryArchive): Разделы с уплотненными записями
+        """
+        self.hot = hot
+        self.archive = archive
+
+    @property
+    def name(self):
+        return self.hot.name
+
+    def append(self, rows):
+        """
+        Добавляет записи в основное хранилище
+
+        Args:
+            rows (list): Список записей (словарей с полями HISTORY_FIELDS)
+
+        Returns:
+            list: Добавленные записи
+        """
+        return self.hot.append(rows)
+
+    def has_history(self, sku):
+        """
+        Args:
+            sku (str): Артикул товара
+
+        Returns:
+            bool: True, если история есть в основном хранилище или в разделах
+        """
+        return self.hot.has_history(sku) or self.archive.has_history(sku)
+
+    def list_skus(self):
+        """
+        Returns:
+            list: Артикулы, для которых есть история
+        """
+        return sorted(set(self.hot.list_skus()) | set(self.archive.list_skus()), key=int)
+
+    def last_page(self, sku, query, dest=None):
+        """
+        Возвращает страницу, на которой товар был найден в последний раз (по основному хранилищу)
+
+        Args:
+            sku (str): Артикул товара
+            query (str): Поисковый запрос
+            dest (str, optional): Регион выдачи
+
+        Returns:
+            int: Номер страницы или None
+        """
+        return self.hot.last_page(sku, query, dest)
+
+    def query(self, sku, query=None, since=None, until=None, limit=None, dest=None):
+        """
+        Выбирает историю позиций товара из разделов периода и основного хранилища
+
+        Args:
+            sku (str): Артикул товара
+            query (str, optional): Поисковый запрос
+            since (datetime, optional): Нижняя граница времени (не включительно)
+            until (datetime, optional): Верхняя граница времени (включительно)
+            limit (int, optional): Максимальное количество записей
+            dest (str, optional): Регион выдачи (по умолчанию - все регионы)
+
+        Returns:
+            pandas.DataFrame: Записи истории в порядке времени
+        """
+        # Под разделяемой блокировкой уплотнение не переносит записи из основного
+        # хранилища в разделы между двумя чтениями (запись не пропадает и не повторяется)
+        with self.archive.lock(shared=True):
+            frames = list(self.archive.read(sku, query, since, until, dest))
+            hot = self.hot.query(sku, query, since=since, until=until, limit=limit, dest=dest)
+        if not frames:
+            return hot
+
+        import pandas as pd
+
+        df = pd.concat(frames + [hot[HISTORY_FIELDS]], ignore_index=True)
+        df = df.sort_values('timestamp', kind='stable').reset_index(drop=True)
+        if limit is not None:
+            df = df.iloc[:limit]
+        return df
+
+    def iter_query(self, sku, query=None, since=None, until=None, chunk_size=10000, dest=None):
+        """
+        Выбирает историю позиций товара частями: сначала разделы периода, затем основное хранилище
+
+        Разделы читаются, а чтение основного хранилища начинается под разделяемой
+        блокировкой архива. Начатое чтение видит неизменный снимок (курсор SQLite
+        или открытый CSV-файл, который уплотнение заменяет новым), поэтому
+        блокировка снимается до выдачи частей и медленный потребитель не задерживает
+        уплотнение. Разделы периода держатся в памяти до выдачи.
+
+        Args:
+            sku (str): Артикул товара
+            query (str, optional): Поисковый запрос
+            since (datetime, optional): Нижняя граница времени (не включительно)
+            until (datetime, optional): Верхняя граница времени (включительно)
+            chunk_size (int): Количество записей в части
+            dest (str, optional): Регион выдачи (по умолчанию - все регионы)
+
+        Yields:
+            pandas.DataFrame: Очередная часть записей
+        """
+        with self.archive.lock(shared=True):
+            frames = list(self.archive.read(sku, query, since, until, dest))
+            hot = self.hot.iter_query(sku, query, since=since, until=until, chunk_size=chunk_size, dest=dest)
+            first = next(hot, None)
+
+        for df in frames:
+            for start in range(0, len(df), chunk_size):
+                yield df.iloc[start:start + chunk_size]
+
+        if first is not None:
+            yield first
+            yield from hot
+
+    def move_before(self, sku, cutoff):
+        """
+        Переносит записи товара не новее cutoff из основного хранилища в разделы
+
+        Args:
+            sku (str): Артикул товара
+            cutoff (datetime): Граница переноса
+
+        Returns:
+            int: Количество перенесенных записей
+        """
+        return self.hot.move_before(sku, cutoff, self.archive)
+
+
+def compact_history(store=None, rollup_store=None, now=None, deadline=None):
+    """
+    Уплотняет историю позиций и применяет сроки хранения
+
+    Записи старше WB_HISTORY_HOT_DAYS переносятся в разделы, разделы месяцев
+    старше WB_HISTORY_RAW_RETENTION_DAYS (не меньше WB_HISTORY_HOT_DAYS)
+    удаляются, агрегаты старше WB_HISTORY_ROLLUP_RETENTION_DAYS удаляются.
+
+    Args:
+        store (ArchivedHistoryStore, optional): Хранилище истории (по умолчанию - хранилище процесса)
+        rollup_store (RollupStore, optional): Хранилище агрегатов (по умолчанию - хранилище процесса)
+        now (datetime, optional): Текущий момент (по умолчанию datetime.now())
+        deadline (float, optional): Момент time.monotonic(), после которого перенос прерывается
+            до следующего запуска
+
+    Returns:
+        dict: Обработано товаров, перенесено записей, удалено разделов и интервалов агрегатов
+    """
+    store = store or get_history_store()
+    rollup_store = rollup_store or get_rollup_store()
+    now = now or datetime.now()
+
+    result = {"skus": 0, "moved_rows": 0, "partitions_deleted": 0, "rollups_deleted": 0, "complete": True}
+
+    try:
+        with store.archive.lock():
+            if config.HISTORY_HOT_DAYS > 0:
+                cutoff = now - timedelta(days=config.HISTORY_HOT_DAYS)
+                for sku in store.hot.list_skus():
+                    if deadline is not None and time.monotonic() > deadline:
+                        result["complete"] = False
+                        break
+
+                    moved = store.move_before(sku, cutoff)
+                    result["skus"] += 1
+                    result["moved_rows"] += moved
+                    if moved:
+                        HISTORY_ARCHIVED.inc(moved)
+
+            if config.HISTORY_RAW_RETENTION_DAYS > 0:
+                days = max(config.HISTORY_RAW_RETENTION_DAYS, config.HISTORY_HOT_DAYS)
+                result["partitions_deleted"] = store.archive.drop_before(now - timedelta(days=days))
+
+            if config.HISTORY_ROLLUP_RETENTION_DAYS > 0:
+                result["rollups_deleted"] = rollup_store.prune(
+                    now - timedelta(days=config.HISTORY_ROLLUP_RETENTION_DAYS)
+                )
+    except Exception as e:
+        raise Exception(f"Ошибка при уплотнении истории позиций: {str(e)}")
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Уплотнение истории позиций в сжатые разделы")
+    parser.add_argument("--compact", action="store_true",
+                        help="Перенести записи старше WB_HISTORY_HOT_DAYS в разделы и применить сроки хранения")
+    args = parser.parse_args()
+
+    store = get_history_store()
+
+    if args.compact:
+        print(compact_history(store))
+
+    print(store.archive.stats())
+
+
+if __name__ == "__main__":
+    main()
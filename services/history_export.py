@@ -0,0 +1,399 @@
+# Массовая выгрузка истории позиций
+#
+# История многих товаров выдается одним потоком в колоночном формате
+# Apache Parquet или Arrow IPC (stream), либо в CSV. Записи читаются частями:
+# сжатые разделы уплотненной истории разбираются pyarrow напрямую в колонки
+# Arrow из отображенного в память файла, записи основного хранилища
+# переводятся из частей pandas. Части накапливаются до WB_HISTORY_EXPORT_CHUNK
+# записей - это одна группа строк Parquet или один пакет Arrow. Готовые байты
+# сразу отдаются клиенту, поэтому расход памяти ограничен историей одного
+# товара и размером пакета, а не объемом выгрузки.
+#
+# По умолчанию выгрузка идет в Parquet. Parquet и Arrow требуют пакета pyarrow
+# (входит в requirements.txt); CSV выгружается средствами pandas и доступен
+# без него.
+#
+# Записи товара читаются в память под разделяемой блокировкой архива, поэтому
+# уплотнение не переносит их между основным хранилищем и разделами посреди
+# чтения (запись не пропадает и не повторяется). Блокировка снимается до
+# передачи байтов клиенту: медленная загрузка не задерживает уплотнение.
+#
+# Выгрузка из командной строки:
+#   python -m services.history_export --format parquet --output history.parquet --days 90
+import argparse
+import sys
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+
+from services import config
+from services.history_store import HISTORY_FIELDS, get_history_store
+from services.history_writer import flush_history
+from services.metrics import Counter
+
+# Форматы выгрузки: тип содержимого и расширение файла
+EXPORT_FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", ".arrows"),
+    "csv": ("text/csv", ".csv"),
+}
+
+HISTORY_EXPORTED = Counter(
+    "wb_history_exported_rows_total",
+    "Записей истории, выгруженных массовой выгрузкой",
+    ("format",)
+)
+
+
+def parse_export_time(value, name):
+    """
+    Разбирает границу периода выгрузки
+
+    Args:
+        value (str or datetime): Время в формате ISO 8601
+        name (str): Имя параметра для сообщения об ошибке
+
+    Returns:
+        datetime: Граница периода или None
+    """
+    if value is None or value == "" or isinstance(value, datetime):
+        return value or None
+
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Параметр {name} должен быть временем в формате ISO 8601")
+
+
+def iter_history_export(skus=None, query=None, since=None, until=None, dest=None, output_format="parquet",
+                        chunk_size=None):
+    """
+    Выдает историю позиций товаров одним потоком в формате output_format
+
+    Параметры проверяются до начала выдачи: ошибка в них не прерывает уже
+    начатый ответ.
+
+    Args:
+        skus (list, optional): Артикулы товаров (по умолчанию - все товары с историей)
+        query (str, optional): Поисковый запрос
+        since (datetime or str, optional): Нижняя граница времени (не включительно)
+        until (datetime or str, optional): Верхняя граница времени (включительно)
+        dest (str, optional): Регион выдачи (по умолчанию - все регионы)
+        output_format (str): "parquet", "arrow" или "csv"
+        chunk_size (int, optional): Записей в группе строк Parquet или пакете Arrow
+            (по умолчанию WB_HISTORY_EXPORT_CHUNK)
+
+    Returns:
+        generator: Генератор блоков байтов
+
+    Raises:
+        ValueError: Если параметры некорректны или для формата не установлен pyarrow
+    """
+    if output_format not in EXPORT_FORMATS:
+        raise ValueError(f"format должен быть одним из: {', '.join(EXPORT_FORMATS)}")
+
+    since = parse_export_time(since, "since")
+    until = parse_export_time(until, "until")
+    skus = _normalize_skus(skus)
+    chunk_size = max(1, chunk_size or config.HISTORY_EXPORT_CHUNK)
+
+    if output_format == "csv":
+        writer = _CsvExportWriter()
+    else:
+        writer = _ArrowExportWriter(output_format)
+
+    flush_history()
+    store = get_history_store()
+    archive = getattr(store, "archive", None)
+
+    def generate():
+        if skus is None:
+            selected = store.list_skus()
+        else:
+            selected = skus
+
+        pending = []
+        pending_rows = 0
+
+        try:
+            for sku in selected:
+                with archive.lock(shared=True) if archive is not None else nullcontext():
+                    parts = list(writer.read(store, sku, query, since, until, dest, chunk_size))
+
+                for part in parts:
+                    pending.append(part)
+                    pending_rows += len(part)
+
+                    if pending_rows >= chunk_size:
+                        yield writer.write(pending)
+                        HISTORY_EXPORTED.inc(pending_rows, format=output_format)
+                        pending = []
+                        pending_rows = 0
+
+            if pending:
+                yield writer.write(pending)
+                HISTORY_EXPORTED.inc(pending_rows, format=output_format)
+
+            yield writer.close()
+        except Exception as e:
+            raise Exception(f"Ошибка при выгрузке истории позиций: {str(e)}")
+
+    return generate()
+
+
+def _normalize_skus(skus):
+    # Список или строка через запятую; None - все товары
+    if skus is None:
+        return None
+
+    if isinstance(skus, str):
+        skus = skus.split(",")
+
+    normalized = []
+    for sku in skus:
+        sku = str(sku).strip()
+        if not sku:
+            continue
+        if not sku.isdigit():
+            raise ValueError(f"Артикул должен быть числом: {sku}")
+        if sku not in normalized:
+            normalized.append(sku)
+
+    if not normalized:
+        raise ValueError("Список артикулов пуст")
+
+    return normalized
+
+
+class _ExportSink:
+    """Файловый объект, из которого выгрузка забирает байты, записанные писателем pyarrow"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class _ArrowExportWriter:
+    """Запись частей истории в поток Parquet или Arrow IPC"""
+
+    def __init__(self, output_format):
+        try:
+            import pyarrow as pa
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError(f"Формат {output_format} требует пакета pyarrow (pip install pyarrow)")
+
+        import pyarrow.compute
+        import pyarrow.csv
+
+        self.pa = pa
+        self.output_format = output_format
+        self.schema = pa.schema([
+            ("timestamp", pa.timestamp("us")),
+            ("sku", pa.int64()),
+            ("query", pa.string()),
+            ("organic_position", pa.int32()),
+            ("promo_position", pa.int32()),
+            ("price", pa.float64()),
+            ("cpm", pa.float64()),
+            ("ad_type", pa.string()),
+            ("page", pa.int32()),
+            ("position_on_page", pa.int32()),
+            ("boost_cost", pa.float64()),
+            ("dest", pa.string()),
+        ])
+        self._convert_options = pa.csv.ConvertOptions(
+            column_types={field.name: field.type for field in self.schema},
+            strings_can_be_null=True
+        )
+        self._sink = _ExportSink()
+        self._writer = None
+
+    def read(self, store, sku, query, since, until, dest, chunk_size):
+        """
+        Читает записи товара частями в колонках Arrow
+
+        Разделы уплотненной истории разбираются pyarrow из отображенного в память
+        файла, без промежуточного DataFrame; записи основного хранилища
+        переводятся из частей pandas.
+
+        Args:
+            store: Хранилище истории
+            sku (str): Артикул товара
+            query (str): Поисковый запрос или None
+            since (datetime): Нижняя граница времени (не включительно) или None
+            until (datetime): Верхняя граница времени (включительно) или None
+            dest (str): Регион выдачи или None
+            chunk_size (int): Записей в части основного хранилища
+
+        Yields:
+            pyarrow.Table: Очередная часть записей со схемой выгрузки
+        """
+        archive = getattr(store, "archive", None)
+        if archive is not None:
+            for _, filename in archive.partitions(sku, since, until):
+                table = self._read_partition(filename, query, since, until, dest)
+                if table.num_rows:
+                    yield table
+            store = store.hot
+
+        for chunk in store.iter_query(sku, query, since=since, until=until, chunk_size=chunk_size, dest=dest):
+            yield self._from_pandas(chunk)
+
+    def _read_partition(self, filename, query, since, until, dest):
+        pa = self.pa
+        with pa.memory_map(filename) as source, pa.CompressedInputStream(source, "gzip") as stream:
+            table = pa.csv.read_csv(stream, convert_options=self._convert_options)
+
+        conditions = []
+        if dest:
+            conditions.append(pa.compute.equal(table["dest"], str(dest)))
+        if since is not None:
+            conditions.append(pa.compute.greater(table["timestamp"], pa.scalar(since, pa.timestamp("us"))))
+        if until is not None:
+            conditions.append(pa.compute.less_equal(table["timestamp"], pa.scalar(until, pa.timestamp("us"))))
+        if query:
+            conditions.append(pa.compute.equal(table["query"], query))
+
+        if conditions:
+            mask = conditions[0]
+            for condition in conditions[1:]:
+                mask = pa.compute.and_(mask, condition)
+            table = table.filter(mask)
+
+        return table.select(self.schema.names)
+
+    def _from_pandas(self, df):
+        import pandas as pd
+
+        arrays = []
+        for field in self.schema:
+            column = df[field.name]
+            if self.pa.types.is_string(field.type):
+                if pd.api.types.is_numeric_dtype(column):
+                    # В CSV запрос из цифр читается числом
+                    column = column.astype(str).where(column.notna(), None)
+            elif not self.pa.types.is_timestamp(field.type):
+                column = pd.to_numeric(column, errors="coerce")
+            arrays.append(self.pa.Array.from_pandas(column, type=field.type, safe=False))
+
+        return self.pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def write(self, parts):
+        """
+        Записывает части одной группой строк (Parquet) или одним пакетом (Arrow)
+
+        Args:
+            parts (list): Части, полученные read
+
+        Returns:
+            bytes: Записанные байты
+        """
+        table = self.pa.concat_tables(parts).combine_chunks()
+        self._open().write_table(table)
+        return self._sink.drain()
+
+    def close(self):
+        """
+        Завершает поток (схема пустой выгрузки, метаданные Parquet)
+
+        Returns:
+            bytes: Оставшиеся байты
+        """
+        self._open().close()
+        return self._sink.drain()
+
+    def _open(self):
+        if self._writer is None:
+            if self.output_format == "parquet":
+                self._writer = self.pa.parquet.ParquetWriter(self._sink, self.schema)
+            else:
+                self._writer = self.pa.ipc.new_stream(self._sink, self.schema)
+        return self._writer
+
+
+class _CsvExportWriter:
+    """Запись частей истории в CSV с заголовком в первой строке"""
+
+    def __init__(self):
+        self._header = True
+
+    def read(self, store, sku, query, since, until, dest, chunk_size):
+        for chunk in store.iter_query(sku, query, since=since, until=until, chunk_size=chunk_size, dest=dest):
+            yield chunk[HISTORY_FIELDS]
+
+    def write(self, frames):
+        import pandas as pd
+
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        data = df.to_csv(index=False, header=self._header)
+        self._header = False
+        return data.encode("utf-8")
+
+    def close(self):
+        if self._header:
+            self._header = False
+            return (",".join(HISTORY_FIELDS) + "\n").encode("utf-8")
+        return b""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Массовая выгрузка истории позиций")
+    parser.add_argument("--format", dest="output_format", choices=list(EXPORT_FORMATS), default="parquet",
+                        help="Формат выгрузки")
+    parser.add_argument("--output", default="-", help="Файл выгрузки (по умолчанию - стандартный вывод)")
+    parser.add_argument("--sku", action="append", help="Артикул или артикулы через запятую (можно указать "
+                                                       "несколько раз; по умолчанию - все товары)")
+    parser.add_argument("--query", help="Поисковый запрос")
+    parser.add_argument("--dest", help="Регион выдачи")
+    parser.add_argument("--since", help="Нижняя граница времени, ISO 8601")
+    parser.add_argument("--until", help="Верхняя граница времени, ISO 8601")
+    parser.add_argument("--days", type=float, help="Выгрузить последние N дней (вместо --since)")
+    args = parser.parse_args()
+
+    skus = ",".join(args.sku) if args.sku else None
+    since = args.since
+    if args.days is not None:
+        since = datetime.now() - timedelta(days=args.days)
+
+    try:
+        chunks = iter_history_export(skus, args.query, since=since, until=args.until, dest=args.dest,
+                                     output_format=args.output_format)
+    except ValueError as e:
+        parser.error(str(e))
+
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    try:
+        for chunk in chunks:
+            output.write(chunk)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,708 @@
+# Хранилища истории позиций товаров
+# Бэкенд выбирается настройкой WB_HISTORY_BACKEND: "sqlite" (по умолчанию) или "csv"
+#
+# pandas импортируется только в методах выборки истории: запись позиций,
+# реестр задач и процесс отслеживания обходятся без него, что сокращает
+# время запуска и память воркеров.
+import csv
+import glob
+import os
+import threading
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка файлов недоступна
+    fcntl = None
+
+from services import config
+from services.db import get_connection, table_columns
+
+# Поля записи истории позиций (порядок колонок CSV). Регион выдачи dest добавлен
+# последним: в записях и файлах без него регион - config.DEFAULT_DEST
+HISTORY_FIELDS = ['timestamp', 'sku', 'query', 'organic_position', 'promo_position',
+                  'price', 'cpm', 'ad_type', 'page', 'position_on_page', 'boost_cost', 'dest']
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class HistoryAppendError(Exception):
+    """Добавление записей в историю выполнено частично"""
+
+    def __init__(self, error, written, unwritten):
+        """
+        Args:
+            error (Exception): Исходная ошибка
+            written (list): Записи, добавленные до ошибки
+            unwritten (list): Записи, которые не были добавлены
+        """
+        self.written = written
+        self.unwritten = unwritten
+        super().__init__(str(error))
+
+
+def format_timestamp(value):
+    """
+    Приводит момент времени к текстовому виду, в котором он хранится в истории
+
+    Args:
+        value (datetime or str): Момент времени
+
+    Returns:
+        str: Время в формате "YYYY-MM-DD HH:MM:SS.ffffff"
+    """
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ', timespec='microseconds')
+    return str(value).replace('T', ' ')
+
+
+def _empty_value(value):
+    # Пустые строки (например, позиции без рекламы) хранятся как NULL
+    return None if value == '' else value
+
+
+def _dest(row):
+    # Записи, сохраненные до появления регионов, относятся к региону по умолчанию
+    return str(row.get('dest') or config.DEFAULT_DEST)
+
+
+class CsvHistoryStore:
+    """Хранилище истории в файлах data/positions_{sku}.csv (устаревший формат)"""
+
+    name = "csv"
+
+    def __init__(self, data_dir, fsync=True):
+        """
+        Args:
+            data_dir (str): Директория с CSV-файлами истории
+            fsync (bool): Дожидаться записи данных на диск после каждого добавления
+        """
+        self.data_dir = data_dir
+        self.fsync = fsync
+        self._lock = threading.Lock()
+
+    def _filename(self, sku):
+        return os.path.join(self.data_dir, f"positions_{sku}.csv")
+
+    def append(self, rows):
+        """
+        Добавляет записи в историю
+
+        Записи одного товара дописываются в его файл одной операцией под
+        блокировкой (в процессе и, где доступно, между процессами), поэтому
+        заголовок пишется ровно один раз, а строки разных записей не перемешиваются.
+        Если дозапись в файл товара не удалась, файл обрезается до прежнего
+        размера: записи товара добавляются целиком или не добавляются вовсе.
+
+        Args:
+            rows (list): Список записей (словарей с полями HISTORY_FIELDS)
+
+        Returns:
+            list: Добавленные записи (все переданные)
+
+        Raises:
+            HistoryAppendError: Если записи добавлены не для всех товаров
+        """
+        by_sku = {}
+        for row in rows:
+            by_sku.setdefault(row['sku'], []).append(row)
+
+        written = []
+        try:
+            os.makedirs(self.data_dir, exist_ok=True)
+
+            with self._lock:
+                for sku, sku_rows in by_sku.items():
+                    self._append_sku(sku, sku_rows)
+                    written.extend(sku_rows)
+        except Exception as e:
+            if not written:
+                raise
+            done = set(map(id, written))
+            raise HistoryAppendError(e, written, [row for row in rows if id(row) not in done])
+
+        return written
+
+    def _append_sku(self, sku, rows):
+        with self._open_locked(self._filename(sku)) as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=HISTORY_FIELDS)
+
+            # Заголовок нужен только пустому файлу; размер проверяется под блокировкой
+            csvfile.seek(0, os.SEEK_END)
+            if csvfile.tell() == 0:
+                writer.writeheader()
+            else:
+                self._upgrade_header(csvfile)
+
+            size = csvfile.tell()
+            try:
+                writer.writerows(dict(row, dest=_dest(row)) for row in rows)
+                csvfile.flush()
+                if self.fsync:
+                    os.fsync(csvfile.fileno())
+            except Exception:
+                # Частично дописанные строки удаляются, чтобы повтор не создал дубликатов
+                csvfile.truncate(size)
+                raise
+
+    @staticmethod
+    def _open_locked(filename):
+        # Открывает файл на дозапись под межпроцессной блокировкой. Если, пока ожидалась
+        # блокировка, уплотнение заменило файл новым, блокировка берется заново на новом файле
+        while True:
+            csvfile = open(filename, 'a+', newline='', encoding='utf-8')
+            if fcntl is None:
+                return csvfile
+
+            fcntl.flock(csvfile, fcntl.LOCK_EX)
+            try:
+                if os.fstat(csvfile.fileno()).st_ino == os.stat(filename).st_ino:
+                    return csvfile
+            except FileNotFoundError:
+                pass
+            csvfile.close()
+
+    def move_before(self, sku, cutoff, archive):
+        """
+        Переносит записи товара не новее cutoff в сжатые разделы
+
+        Файл товара переписывается под блокировкой через временный файл с заменой,
+        поэтому одновременное чтение видит либо прежний, либо новый файл.
+
+        Args:
+            sku (str): Артикул товара
+            cutoff (datetime): Граница переноса
+            archive (HistoryArchive): Разделы истории
+
+        Returns:
+            int: Количество перенесенных записей
+        """
+        import pandas as pd
+
+        filename = self._filename(sku)
+        if not os.path.isfile(filename):
+            return 0
+
+        with self._lock:
+            with self._open_locked(filename):
+                df = self._filter(self._read_csv(pd, filename), None, None, None)
+                old = df[df['timestamp'] <= cutoff]
+                if old.empty:
+                    return 0
+
+                archive.write(sku, old)
+
+                temporary = filename + ".tmp"
+                df[df['timestamp'] > cutoff].to_csv(
+                    temporary, index=False, columns=HISTORY_FIELDS, date_format='%Y-%m-%d %H:%M:%S.%f'
+                )
+                if self.fsync:
+                    with open(temporary, 'rb') as f:
+                        os.fsync(f.fileno())
+                os.replace(temporary, filename)
+
+        return len(old)
+
+    @staticmethod
+    def _upgrade_header(csvfile):
+        # Файл в формате без колонки dest переписывается на месте с регионом по умолчанию,
+        # чтобы новые строки совпадали с заголовком. Вызывается под блокировкой файла
+        csvfile.seek(0)
+        header = next(csv.reader(csvfile), None)
+        if header == HISTORY_FIELDS:
+            csvfile.seek(0, os.SEEK_END)
+            return
+
+        csvfile.seek(0)
+        rows = [dict(row, dest=_dest(row)) for row in csv.DictReader(csvfile)]
+
+        csvfile.seek(0)
+        csvfile.truncate()
+        writer = csv.DictWriter(csvfile, fieldnames=HISTORY_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+    def has_history(self, sku):
+        """
+        Проверяет, есть ли история позиций товара
+
+        Args:
+            sku (str): Артикул товара
+
+        Returns:
+            bool: True, если история есть
+        """
+        return os.path.isfile(self._filename(sku))
+
+    def list_skus(self):
+        """
+        Возвращает артикулы, для которых есть история
+
+        Returns:
+            list: Список артикулов
+        """
+        return sorted(
+            os.path.basename(filename)[len("positions_"):-len(".csv")]
+            for filename in glob.glob(os.path.join(self.data_dir, "positions_*.csv"))
+        )
+
+    def last_page(self, sku, query, dest=None):
+        """
+        Возвращает страницу выдачи, на которой товар был найден по запросу в последний раз
+
+        Args:
+            sku (str): Артикул товара
+            query (str): Поисковый запрос
+            dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+
+        Returns:
+            int: Номер страницы или None, если товар по запросу не находили
+        """
+        filename = self._filename(sku)
+        if not os.path.isfile(filename):
+            return None
+
+        dest = str(dest or config.DEFAULT_DEST)
+        page = None
+        with open(filename, newline='', encoding='utf-8') as csvfile:
+            for row in csv.DictReader(csvfile):
+                if row.get('query') == query and row.get('page') and _dest(row) == dest:
+                    page = row['page']
+
+        return int(float(page)) if page is not None else None
+
+    def query(self, sku, query=None, since=None, until=None, limit=None, dest=None):
+        """
+        Выбирает историю позиций товара
+
+        Args:
+            sku (str): Артикул товара
+            query (str, optional): Поисковый запрос
+            since (datetime, optional): Нижняя граница времени (не включительно)
+            until (datetime, optional): Верхняя граница времени (включительно)
+            limit (int, optional): Максимальное количество записей
+            dest (str, optional): Регион выдачи (по умолчанию - все регионы)
+
+        Returns:
+            pandas.DataFrame: Записи истории в порядке времени
+        """
+        import pandas as pd
+
+        filename = self._filename(sku)
+        if not os.path.isfile(filename):
+            return pd.DataFrame(columns=HISTORY_FIELDS)
+
+        df = self._filter(self._read_csv(pd, filename), query, since, until, dest)
+
+        if limit is not None:
+            df = df.iloc[:limit]
+
+        return df
+
+    def iter_query(self, sku, query=None, since=None, until=None, chunk_size=10000, dest=None):
+        """
+        Выбирает историю позиций товара частями, не загружая файл целиком
+
+        Args:
+            sku (str): Артикул товара
+            query (str, optional): Поисковый запрос
+            since (datetime, optional): Нижняя граница времени (не включительно)
+            until (datetime, optional): Верхняя граница времени (включительно)
+            chunk_size (int): Количество строк файла, читаемых за раз
+            dest (str, optional): Регион выдачи (по умолчанию - все регионы)
+
+        Yields:
+            pandas.DataFrame: Очередная часть записей в порядке времени
+        """
+        import pandas as pd
+
+        filename = self._filename(sku)
+        if not os.path.isfile(filename):
+            return
+
+        for chunk in self._read_csv(pd, filename, chunksize=chunk_size):
+            chunk = self._filter(chunk, query, since, until, dest)
+            if not chunk.empty:
+                yield chunk
+
+    @staticmethod
+    def _read_csv(pd, filename, chunksize=None):
+        # Регион читается строкой; в файлах без колонки dest она добавляется при фильтрации
+        return pd.read_csv(filename, parse_dates=['timestamp'], dtype={'dest': str}, chunksize=chunksize)
+
+    @staticmethod
+    def _filter(df, query, since, until, dest=None):
+        if 'dest' not in df.columns:
+            df = df.assign(dest=str(config.DEFAULT_DEST))
+        if dest:
+            df = df[df['dest'] == str(dest)]
+        if since is not None:
+            df = df[df['timestamp'] > since]
+        if until is not None:
+            df = df[df['timestamp'] <= until]
+        if query:
+            df = df[df['query'] == query]
+        return df
+
+
+class SqliteHistoryStore:
+    """Хранилище истории во встроенной базе SQLite (режим WAL, индекс по sku, query, timestamp)"""
+
+    name = "sqlite"
+
+    def __init__(self, path, fsync=True):
+        """
+        Args:
+            path (str): Путь к файлу базы
+            fsync (bool): Дожидаться записи транзакции на диск (PRAGMA synchronous=FULL)
+        """
+        self.path = path
+        self.fsync = fsync
+        self._initialized_pid = None
+        self._init_lock = threading.Lock()
+
+    def _connect(self):
+        connection = get_connection(self.path)
+
+        pid = os.getpid()
+        if self._initialized_pid != pid:
+            with self._init_lock:
+                if self._initialized_pid != pid:
+                    self._create_schema(connection)
+                    self._initialized_pid = pid
+
+        return connection
+
+    def _create_schema(self, connection):
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS positions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT NOT NULL,
+                    sku INTEGER NOT NULL,
+                    query TEXT NOT NULL,
+                    organic_position INTEGER,
+                    promo_position INTEGER,
+                    price REAL,
+                    cpm REAL,
+                    ad_type TEXT,
+                    page INTEGER,
+                    position_on_page INTEGER,
+                    boost_cost REAL,
+                    dest TEXT NOT NULL
+                )
+            """)
+
+        self._migrate_dest(connection)
+
+        with connection:
+            # Уникальный индекс обслуживает выборки по товару, запросу и региону и защищает от повторного импорта
+            connection.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_positions_sku_query_dest_ts
+                ON positions (sku, query, dest, timestamp)
+            """)
+            connection.execute("DROP INDEX IF EXISTS idx_positions_sku_query_ts")
+            connection.execute("""
+                CREATE INDEX IF NOT EXISTS idx_positions_sku_ts
+                ON positions (sku, timestamp)
+            """)
+
+    @staticmethod
+    def _migrate_dest(connection):
+        # Базы, созданные до появления регионов, получают колонку dest; прежние записи
+        # относятся к региону по умолчанию. Проверка и изменение выполняются под
+        # блокировкой записи, поэтому миграцию выполняет один процесс
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if 'dest' not in table_columns(connection, "positions"):
+                default = str(config.DEFAULT_DEST).replace("'", "''")
+                connection.execute(f"ALTER TABLE positions ADD COLUMN dest TEXT NOT NULL DEFAULT '{default}'")
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def append(self, rows):
+        """
+        Добавляет записи в историю одной транзакцией
+
+        Записи с уже сохраненными (sku, query, dest, timestamp) пропускаются,
+        поэтому повторный импорт одних и тех же данных безопасен. Возвращаются
+        только действительно добавленные записи, чтобы агрегаты не учитывали
+        пропущенные повторы.
+
+        Args:
+            rows (list): Список записей (словарей с полями HISTORY_FIELDS)
+
+        Returns:
+            list: Добавленные записи
+        """
+        values = [
+            (
+                format_timestamp(row['timestamp']),
+                int(row['sku']),
+                row['query'],
+                _empty_value(row.get('organic_position')),
+                _empty_value(row.get('promo_position')),
+                _empty_value(row.get('price')),
+                _empty_value(row.get('cpm')),
+                _empty_value(row.get('ad_type')),
+                _empty_value(row.get('page')),
+                _empty_value(row.get('position_on_page')),
+                _empty_value(row.get('boost_cost')),
+                _dest(row)
+            )
+            for row in rows
+        ]
+
+        connection = self._connect()
+        # В режиме WAL synchronous=NORMAL переживает сбой процесса, FULL - и сбой питания
+        connection.execute(f"PRAGMA synchronous={'FULL' if self.fsync else 'NORMAL'}")
+        sql = (
+            f"INSERT OR IGNORE INTO positions ({', '.join(HISTORY_FIELDS)}) "
+            f"VALUES ({', '.join('?' * len(HISTORY_FIELDS))})"
+        )
+        added = []
+        with connection:
+            # По одной вставке в общей транзакции: rowcount каждой показывает, была ли запись пропущена
+            for row, value in zip(rows, values):
+                if connection.execute(sql, value).rowcount:
+                    added.append(row)
+        return added
+
+    def move_before(self, sku, cutoff, archive):
+        """
+        Переносит записи товара не новее cutoff в сжатые разделы
+
+        Записи переносятся по месяцам: каждый месяц записывается в раздел и
+        удаляется из базы в одной транзакции под блокировкой записи, поэтому
+        прерванный перенос не теряет и не дублирует записи.
+
+        Args:
+            sku (str): Артикул товара
+            cutoff (datetime): Граница переноса
+            archive (HistoryArchive): Разделы истории
+
+        Returns:
+            int: Количество перенесенных записей
+        """
+        import pandas as pd
+
+        from services.history_archive import next_month
+
+        connection = self._connect()
+        moved = 0
+
+        while True:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT MIN(timestamp) FROM positions WHERE sku = ? AND timestamp <= ?",
+                    (int(sku), format_timestamp(cutoff))
+                ).fetchone()
+                if row[0] is None:
+                    connection.execute("COMMIT")
+                    return moved
+
+                # Записи самого раннего месяца, не новее границы
+                month_end = next_month(datetime.fromisoformat(row[0]))
+                conditions = "sku = ? AND timestamp <= ? AND timestamp < ?"
+                params = (int(sku), format_timestamp(cutoff), format_timestamp(month_end))
+                df = pd.read_sql_query(
+                    f"SELECT {', '.join(HISTORY_FIELDS)} FROM positions WHERE {conditions} ORDER BY timestamp",
+                    connection, params=params, parse_dates={'timestamp': {'format': 'ISO8601'}}
+                )
+                archive.write(sku, df)
+                connection.execute(f"DELETE FROM positions WHERE {conditions}", params)
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+            moved += len(df)
+
+    def has_history(self, sku):
+        """
+        Проверяет, есть ли история позиций товара
+
+        Args:
+            sku (str): Артикул товара
+
+        Returns:
+            bool: True, если история есть
+        """
+        row = self._connect().execute(
+            "SELECT 1 FROM positions WHERE sku = ? LIMIT 1", (int(sku),)
+        ).fetchone()
+        return row is not None
+
+    def is_empty(self):
+        """
+        Returns:
+            bool: True, если в базе нет ни одной записи истории
+        """
+        return self._connect().execute("SELECT 1 FROM positions LIMIT 1").fetchone() is None
+
+    def list_skus(self):
+        """
+        Возвращает артикулы, для которых есть история
+
+        Returns:
+            list: Список артикулов
+        """
+        rows = self._connect().execute("SELECT DISTINCT sku FROM positions ORDER BY sku").fetchall()
+        return [str(row[0]) for row in rows]
+
+    def last_page(self, sku, query, dest=None):
+        """
+        Возвращает страницу выдачи, на которой товар был найден по запросу в последний раз
+
+        Args:
+            sku (str): Артикул товара
+            query (str): Поисковый запрос
+            dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+
+        Returns:
+            int: Номер страницы или None, если товар по запросу не находили
+        """
+        row = self._connect().execute(
+            "SELECT page FROM positions WHERE sku = ? AND query = ? AND dest = ? AND page IS NOT NULL "
+            "ORDER BY timestamp DESC LIMIT 1",
+            (int(sku), query, str(dest or config.DEFAULT_DEST))
+        ).fetchone()
+        return int(row[0]) if row else None
+
+    def query(self, sku, query=None, since=None, until=None, limit=None, dest=None):
+        """
+        Выбирает историю позиций товара, фильтруя по индексу в базе
+
+        Args:
+            sku (str): Артикул товара
+            query (str, optional): Поисковый запрос
+            since (datetime, optional): Нижняя граница времени (не включительно)
+            until (datetime, optional): Верхняя граница времени (включительно)
+            limit (int, optional): Максимальное количество записей
+            dest (str, optional): Регион выдачи (по умолчанию - все регионы)
+
+        Returns:
+            pandas.DataFrame: Записи истории в порядке времени
+        """
+        import pandas as pd
+
+        sql, params = self._select(sku, query, since, until, limit, dest)
+        return pd.read_sql_query(
+            sql, self._connect(), params=params, parse_dates={'timestamp': {'format': 'ISO8601'}}
+        )
+
+    def iter_query(self, sku, query=None, since=None, until=None, chunk_size=10000, dest=None):
+        """
+        Выбирает историю позиций товара частями по chunk_size записей
+
+        Записи читаются одним курсором порциями, поэтому память не зависит от объема истории.
+
+        Args:
+            sku (str): Артикул товара
+            query (str, optional): Поисковый запрос
+            since (datetime, optional): Нижняя граница времени (не включительно)
+            until (datetime, optional): Верхняя граница времени (включительно)
+            chunk_size (int): Количество записей в части
+            dest (str, optional): Регион выдачи (по умолчанию - все регионы)
+
+        Yields:
+            pandas.DataFrame: Очередная часть записей в порядке времени
+        """
+        import pandas as pd
+
+        sql, params = self._select(sku, query, since, until, dest=dest)
+        cursor = self._connect().execute(sql, params)
+
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+
+                chunk = pd.DataFrame.from_records(rows, columns=HISTORY_FIELDS)
+                chunk['timestamp'] = pd.to_datetime(chunk['timestamp'], format='ISO8601')
+                yield chunk
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _select(sku, query=None, since=None, until=None, limit=None, dest=None):
+        # Формирует запрос выборки истории и его параметры
+        conditions = ["sku = ?"]
+        params = [int(sku)]
+
+        if query:
+            conditions.append("query = ?")
+            params.append(query)
+        if dest:
+            conditions.append("dest = ?")
+            params.append(str(dest))
+        if since is not None:
+            conditions.append("timestamp > ?")
+            params.append(format_timestamp(since))
+        if until is not None:
+            conditions.append("timestamp <= ?")
+            params.append(format_timestamp(until))
+
+        sql = (
+            f"SELECT {', '.join(HISTORY_FIELDS)} FROM positions "
+            f"WHERE {' AND '.join(conditions)} ORDER BY timestamp"
+        )
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+
+        return sql, params
+
+
+def create_history_store(backend=None):
+    """
+    Создает хранилище истории заданного типа
+
+    Args:
+        backend (str, optional): "sqlite" или "csv" (по умолчанию config.HISTORY_BACKEND)
+
+    Returns:
+        ArchivedHistoryStore: Хранилище истории с чтением уплотненных разделов (services.history_archive)
+    """
+    from services.history_archive import ArchivedHistoryStore, HistoryArchive
+
+    backend = backend or config.HISTORY_BACKEND
+
+    if config.HISTORY_FSYNC not in ("flush", "off"):
+        raise ValueError(f"Неизвестная политика fsync истории: {config.HISTORY_FSYNC}")
+    fsync = config.HISTORY_FSYNC == "flush"
+
+    if backend == "sqlite":
+        from services.migrate_history import migrate_on_first_open
+
+        hot = SqliteHistoryStore(config.HISTORY_DB_PATH, fsync=fsync)
+        # История, накопленная в CSV до перехода на SQLite, переносится при первом открытии базы
+        migrate_on_first_open(hot, config.DATA_DIR)
+    elif backend == "csv":
+        hot = CsvHistoryStore(config.DATA_DIR, fsync=fsync)
+    else:
+        raise ValueError(f"Неизвестный тип хранилища истории: {backend}")
+
+    return ArchivedHistoryStore(hot, HistoryArchive(config.HISTORY_ARCHIVE_DIR, fsync=fsync))
+
+
+def get_history_store():
+    """
+    Возвращает хранилище истории процесса
+
+    Returns:
+        Хранилище истории, выбранное настройкой WB_HISTORY_BACKEND
+    """
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_history_store()
+
+    return _store
@@ -0,0 +1,280 @@
+# Отложенная запись истории позиций
+#
+# Найденные позиции не пишутся в хранилище на пути запроса: они попадают в
+# буфер процесса, а фоновый поток сбрасывает его пачками - при накоплении
+# WB_HISTORY_FLUSH_ROWS записей, раз в WB_HISTORY_FLUSH_INTERVAL секунд и
+# при завершении процесса. Сброс выполняется под блокировкой одним потоком,
+# поэтому записи разных сканирований не перемешиваются, а каждый файл истории
+# (CSV) или транзакция (SQLite) получает всю пачку сразу.
+#
+# Пачка проходит два этапа: запись в хранилище истории и обновление
+# агрегатов. Если этап завершился ошибкой, пачка остается в буфере и
+# повторяется со следующим сбросом, причем уже выполненный этап не
+# повторяется. Если хранилище записало пачку частично (CSV: файлы части
+# товаров), в буфер возвращаются только незаписанные записи. Настройка
+# WB_HISTORY_FSYNC определяет, дожидается ли сброс записи данных на диск.
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from services import config
+from services.history_store import HistoryAppendError, get_history_store
+from services.metrics import Counter, Gauge, Histogram
+from services.rollups import get_rollup_store
+
+logger = logging.getLogger(__name__)
+
+HISTORY_LATENCY = Histogram(
+    "wb_history_operation_duration_seconds",
+    "Длительность чтения и записи истории позиций",
+    ("operation",)
+)
+HISTORY_BUFFER_ROWS = Gauge(
+    "wb_history_buffer_rows",
+    "Записей истории в буфере отложенной записи"
+)
+HISTORY_DROPPED = Counter(
+    "wb_history_dropped_rows_total",
+    "Записей истории, отброшенных при переполнении буфера"
+)
+HISTORY_FLUSHES = Counter(
+    "wb_history_flushes_total",
+    "Сбросов буфера истории позиций по результату",
+    ("result",)
+)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+class HistoryWriter:
+    """Буфер записей истории с фоновым сбросом в хранилище и агрегаты"""
+
+    def __init__(self, history_store, rollup_store, flush_rows, flush_interval, max_rows):
+        """
+        Args:
+            history_store: Хранилище истории
+            rollup_store (RollupStore): Хранилище агрегатов
+            flush_rows (int): Записей в буфере, при которых сброс начинается сразу
+            flush_interval (float): Максимальное время хранения записи в буфере, секунды
+            max_rows (int): Предельный размер буфера; при переполнении отбрасываются самые старые записи
+        """
+        self.history_store = history_store
+        self.rollup_store = rollup_store
+        self.flush_rows = max(1, flush_rows)
+        self.flush_interval = flush_interval
+        self.max_rows = max(self.flush_rows, max_rows)
+
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        # Записи, ожидающие записи в историю, и пачки, ожидающие обновления агрегатов
+        self._pending = deque()
+        self._rollup_pending = deque()
+        self._pid = None
+        self._thread = None
+        self._closed = False
+        self._stats = {"buffered": 0, "written": 0, "dropped": 0, "flushes": 0, "errors": 0, "last_error": None}
+
+    def add(self, rows):
+        """
+        Помещает записи в буфер и возвращается, не дожидаясь записи на диск
+
+        Args:
+            rows (list): Записи истории (словари с полями history_store.HISTORY_FIELDS)
+        """
+        if not rows:
+            return
+
+        with self._condition:
+            self._ensure_thread()
+            self._pending.extend(rows)
+            self._stats["buffered"] += len(rows)
+
+            overflow = len(self._pending) - self.max_rows
+            if overflow > 0:
+                for _ in range(overflow):
+                    self._pending.popleft()
+                self._stats["dropped"] += overflow
+                HISTORY_DROPPED.inc(overflow)
+                logger.error("Буфер истории позиций переполнен, отброшено записей: %s", overflow)
+
+            HISTORY_BUFFER_ROWS.set(len(self._pending))
+
+            if len(self._pending) >= self.flush_rows:
+                self._condition.notify()
+
+    def flush(self):
+        """
+        Записывает накопленные записи в хранилище истории и агрегаты
+
+        Returns:
+            int: Количество записей, переданных в хранилище истории
+
+        Raises:
+            Exception: Если запись в хранилище или агрегаты не удалась (записи остаются в буфере)
+        """
+        with self._flush_lock:
+            with self._condition:
+                rows = list(self._pending)
+                self._pending.clear()
+                HISTORY_BUFFER_ROWS.set(0)
+
+            error = None
+            written = rows
+            if rows:
+                try:
+                    with HISTORY_LATENCY.time(operation="write"):
+                        added = self.history_store.append(rows)
+                except HistoryAppendError as e:
+                    # Часть товаров записана - в буфер возвращаются только остальные записи
+                    error, written, unwritten, added = e, e.written, e.unwritten, e.written
+                except Exception as e:
+                    error, written, unwritten, added = e, [], rows, []
+
+                if error is not None:
+                    with self._condition:
+                        self._pending.extendleft(reversed(unwritten))
+                        HISTORY_BUFFER_ROWS.set(len(self._pending))
+
+                self._stats["written"] += len(written)
+                # Агрегаты учитывают только добавленные записи: повторы, пропущенные
+                # хранилищем (SQLite), не должны увеличивать количество и суммы
+                if added:
+                    self._rollup_pending.append(added)
+
+            try:
+                while self._rollup_pending:
+                    with HISTORY_LATENCY.time(operation="rollup_write"):
+                        self.rollup_store.add(self._rollup_pending[0])
+                    self._rollup_pending.popleft()
+            except Exception as e:
+                error = error or e
+
+            if error is not None:
+                self._stats["errors"] += 1
+                self._stats["last_error"] = str(error)
+                HISTORY_FLUSHES.inc(result="error")
+                raise Exception(f"Ошибка при сбросе буфера истории позиций: {str(error)}")
+
+            self._stats["flushes"] += 1
+            HISTORY_FLUSHES.inc(result="ok")
+
+            return len(written)
+
+    def close(self):
+        """Останавливает фоновый поток и сбрасывает оставшиеся записи"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=self.flush_interval + 5)
+
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(str(e))
+
+    def has_pending(self):
+        """
+        Returns:
+            bool: True, если в буфере есть записи, не записанные в историю или агрегаты
+        """
+        with self._condition:
+            return bool(self._pending or self._rollup_pending)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Счетчики буфера и размер очереди
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+        stats["rollup_pending"] = len(self._rollup_pending)
+        stats["flush_rows"] = self.flush_rows
+        stats["flush_interval"] = self.flush_interval
+        stats["fsync"] = config.HISTORY_FSYNC
+        return stats
+
+    def _ensure_thread(self):
+        # Вызывается под self._condition. После fork буфер и поток родителя не наследуются
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pending.clear()
+            self._rollup_pending.clear()
+            HISTORY_BUFFER_ROWS.set(0)
+            self._thread = None
+            self._closed = False
+            self._pid = pid
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="wb-history-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and len(self._pending) < self.flush_rows:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                closed = self._closed
+
+            if self.has_pending():
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(str(e))
+                    if not closed:
+                        # Повтор после паузы, а не в плотном цикле
+                        time.sleep(self.flush_interval)
+
+            if closed:
+                return
+
+
+def get_history_writer():
+    """
+    Возвращает буфер записи истории процесса (сбрасывается при завершении процесса)
+
+    Returns:
+        HistoryWriter: Буфер записи истории
+    """
+    global _writer
+
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = HistoryWriter(
+                    get_history_store(),
+                    get_rollup_store(),
+                    config.HISTORY_FLUSH_ROWS,
+                    config.HISTORY_FLUSH_INTERVAL,
+                    config.HISTORY_BUFFER_MAX_ROWS
+                )
+                atexit.register(_writer.close)
+
+    return _writer
+
+
+def flush_history():
+    """
+    Сбрасывает буфер истории, если он создан и не пуст
+
+    Вызывается перед чтением истории, чтобы ответ включал только что найденные позиции.
+    Ошибка сброса (заполненный диск, занятая база) не прерывает чтение: она
+    записывается в журнал, записи остаются в буфере, а ответ строится по уже
+    сохраненной истории. Ошибку сброса пробрасывают только HistoryWriter.flush и close.
+    """
+    if _writer is not None and _writer.has_pending():
+        try:
+            _writer.flush()
+        except Exception as e:
+            logger.error(str(e))
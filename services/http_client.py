@@ -0,0 +1,237 @@
+# Общий HTTP-клиент для запросов к API Wildberries
+# Держит постоянные keep-alive сессии (отдельную на каждый поток процесса)
+# и согласует частоту запросов к каждому хосту с ограничителем rate_limiter
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from services import config
+from services.metrics import Histogram, register_collector
+from services.rate_limiter import THROTTLE_STATUSES, RateLimitExceeded, get_rate_limiter, parse_retry_after
+
+# Заголовки, общие для всех запросов к Wildberries
+DEFAULT_HEADERS = {
+    "Accept": "*/*",
+    "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "Origin": "https://www.wildberries.ru",
+    "Pragma": "no-cache",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
+}
+
+UPSTREAM_LATENCY = Histogram(
+    "wb_upstream_request_duration_seconds",
+    "Длительность запросов к API Wildberries",
+    ("host", "status")
+)
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {
+    "sessions_created": 0,
+    "requests": 0,
+    "connections_created": 0,
+    "errors": 0,
+    "retries": 0
+}
+
+
+def _count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    """Пул соединений, учитывающий открытие новых TCP-соединений"""
+
+    def _new_conn(self):
+        _count("connections_created")
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    """Пул TLS-соединений, учитывающий открытие новых соединений"""
+
+    def _new_conn(self):
+        _count("connections_created")
+        return super()._new_conn()
+
+
+class _PooledAdapter(HTTPAdapter):
+    """HTTP-адаптер с учетом новых соединений в статистике клиента"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool
+        }
+
+
+def _build_retry():
+    """
+    Создает политику повторов при сетевых ошибках для идемпотентных запросов
+
+    Повторы при ответах 429/5xx выполняет http_get: каждый повтор должен
+    получить токен ограничителя и сообщить ему статус ответа.
+
+    Returns:
+        Retry: Политика повторов urllib3
+    """
+    return Retry(
+        total=config.HTTP_RETRIES,
+        connect=config.HTTP_RETRIES,
+        read=config.HTTP_RETRIES,
+        status=0,
+        backoff_factor=config.HTTP_BACKOFF_FACTOR,
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False
+    )
+
+
+def _create_session():
+    """
+    Создает сессию с пулом соединений, повторами и заголовками по умолчанию
+
+    Returns:
+        requests.Session: Новая сессия
+    """
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+
+    adapter = _PooledAdapter(
+        pool_connections=config.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=config.HTTP_POOL_MAXSIZE,
+        max_retries=_build_retry()
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    _count("sessions_created")
+    return session
+
+
+def get_session():
+    """
+    Возвращает постоянную сессию текущего потока
+
+    Сессия пересоздается после fork (например, в воркерах gunicorn с --preload),
+    чтобы процессы не делили открытые сокеты.
+
+    Returns:
+        requests.Session: Сессия текущего потока
+    """
+    pid = os.getpid()
+    session = getattr(_local, "session", None)
+
+    if session is None or getattr(_local, "pid", None) != pid:
+        session = _create_session()
+        _local.session = session
+        _local.pid = pid
+
+    return session
+
+
+def http_get(url, params=None, headers=None, timeout=None):
+    """
+    Выполняет GET-запрос через постоянную сессию текущего потока
+
+    Перед каждой попыткой запрос ждет токен ограничителя частоты хоста.
+    При ответах 429/5xx выполняется до config.HTTP_RETRIES повторов
+    с экспоненциальной задержкой; Retry-After учитывает ограничитель.
+
+    Args:
+        url (str): Адрес запроса
+        params (dict, optional): Параметры строки запроса
+        headers (dict, optional): Дополнительные заголовки запроса
+        timeout (float, optional): Таймаут в секундах (по умолчанию config.HTTP_TIMEOUT)
+
+    Returns:
+        requests.Response: Ответ сервера
+
+    Raises:
+        RateLimitExceeded: Если хост отвечает 429 после всех повторов или токена пришлось бы ждать слишком долго
+    """
+    host = urlsplit(url).hostname
+    limiter = get_rate_limiter()
+    attempt = 0
+
+    while True:
+        started_at = limiter.acquire(host)
+
+        _count("requests")
+        started = time.perf_counter()
+        try:
+            response = get_session().get(
+                url,
+                params=params,
+                headers=headers,
+                timeout=config.HTTP_TIMEOUT if timeout is None else timeout
+            )
+        except requests.exceptions.RequestException:
+            _count("errors")
+            UPSTREAM_LATENCY.observe(time.perf_counter() - started, host=host, status="error")
+            raise
+        UPSTREAM_LATENCY.observe(time.perf_counter() - started, host=host, status=response.status_code)
+
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        limiter.record(host, response.status_code, started_at, retry_after)
+
+        if response.status_code not in THROTTLE_STATUSES:
+            return response
+
+        if attempt >= config.HTTP_RETRIES:
+            if response.status_code == 429:
+                raise RateLimitExceeded(host, retry_after or limiter.retry_after(host))
+            return response
+
+        attempt += 1
+        _count("retries")
+        response.close()
+
+        # При Retry-After паузу выдерживает ограничитель
+        if not retry_after:
+            time.sleep(config.HTTP_BACKOFF_FACTOR * (2 ** (attempt - 1)))
+
+
+def get_http_stats():
+    """
+    Возвращает статистику HTTP-клиента
+
+    Returns:
+        dict: Счетчики сессий, запросов и соединений и состояние ограничителя частоты по хостам
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+
+    reused = max(stats["requests"] - stats["connections_created"], 0)
+    stats["connections_reused"] = reused
+    stats["reuse_ratio"] = round(reused / stats["requests"], 4) if stats["requests"] else None
+    stats["rate_limits"] = get_rate_limiter().stats()
+    return stats
+
+
+def _collect_http_metrics():
+    with _stats_lock:
+        stats = dict(_stats)
+    limits = get_rate_limiter().stats()
+
+    return [
+        ("wb_http_connections_created_total", "counter", "Открытых TCP-соединений к API",
+         [({}, stats["connections_created"])]),
+        ("wb_http_retries_total", "counter", "Повторов запросов после 429/5xx", [({}, stats["retries"])]),
+        ("wb_rate_limit_rate", "gauge", "Текущая допустимая скорость запросов к хосту, запросов в секунду",
+         [({"host": host}, item["rate"]) for host, item in sorted(limits.items())]),
+        ("wb_rate_limit_blocked_seconds", "gauge", "Оставшаяся пауза хоста по Retry-After",
+         [({"host": host}, item["blocked_for"]) for host, item in sorted(limits.items())])
+    ]
+
+
+register_collector(_collect_http_metrics)
@@ -0,0 +1,238 @@
+# Метрики сервиса в текстовом формате Prometheus
+#
+# Счетчики, значения и гистограммы регистрируются при создании и
+# отдаются маршрутом /metrics. Значения, которые модули уже считают сами
+# (статистика кэшей, планировщика, ограничителя частоты), добавляются
+# функциями-сборщиками в момент запроса метрик.
+#
+# Метрики ведутся в памяти процесса: при нескольких воркерах gunicorn
+# каждый отдает свои значения.
+import threading
+import time
+from contextlib import contextmanager
+
+# Границы гистограмм длительности по умолчанию, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry_lock = threading.Lock()
+_metrics = {}
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Метрика с набором меток"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        Args:
+            name (str): Имя метрики
+            documentation (str): Описание метрики
+            labels (tuple): Имена меток
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+        with _registry_lock:
+            if name in _metrics:
+                raise ValueError(f"Метрика {name} уже зарегистрирована")
+            _metrics[name] = self
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Метрика {self.name} ожидает метки: {', '.join(self.labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _samples(self):
+        # Одно значение на набор меток; метрики со сложным состоянием (Histogram) переопределяют
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.labels:
+            # Метрика без меток отдается с нулем еще до первого изменения
+            values = [((), 0)]
+        return [("", list(zip(self.labels, key)), value) for key, value in values]
+
+    def render(self):
+        """
+        Returns:
+            list: Строки метрики в текстовом формате Prometheus
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик; имя по соглашению Prometheus оканчивается на _total"""
+
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        """
+        Увеличивает счетчик
+
+        Args:
+            value (float): Прирост
+            **labels: Значения меток
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    """Текущее значение"""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        """
+        Устанавливает значение
+
+        Args:
+            value (float): Значение
+            **labels: Значения меток
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Распределение значений по интервалам"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            name (str): Имя метрики
+            documentation (str): Описание метрики
+            labels (tuple): Имена меток
+            buckets (tuple): Верхние границы интервалов по возрастанию
+        """
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """
+        Учитывает значение
+
+        Args:
+            value (float): Значение
+            **labels: Значения меток
+        """
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Счетчики интервалов, сумма и количество значений
+                state = [[0] * len(self.buckets), 0.0, 0]
+                self._values[key] = state
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Учитывает длительность выполнения блока в секундах
+
+        Args:
+            **labels: Значения меток
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, [list(state[0]), state[1], state[2]]) for key, state in self._values.items())
+
+        samples = []
+        for key, (counts, total, count) in values:
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", labels + [("le", _format_value(float(bound)))], cumulative))
+            samples.append(("_bucket", labels + [("le", "+Inf")], count))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+def register_collector(collector):
+    """
+    Регистрирует функцию, формирующую метрики в момент запроса
+
+    Функция возвращает список кортежей (имя, тип, описание, значения), где
+    значения - список пар (словарь меток, число).
+
+    Args:
+        collector (callable): Функция-сборщик
+    """
+    with _registry_lock:
+        _collectors.append(collector)
+
+
+def render_metrics():
+    """
+    Формирует все метрики процесса в текстовом формате Prometheus
+
+    Returns:
+        str: Текст метрик
+    """
+    with _registry_lock:
+        metrics = list(_metrics.values())
+        collectors = list(_collectors)
+
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+
+    for collector in collectors:
+        try:
+            families = collector()
+        except Exception as e:
+            lines.append(f"# Ошибка сборщика {getattr(collector, '__name__', collector)}: {_escape(e)}")
+            continue
+
+        for name, kind, documentation, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+
+    return "\n".join(lines) + "\n"
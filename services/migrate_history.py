@@ -0,0 +1,182 @@
+# Импорт истории позиций из CSV-файлов data/positions_{sku}.csv в SQLite
+#
+# Запуск:
+#   python -m services.migrate_history [--data-dir data] [--db data/history.sqlite3]
+#
+# Повторный запуск безопасен: уже импортированные записи пропускаются.
+#
+# Хранилище SQLite выполняет импорт само при первом открытии пустой базы,
+# если в WB_DATA_DIR есть CSV-файлы истории (migrate_on_first_open), поэтому
+# переход с бэкенда csv на sqlite не скрывает накопленную историю.
+import argparse
+import csv
+import glob
+import logging
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка файлов недоступна
+    fcntl = None
+
+from services import config
+from services.history_store import HISTORY_FIELDS, SqliteHistoryStore
+
+logger = logging.getLogger(__name__)
+
+# Количество записей, вставляемых одной транзакцией
+BATCH_SIZE = 5000
+
+# Отметка автоматического импорта рядом с файлом базы: "started" или "done"
+IMPORT_MARKER_SUFFIX = ".csv-import"
+
+
+def migrate_csv_file(filename, store, batch_size=BATCH_SIZE):
+    """
+    Импортирует один CSV-файл истории в хранилище
+
+    Args:
+        filename (str): Путь к CSV-файлу
+        store (SqliteHistoryStore): Хранилище, в которое выполняется импорт
+        batch_size (int): Количество записей в одной транзакции
+
+    Returns:
+        tuple: Кортеж (прочитано записей, добавлено записей)
+    """
+    read = 0
+    inserted = 0
+    batch = []
+
+    with open(filename, newline='', encoding='utf-8') as csvfile:
+        for row in csv.DictReader(csvfile):
+            read += 1
+            batch.append({field: row.get(field) for field in HISTORY_FIELDS})
+
+            if len(batch) >= batch_size:
+                inserted += len(store.append(batch))
+                batch = []
+
+    if batch:
+        inserted += len(store.append(batch))
+
+    return read, inserted
+
+
+def migrate_csv_history(data_dir, db_path):
+    """
+    Импортирует все CSV-файлы истории из директории в SQLite
+
+    Args:
+        data_dir (str): Директория с файлами positions_{sku}.csv
+        db_path (str): Путь к файлу базы SQLite
+
+    Returns:
+        dict: Статистика импорта по файлам
+    """
+    store = SqliteHistoryStore(db_path)
+    report = {}
+
+    for filename in sorted(glob.glob(os.path.join(data_dir, "positions_*.csv"))):
+        read, inserted = migrate_csv_file(filename, store)
+        report[os.path.basename(filename)] = {"read": read, "inserted": inserted}
+
+    return report
+
+
+def migrate_on_first_open(store, data_dir):
+    """
+    Импортирует CSV-историю в базу SQLite, если база открывается впервые
+
+    Импорт выполняется, когда база пуста, а в data_dir есть файлы
+    positions_{sku}.csv, и продолжается после перезапуска, если был прерван.
+    После импорта пересчитываются агрегаты импортированных товаров. Процессы,
+    открывающие базу одновременно, ждут завершения импорта под блокировкой файла.
+
+    Args:
+        store (SqliteHistoryStore): Хранилище истории
+        data_dir (str): Директория с CSV-файлами истории
+
+    Returns:
+        dict: Статистика импорта по файлам или None, если импорт не требовался
+    """
+    marker = store.path + IMPORT_MARKER_SUFFIX
+
+    if _read_marker(marker) == "done":
+        return None
+
+    filenames = sorted(glob.glob(os.path.join(data_dir, "positions_*.csv")))
+    if not filenames:
+        return None
+
+    # Каталог базы может еще не существовать: SQLite создаст его только при первом подключении
+    directory = os.path.dirname(store.path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(marker + ".lock", 'a') as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+
+        state = _read_marker(marker)
+        if state == "done" or (state is None and not store.is_empty()):
+            return None
+
+        logger.info(f"Импорт истории позиций из CSV в {store.path}: файлов {len(filenames)}")
+        try:
+            _write_marker(marker, "started")
+
+            report = {}
+            for filename in filenames:
+                read, inserted = migrate_csv_file(filename, store)
+                report[os.path.basename(filename)] = {"read": read, "inserted": inserted}
+
+            from services.rollups import rebuild_rollups
+
+            skus = [name[len("positions_"):-len(".csv")] for name in report]
+            rebuild_rollups(store, skus)
+
+            _write_marker(marker, "done")
+        except Exception as e:
+            raise Exception(f"Ошибка при импорте истории позиций из CSV: {str(e)}")
+
+    logger.info(f"История позиций импортирована из CSV, добавлено записей: "
+                f"{sum(stats['inserted'] for stats in report.values())}")
+    return report
+
+
+def _read_marker(marker):
+    try:
+        with open(marker, encoding='utf-8') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _write_marker(marker, state):
+    with open(marker + ".tmp", 'w', encoding='utf-8') as f:
+        f.write(state)
+    os.replace(marker + ".tmp", marker)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Импорт истории позиций из CSV в SQLite")
+    parser.add_argument("--data-dir", default=config.DATA_DIR, help="Директория с CSV-файлами истории")
+    parser.add_argument("--db", default=config.HISTORY_DB_PATH, help="Путь к файлу базы SQLite")
+    args = parser.parse_args()
+
+    report = migrate_csv_history(args.data_dir, args.db)
+
+    if not report:
+        print(f"CSV-файлы истории не найдены в {args.data_dir}")
+        return
+
+    for name, stats in report.items():
+        print(f"{name}: прочитано {stats['read']}, добавлено {stats['inserted']}")
+
+    total_read = sum(stats["read"] for stats in report.values())
+    total_inserted = sum(stats["inserted"] for stats in report.values())
+    print(f"Итого: файлов {len(report)}, прочитано {total_read}, добавлено {total_inserted}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,278 @@
-import requests
 import json
-import csv
-import os
-import pandas as pd
+import logging
 import uuid
 from datetime import datetime, timedelta
-import threading
-import schedule
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-# Словарь активных задач отслеживания
-tracking_jobs = {}
+from services import config
+from services.cache import TTLCache
+from services.history_store import HISTORY_FIELDS, get_history_store
+from services.history_writer import HISTORY_LATENCY, flush_history, get_history_writer
+from services.http_client import http_get
+from services.metrics import Counter, Histogram
+from services.product_service import normalize_dest
+from services.rate_limiter import RateLimitExceeded
+from services.serp import SerpPage, compact_search_page, parse_search_page
+from services.rollups import get_rollup_store
+from services.snapshot_store import get_snapshot_store
+from services.tracker import get_tracker, notify_tracker
+from services.tracking_events import get_event_broadcaster
+from services.tracking_store import get_tracking_store
 
-def search_wildberries(query, page=1):
+logger = logging.getLogger(__name__)
+
+# Кэш страниц поисковой выдачи, общий для всех запросов процесса
+search_cache = TTLCache("search", config.SEARCH_CACHE_TTL, config.SEARCH_CACHE_MAX_ENTRIES)
+
+# Режимы обхода страниц выдачи
+SCAN_MODES = ("sequential", "parallel")
+
+# Порядок обхода страниц: подряд с первой или от страницы, где товар был найден в последний раз
+SCAN_STRATEGIES = ("linear", "guided")
+
+# Метрики обхода выдачи
+SCAN_PAGES = Histogram(
+    "wb_position_scan_pages",
+    "Страниц выдачи, просмотренных за один поиск позиции (single) или пакетный поиск (batch)",
+    ("kind",),
+    buckets=(1, 2, 3, 5, 10, 20, 30, 50, 100)
+)
+SCAN_PAGES_BY_STRATEGY = Counter(
+    "wb_position_scan_pages_total",
+    "Страниц выдачи, запрошенных при поиске позиций, по стратегии обхода",
+    ("strategy",)
+)
+
+# Общий пул потоков для параллельного обхода страниц; ограничивает число одновременных запросов
+_scan_executor = ThreadPoolExecutor(max_workers=config.SCAN_MAX_WORKERS, thread_name_prefix="wb-scan")
+
+# Общий пул потоков для одновременного обхода выдачи в нескольких регионах. Пул отдельный:
+# обход региона в режиме "parallel" сам ставит задачи в _scan_executor и ждет их
+_region_executor = ThreadPoolExecutor(max_workers=config.REGION_MAX_WORKERS, thread_name_prefix="wb-region")
+
+def normalize_query(query):
+    """
+    Приводит поисковый запрос к каноническому виду для ключа кэша
+    
+    Args:
+        query (str): Поисковый запрос
+        
+    Returns:
+        str: Запрос в нижнем регистре без лишних пробелов
+    """
+    return " ".join(query.split()).lower()
+
+def normalize_regions(regions):
+    """
+    Проверяет список регионов выдачи
+    
+    Args:
+        regions (list or str, optional): Регионы списком или строкой через запятую
+            (по умолчанию - только config.DEFAULT_DEST)
+        
+    Returns:
+        list: Регионы без повторов в исходном порядке
+    """
+    if regions is None:
+        return [normalize_dest(None)]
+    
+    if isinstance(regions, str):
+        regions = regions.split(",")
+    
+    if not isinstance(regions, (list, tuple)):
+        raise ValueError("Регионы должны быть списком")
+    
+    result = []
+    for dest in regions:
+        if str(dest).strip() == "":
+            continue
+        dest = normalize_dest(dest)
+        if dest not in result:
+            result.append(dest)
+    
+    if not result:
+        raise ValueError("Список регионов не может быть пустым")
+    
+    if len(result) > config.MAX_REGIONS:
+        raise ValueError(f"Можно указать не более {config.MAX_REGIONS} регионов")
+    
+    return result
+
+def search_wildberries(query, page=1, dest=None, sort=None):
     """
     Выполняет поисковый запрос к API Wildberries
     
+    Одинаковые страницы выдачи кэшируются на config.SEARCH_CACHE_TTL секунд,
+    а конкурентные запросы одной страницы ждут один общий запрос к API.
+    
     Args:
         query (str): Поисковый запрос
         page (int): Номер страницы (по умолчанию 1)
+        dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+        sort (str, optional): Сортировка выдачи (по умолчанию config.DEFAULT_SORT)
+        
+    Returns:
+        SerpPage: Компактная страница выдачи
+    """
+    dest = str(dest or config.DEFAULT_DEST)
+    sort = sort or config.DEFAULT_SORT
+    key = (normalize_query(query), int(page), dest, sort)
+    
+    return search_cache.get_or_load(key, lambda: _fetch_search_page(query, page, dest, sort))
+
+def _fetch_search_page(query, page, dest, sort):
+    """
+    Запрашивает страницу поисковой выдачи у API Wildberries без кэша
+    
+    Args:
+        query (str): Поисковый запрос
+        page (int): Номер страницы
+        dest (str): Регион выдачи
+        sort (str): Сортировка выдачи
         
     Returns:
-        dict: Результаты поиска в формате JSON
+        SerpPage: Компактная страница выдачи (только артикулы и поля для расчета позиции)
     """
-    url = f"https://search.wb.ru/exactmatch/ru/common/v13/search"
+    url = config.SEARCH_API_URL
     params = {
         "ab_old_spell": "oct",
         "appType": "64",
         "curr": "rub",
-        "dest": "-1257786",
+        "dest": dest,
         "hide_dtype": "13",
         "lang": "ru",
         "locale": "ru",
         "page": page,
         "query": query,
         "resultset": "catalog",
-        "sort": "popular"
+        "sort": sort
     }
     
+    # Общие заголовки задаются в сессии http_client
     headers = {
-        "Accept": "*/*",
-        "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
-        "Cache-Control": "no-cache",
-        "Origin": "https://www.wildberries.ru",
-        "Pragma": "no-cache",
-        "Referer": "https://www.wildberries.ru/catalog/0/search.aspx",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
+        "Referer": "https://www.wildberries.ru/catalog/0/search.aspx"
     }
     
     try:
-        response = requests.get(url, params=params, headers=headers, timeout=10)
+        response = http_get(url, params=params, headers=headers)
         response.raise_for_status()
-        return response.json()
+        serp = parse_search_page(response.content)
+    except RateLimitExceeded:
+        raise
     except Exception as e:
         raise Exception(f"Ошибка при запросе к API поиска: {str(e)}")
+    
+    _save_snapshot(query, page, dest, sort, serp)
+    return serp
+
+def _save_snapshot(query, page, dest, sort, serp):
+    """
+    Сохраняет снимок загруженной страницы выдачи
+    
+    Ошибка записи снимка не прерывает поиск позиции.
+    
+    Args:
+        query (str): Поисковый запрос
+        page (int): Номер страницы
+        dest (str): Регион выдачи
+        sort (str): Сортировка выдачи
+        serp (SerpPage): Страница выдачи
+    """
+    if not config.SNAPSHOTS_ENABLED:
+        return
+    
+    try:
+        get_snapshot_store().add(normalize_query(query), dest, sort, page, serp)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить снимок выдачи '{query}', страница {page}: {str(e)}")
+
+def get_position_at(sku, query, at=None, dest=None, sort=None, max_age=None):
+    """
+    Определяет позицию товара в выдаче на момент времени по сохраненным снимкам
+    
+    Для каждой страницы берется последний снимок не позже at и не старше max_age;
+    запросы к API не выполняются. Снимки есть только для страниц, загруженных
+    при сканировании, поэтому товар ниже последней просмотренной страницы не найдется.
+    
+    Args:
+        sku (str): Артикул товара (любого, не только отслеживаемого)
+        query (str): Поисковый запрос
+        at (str, optional): Момент времени в формате ISO 8601 (по умолчанию текущий)
+        dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+        sort (str, optional): Сортировка выдачи (по умолчанию config.DEFAULT_SORT)
+        max_age (float, optional): Максимальный возраст снимка в секундах (по умолчанию config.SNAPSHOT_MAX_AGE)
+        
+    Returns:
+        dict: Позиция товара и время снимка или found=False и список страниц, по которым есть снимки
+    """
+    try:
+        sku = int(sku)
+    except (TypeError, ValueError):
+        raise ValueError("Артикул должен быть числом")
+    
+    if not query or not query.strip():
+        raise ValueError("Поисковый запрос не может быть пустым")
+    
+    if at:
+        try:
+            moment = datetime.fromisoformat(at)
+        except ValueError:
+            raise ValueError("Параметр at должен быть временем в формате ISO 8601")
+    else:
+        moment = datetime.now()
+    
+    dest = str(dest or config.DEFAULT_DEST)
+    sort = sort or config.DEFAULT_SORT
+    max_age = config.SNAPSHOT_MAX_AGE if max_age is None else max_age
+    
+    pages = get_snapshot_store().latest_pages(normalize_query(query), dest, sort, moment.timestamp(), max_age)
+    
+    result = {
+        "query": query,
+        "sku": str(sku),
+        "at": moment.isoformat(),
+        "found": False,
+        "pages_available": [snapshot["page"] for snapshot in pages]
+    }
+    
+    for snapshot in pages:
+        try:
+            index = snapshot["ids"].index(sku)
+        except ValueError:
+            continue
+        
+        page = snapshot["page"]
+        result.update({
+            "found": True,
+            "page": page,
+            "position_on_page": index + 1,
+            "global_position": (page - 1) * 100 + index + 1,
+            "is_advertised": any(snapshot[column][index] > 0 for column in ("organic", "promo", "cpm")),
+            "organic_position": snapshot["organic"][index] or None,
+            "promo_position": snapshot["promo"][index] or None,
+            "cpm": snapshot["cpm"][index] or None,
+            "snapshot_at": datetime.fromtimestamp(snapshot["fetched_at"]).isoformat()
+        })
+        break
+    
+    return result
 
 def find_product_by_sku(data, target_sku):
     """
     Ищет товар с заданным SKU в данных
     
     Args:
-        data (dict): Данные поисковой выдачи
+        data (SerpPage or dict): Страница выдачи или ответ API поиска
         target_sku (str): Искомый артикул товара
         
     Returns:
         tuple: Кортеж (товар, позиция) или (None, 0) если товар не найден
     """
+    if isinstance(data, SerpPage):
+        position = data.position(target_sku)
+        return (data.product(position), position) if position else (None, 0)
+    
     if not data or 'data' not in data or 'products' not in data['data']:
         return None, 0
     
@@ -78,7 +285,34 @@ def find_product_by_sku(data, target_sku):
     
     return None, 0
 
-def search_product_position(query, target_sku, max_pages=10):
+def build_sku_index(data):
+    """
+    Строит индекс товаров страницы выдачи по артикулу
+    
+    Args:
+        data (SerpPage or dict): Страница выдачи или ответ API поиска
+        
+    Returns:
+        dict: Словарь артикул -> (товар, позиция на странице); при повторах учитывается первое вхождение
+    """
+    if isinstance(data, SerpPage):
+        index = {}
+        for position, product_id in enumerate(data.ids, start=1):
+            index.setdefault(str(product_id), (data.product(position), position))
+        return index
+    
+    if not data or 'data' not in data or 'products' not in data['data']:
+        return {}
+    
+    index = {}
+    
+    for position, product in enumerate(data['data']['products'], start=1):
+        index.setdefault(str(product.get('id', '')), (product, position))
+    
+    return index
+
+def search_product_position(query, target_sku, max_pages=10, mode="sequential", window=None, deadline=None,
+                            strategy="linear", dest=None):
     """
     Ищет позицию товара с заданным SKU в поисковой выдаче
     
@@ -86,6 +320,12 @@ def search_product_position(query, target_sku, max_pages=10):
         query (str): Поисковый запрос
         target_sku (str): Артикул товара
         max_pages (int): Максимальное количество страниц для поиска
+        mode (str): Режим обхода страниц: "sequential" (по одной) или "parallel" (окнами)
+        window (int, optional): Количество страниц, запрашиваемых одновременно в режиме "parallel"
+        deadline (float, optional): Момент time.monotonic(), после которого поиск прерывается с TimeoutError
+        strategy (str): Порядок обхода: "linear" (с первой страницы) или "guided"
+            (от страницы, на которой товар был найден в последний раз, см. guided_page_order)
+        dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
         
     Returns:
         dict: Результат поиска с информацией о позиции товара
@@ -99,97 +339,549 @@ def search_product_position(query, target_sku, max_pages=10):
     if not query or not query.strip():
         raise ValueError("Поисковый запрос не может быть пустым")
     
+    if mode not in SCAN_MODES:
+        raise ValueError(f"Режим поиска должен быть одним из: {', '.join(SCAN_MODES)}")
+    
+    dest = normalize_dest(dest)
+    page_order = _scan_page_order(query, [target_sku], max_pages, strategy, dest)
+    
     result = {
         "query": query,
         "sku": target_sku,
+        "dest": dest,
         "found": False,
         "timestamp": datetime.now().isoformat()
     }
     
-    for page in range(1, max_pages + 1):
-        search_data = search_wildberries(query, page)
+    found, pages_scanned = _scan_positions(query, [target_sku], page_order, mode, window, deadline, dest,
+                                           kind="single", strategy=strategy)
+    result["pages_scanned"] = pages_scanned
+    
+    if target_sku in found:
+        _fill_position_result(result, *found[target_sku])
+        _save_position_result(result)
+    
+    return result
+
+def search_products_positions(query, target_skus, max_pages=10, mode="sequential", window=None, deadline=None,
+                              strategy="linear", dest=None):
+    """
+    Ищет позиции нескольких товаров за один обход поисковой выдачи
+    
+    Каждая страница запрашивается один раз; для нее строится индекс
+    артикул -> позиция, по которому проверяются все еще не найденные товары.
+    Обход прекращается, когда найдены все товары или просмотрены все max_pages страниц.
+    
+    Args:
+        query (str): Поисковый запрос
+        target_skus (list): Список артикулов товаров
+        max_pages (int): Максимальное количество страниц для поиска
+        mode (str): Режим обхода страниц: "sequential" или "parallel"
+        window (int, optional): Количество страниц в окне для режима "parallel"
+        deadline (float, optional): Момент time.monotonic(), после которого поиск прерывается с TimeoutError
+        strategy (str): Порядок обхода: "linear" или "guided" (от последних известных страниц товаров)
+        dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+        
+    Returns:
+        dict: Результаты поиска по каждому артикулу и сводка обхода
+    """
+    # Валидация входных данных
+    skus = []
+    for target_sku in target_skus:
+        try:
+            sku = str(int(target_sku))  # Проверка, что это число
+        except (TypeError, ValueError):
+            raise ValueError(f"Артикул должен быть числом: {target_sku}")
+        if sku not in skus:
+            skus.append(sku)
+    
+    if not skus:
+        raise ValueError("Список артикулов не может быть пустым")
+    
+    if not query or not query.strip():
+        raise ValueError("Поисковый запрос не может быть пустым")
+    
+    if mode not in SCAN_MODES:
+        raise ValueError(f"Режим поиска должен быть одним из: {', '.join(SCAN_MODES)}")
+    
+    dest = normalize_dest(dest)
+    page_order = _scan_page_order(query, skus, max_pages, strategy, dest)
+    
+    timestamp = datetime.now().isoformat()
+    results = {
+        sku: {"query": query, "sku": sku, "dest": dest, "found": False, "timestamp": timestamp}
+        for sku in skus
+    }
+    found, pages_scanned = _scan_positions(query, skus, page_order, mode, window, deadline, dest,
+                                           kind="batch", strategy=strategy)
+    remaining = set(skus) - set(found)
+    
+    rows = []
+    for sku in skus:
+        if sku in found:
+            _fill_position_result(results[sku], *found[sku])
+            rows.append(_position_row(results[sku]))
+    
+    # Все найденные позиции сохраняются в историю одной пачкой
+    save_position_rows(rows)
+    
+    return {
+        "query": query,
+        "dest": dest,
+        "timestamp": timestamp,
+        "pages_scanned": pages_scanned,
+        "found_count": len(skus) - len(remaining),
+        "not_found": [sku for sku in skus if sku in remaining],
+        "results": results
+    }
+
+def search_product_position_regions(query, target_sku, regions, max_pages=10, mode="sequential", window=None,
+                                    deadline=None, strategy="linear"):
+    """
+    Ищет позицию товара одновременно в нескольких регионах
+    
+    Регионы обходятся параллельно в общем пуле WB_REGION_MAX_WORKERS потоков,
+    поэтому проверка нескольких регионов занимает примерно столько же времени,
+    сколько проверка одного. Позиции сохраняются в историю с регионом.
+    
+    Args:
+        query (str): Поисковый запрос
+        target_sku (str): Артикул товара
+        regions (list or str): Регионы выдачи списком или строкой через запятую
+        max_pages (int): Максимальное количество страниц для поиска в каждом регионе
+        mode (str): Режим обхода страниц в регионе: "sequential" или "parallel"
+        window (int, optional): Количество страниц в окне для режима "parallel"
+        deadline (float, optional): Момент time.monotonic(), после которого поиск прерывается с TimeoutError
+        strategy (str): Порядок обхода: "linear" или "guided"
         
+    Returns:
+        dict: Результаты по регионам в порядке запроса (для региона с ошибкой - поле error)
+    """
+    regions = normalize_regions(regions)
+    
+    results = _scan_regions(regions, lambda dest: search_product_position(
+        query, target_sku, max_pages, mode=mode, window=window, deadline=deadline, strategy=strategy, dest=dest
+    ))
+    
+    return {
+        "query": query,
+        "sku": str(target_sku),
+        "timestamp": datetime.now().isoformat(),
+        "found_count": sum(1 for result in results if result.get("found")),
+        "regions": results
+    }
+
+def search_products_positions_regions(query, target_skus, regions, max_pages=10, mode="sequential", window=None,
+                                      deadline=None, strategy="linear"):
+    """
+    Ищет позиции нескольких товаров одновременно в нескольких регионах
+    
+    В каждом регионе выполняется один пакетный обход (search_products_positions),
+    регионы обходятся параллельно в общем пуле WB_REGION_MAX_WORKERS потоков.
+    
+    Args:
+        query (str): Поисковый запрос
+        target_skus (list): Список артикулов товаров
+        regions (list or str): Регионы выдачи списком или строкой через запятую
+        max_pages (int): Максимальное количество страниц для поиска в каждом регионе
+        mode (str): Режим обхода страниц в регионе: "sequential" или "parallel"
+        window (int, optional): Количество страниц в окне для режима "parallel"
+        deadline (float, optional): Момент time.monotonic(), после которого поиск прерывается с TimeoutError
+        strategy (str): Порядок обхода: "linear" или "guided"
+        
+    Returns:
+        dict: Результаты пакетного поиска по регионам в порядке запроса
+    """
+    regions = normalize_regions(regions)
+    
+    results = _scan_regions(regions, lambda dest: search_products_positions(
+        query, target_skus, max_pages, mode=mode, window=window, deadline=deadline, strategy=strategy, dest=dest
+    ))
+    
+    return {
+        "query": query,
+        "timestamp": datetime.now().isoformat(),
+        "regions": results
+    }
+
+def _scan_regions(regions, scan):
+    """
+    Выполняет поиск во всех регионах параллельно
+    
+    Ошибка в одном регионе не прерывает остальные: его результат заменяется
+    словарем с полем error. Если ошибка во всех регионах, она пробрасывается.
+    
+    Args:
+        regions (list): Проверенные регионы выдачи
+        scan (callable): Функция поиска, принимающая регион
+        
+    Returns:
+        list: Результаты в порядке regions
+    """
+    if len(regions) == 1:
+        return [scan(regions[0])]
+    
+    futures = [_region_executor.submit(scan, dest) for dest in regions]
+    
+    results = []
+    errors = []
+    for dest, future in zip(regions, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            logger.error(f"Ошибка при поиске позиций в регионе {dest}: {str(e)}")
+            errors.append(e)
+            results.append({"dest": dest, "error": str(e)})
+    
+    if len(errors) == len(regions):
+        raise errors[0]
+    
+    return results
+
+def guided_page_order(start_pages, max_pages):
+    """
+    Возвращает порядок обхода страниц от последних известных страниц товаров
+    
+    Сначала проверяются сами известные страницы, затем соседние на расстоянии
+    1, 2, ... (сначала предыдущая, потом следующая), пока не будут перечислены
+    все страницы от 1 до max_pages. Порядок покрывает те же страницы, что и обход
+    подряд, поэтому ненайденный товар действительно отсутствует в первых max_pages.
+    Находка вне порядка страниц подтверждается проверкой более ранних страниц
+    (см. _scan_positions).
+    
+    Args:
+        start_pages (list): Последние известные страницы товаров (None - неизвестна)
+        max_pages (int): Максимальное количество страниц
+        
+    Returns:
+        list: Номера страниц в порядке обхода
+    """
+    starts = sorted({min(max(int(page), 1), max_pages) for page in start_pages if page})
+    if not starts:
+        return list(range(1, max_pages + 1))
+    
+    order = []
+    seen = set()
+    for distance in range(max_pages):
+        for start in starts:
+            for page in (start - distance, start + distance):
+                if 1 <= page <= max_pages and page not in seen:
+                    seen.add(page)
+                    order.append(page)
+        if len(order) == max_pages:
+            break
+    
+    return order
+
+def _scan_page_order(query, skus, max_pages, strategy, dest=None):
+    """
+    Возвращает порядок обхода страниц для стратегии поиска
+    
+    Для стратегии "guided" последняя страница каждого товара берется из истории
+    позиций.
+    
+    Args:
+        query (str): Поисковый запрос
+        skus (list): Артикулы товаров
+        max_pages (int): Максимальное количество страниц
+        strategy (str): "linear" или "guided"
+        dest (str, optional): Регион выдачи
+        
+    Returns:
+        list: Номера страниц в порядке обхода
+    """
+    if strategy not in SCAN_STRATEGIES:
+        raise ValueError(f"Стратегия поиска должна быть одной из: {', '.join(SCAN_STRATEGIES)}")
+    
+    max_pages = int(max_pages)
+    if strategy == "linear":
+        return list(range(1, max_pages + 1))
+    
+    try:
+        # Последние найденные позиции могут еще находиться в буфере записи
+        flush_history()
+        store = get_history_store()
+        start_pages = [store.last_page(sku, query, dest) for sku in skus]
+    except Exception as e:
+        logger.error(f"Ошибка при чтении последней страницы товаров из истории: {str(e)}")
+        start_pages = []
+    
+    return guided_page_order(start_pages, max_pages)
+
+def _scan_positions(query, skus, page_order, mode, window, deadline, dest, kind, strategy):
+    """
+    Находит первое вхождение каждого товара в выдаче, обходя страницы в порядке page_order
+    
+    Товар может встречаться в выдаче несколько раз, а позицией считается первое
+    вхождение. Если порядок обхода (guided) пропустил страницы перед находкой,
+    они проверяются без запросов к API - по кэшу выдачи и снимкам не старше
+    WB_GUIDED_CONFIRM_MAX_AGE (см. _known_pages). Заново запрашиваются только
+    страницы, на которых по этим данным есть найденный товар; страница без
+    кэша и снимков считается не содержащей его. При обходе подряд (linear)
+    пропущенных страниц нет.
+    
+    Args:
+        query (str): Поисковый запрос
+        skus (list): Проверенные артикулы товаров
+        page_order (list): Номера страниц в порядке обхода
+        mode (str): Режим обхода: "sequential" или "parallel"
+        window (int, optional): Количество страниц в окне для режима "parallel"
+        deadline (float, optional): Момент time.monotonic(), после которого поиск прерывается с TimeoutError
+        dest (str): Регион выдачи
+        kind (str): Вид поиска для метрики числа страниц: "single" или "batch"
+        strategy (str): Стратегия обхода для метрики числа страниц
+        
+    Returns:
+        tuple: Кортеж (артикул -> (товар, страница, позиция на странице), количество просмотренных страниц)
+    """
+    found = {}
+    scanned = set()
+    pages_scanned = 0
+    
+    def confirmed():
+        return all(all(page in scanned for page in range(1, found[sku][1])) for sku in found)
+    
+    def check(page, search_data):
+        scanned.add(page)
         if not search_data:
-            continue
-            
-        product, position_on_page = find_product_by_sku(search_data, target_sku)
+            return
         
-        if product:
-            # Сохраняем найденный товар и его позицию
-            global_position = (page-1)*100 + position_on_page
-            
-            # Базовая информация о позиции
-            result["found"] = True
-            result["page"] = page
-            result["position_on_page"] = position_on_page
-            result["global_position"] = global_position
-            
-            # Анализ рекламной информации
-            has_ads = 'log' in product and product['log']
-            result["is_advertised"] = has_ads
-            
-            if has_ads:
-                ad_log = product['log']
-                
-                # Тип рекламы
-                if ad_log.get('tp') == 'c':
-                    result["ad_type"] = "Аукцион"
-                elif ad_log.get('tp') == 'b':
-                    result["ad_type"] = "АРК"
-                else:
-                    result["ad_type"] = "Неизвестный"
-                
-                # Органическая и рекламная позиции
-                result["organic_position"] = ad_log.get('position', '')
-                result["promo_position"] = ad_log.get('promoPosition', '')
-                
-                # CPM и стоимость буста
-                if 'cpm' in ad_log:
-                    result["cpm"] = ad_log['cpm']
-                    
-                    # Расчет стоимости буста если есть обе позиции
-                    if result["organic_position"] and result["promo_position"]:
-                        position_diff = abs(int(result["organic_position"]) - int(result["promo_position"]))
-                        if position_diff > 0:
-                            result["boost_cost"] = float(ad_log['cpm']) / position_diff
-            
-            # Информация о цене
-            if 'salePriceU' in product:
-                result["price"] = product['salePriceU'] / 100
-            elif 'sizes' in product and len(product['sizes']) > 0:
-                first_size = product['sizes'][0]
-                if 'price' in first_size:
-                    if 'total' in first_size['price']:
-                        result["price"] = first_size['price']['total'] / 100
-                    elif 'basic' in first_size['price']:
-                        result["price"] = first_size['price']['basic'] / 100
+        if not isinstance(search_data, SerpPage):
+            search_data = compact_search_page(search_data)
+        
+        for sku in skus:
+            if search_data.position(sku) and (sku not in found or page < found[sku][1]):
+                product, position_on_page = find_product_by_sku(search_data, sku)
+                found[sku] = (product, page, position_on_page)
+    
+    def scan(order, done):
+        nonlocal pages_scanned
+        pages = _iter_search_pages(query, order, mode, window, deadline, dest)
+        try:
+            for page, search_data in pages:
+                pages_scanned += 1
+                check(page, search_data)
+                if done():
+                    break
+        finally:
+            pages.close()
+    
+    try:
+        # Основной обход - пока не найдены все товары
+        scan(page_order, lambda: len(found) == len(skus))
+        
+        # Подтверждение: пропущенные страницы перед находками
+        if found and not confirmed():
+            last = max(page for _, page, _ in found.values())
+            skipped = [page for page in range(1, last) if page not in scanned]
             
-            # Основная информация о товаре
-            result["brand"] = product.get('brand', '')
-            result["name"] = product.get('name', '')
+            refetch = []
+            for page, data in sorted(_known_pages(query, skipped, dest).items()):
+                if isinstance(data, SerpPage):
+                    # Свежая страница из кэша - то же, что и запрос к API
+                    check(page, data)
+                elif any(found[sku][1] > page and int(sku) in data for sku in found):
+                    refetch.append(page)
             
-            # Сохраняем данные о позиции в CSV
-            save_position_to_csv(
-                sku=target_sku,
-                query=query,
-                organic_position=result.get("organic_position"),
-                promo_position=result.get("promo_position"),
-                price=result.get("price"),
-                cpm=result.get("cpm"),
-                ad_type=result.get("ad_type", "Органика"),
-                page=page,
-                position_on_page=position_on_page,
-                boost_cost=result.get("boost_cost")
-            )
+            scan(refetch, lambda: False)
+    finally:
+        SCAN_PAGES.observe(pages_scanned, kind=kind)
+        SCAN_PAGES_BY_STRATEGY.inc(pages_scanned, strategy=strategy)
+    
+    return found, pages_scanned
+
+def _known_pages(query, pages, dest):
+    """
+    Возвращает уже известное содержимое страниц выдачи без запросов к API
+    
+    Страница берется из кэша выдачи, если она там свежая, иначе - артикулы
+    последнего снимка страницы не старше WB_GUIDED_CONFIRM_MAX_AGE секунд.
+    Ошибка чтения снимков не прерывает поиск: такие страницы считаются неизвестными.
+    
+    Args:
+        query (str): Поисковый запрос
+        pages (list): Номера страниц
+        dest (str): Регион выдачи
+        
+    Returns:
+        dict: Номер страницы -> SerpPage из кэша или массив артикулов снимка (только известные страницы)
+    """
+    sort = config.DEFAULT_SORT
+    query_key = normalize_query(query)
+    
+    known = {}
+    for page in pages:
+        cached = search_cache.get((query_key, int(page), str(dest), sort))
+        if cached is not None:
+            known[page] = cached
+    
+    if len(known) == len(pages) or not config.SNAPSHOTS_ENABLED or config.GUIDED_CONFIRM_MAX_AGE <= 0:
+        return known
+    
+    try:
+        snapshots = get_snapshot_store().latest_pages(query_key, dest, sort, time.time(),
+                                                      config.GUIDED_CONFIRM_MAX_AGE)
+    except Exception as e:
+        logger.error(f"Ошибка при чтении снимков выдачи '{query}': {str(e)}")
+        return known
+    
+    for snapshot in snapshots:
+        if snapshot["page"] in pages and snapshot["page"] not in known:
+            known[snapshot["page"]] = snapshot["ids"]
+    
+    return known
+
+def _iter_search_pages(query, page_order, mode="sequential", window=None, deadline=None, dest=None):
+    """
+    Перебирает страницы поисковой выдачи в заданном порядке
+    
+    В режиме "parallel" страницы запрашиваются окнами по window штук через общий
+    пул потоков, но выдаются строго в порядке page_order. При закрытии генератора еще не
+    начатые запросы окна отменяются, а результаты уже запущенных игнорируются.
+    
+    Args:
+        query (str): Поисковый запрос
+        page_order (list): Номера страниц в порядке обхода
+        mode (str): Режим обхода: "sequential" или "parallel"
+        window (int, optional): Количество страниц в окне для режима "parallel"
+        deadline (float, optional): Момент time.monotonic(), после которого новые страницы не запрашиваются
+        dest (str, optional): Регион выдачи
+        
+    Yields:
+        tuple: Кортеж (номер страницы, результаты поиска)
+    """
+    if mode != "parallel":
+        for page in page_order:
+            _check_deadline(deadline)
+            yield page, search_wildberries(query, page, dest)
+        return
+    
+    window = max(1, min(int(window or config.SCAN_WINDOW), config.SCAN_MAX_WORKERS))
+    
+    for window_start in range(0, len(page_order), window):
+        _check_deadline(deadline)
+        pages = page_order[window_start:window_start + window]
+        futures = [_scan_executor.submit(search_wildberries, query, page, dest) for page in pages]
+        
+        try:
+            for page, future in zip(pages, futures):
+                yield page, future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+def _check_deadline(deadline):
+    """
+    Прерывает обход выдачи, если истекло отведенное время
+    
+    Args:
+        deadline (float, optional): Момент time.monotonic(); None - без ограничения
+    """
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutError("Превышено время выполнения поиска позиции")
+
+def _fill_position_result(result, product, page, position_on_page):
+    """
+    Заполняет результат поиска данными найденного товара
+    
+    Args:
+        result (dict): Результат поиска, дополняется на месте
+        product (dict): Товар из поисковой выдачи
+        page (int): Страница, на которой найден товар
+        position_on_page (int): Позиция товара на странице
+    """
+    global_position = (page-1)*100 + position_on_page
+    
+    # Базовая информация о позиции
+    result["found"] = True
+    result["page"] = page
+    result["position_on_page"] = position_on_page
+    result["global_position"] = global_position
+    
+    # Анализ рекламной информации
+    has_ads = bool(product.get('log'))
+    result["is_advertised"] = has_ads
+    
+    if has_ads:
+        ad_log = product['log']
+        
+        # Тип рекламы
+        if ad_log.get('tp') == 'c':
+            result["ad_type"] = "Аукцион"
+        elif ad_log.get('tp') == 'b':
+            result["ad_type"] = "АРК"
+        else:
+            result["ad_type"] = "Неизвестный"
+        
+        # Органическая и рекламная позиции
+        result["organic_position"] = ad_log.get('position', '')
+        result["promo_position"] = ad_log.get('promoPosition', '')
+        
+        # CPM и стоимость буста
+        if 'cpm' in ad_log:
+            result["cpm"] = ad_log['cpm']
             
-            return result
+            # Расчет стоимости буста если есть обе позиции
+            if result["organic_position"] and result["promo_position"]:
+                position_diff = abs(int(result["organic_position"]) - int(result["promo_position"]))
+                if position_diff > 0:
+                    result["boost_cost"] = float(ad_log['cpm']) / position_diff
     
-    # Товар не найден
-    return result
+    # Информация о цене
+    if 'salePriceU' in product:
+        result["price"] = product['salePriceU'] / 100
+    elif 'sizes' in product and len(product['sizes']) > 0:
+        first_size = product['sizes'][0]
+        if 'price' in first_size:
+            if 'total' in first_size['price']:
+                result["price"] = first_size['price']['total'] / 100
+            elif 'basic' in first_size['price']:
+                result["price"] = first_size['price']['basic'] / 100
+    
+    # Основная информация о товаре
+    result["brand"] = product.get('brand', '')
+    result["name"] = product.get('name', '')
+
+def _position_row(result):
+    """
+    Формирует запись истории из результата поиска
+    
+    Args:
+        result (dict): Результат поиска с found=True
+        
+    Returns:
+        dict: Запись с полями history_store.HISTORY_FIELDS
+    """
+    return {
+        'timestamp': datetime.now(),
+        'sku': result["sku"],
+        'query': result["query"],
+        'organic_position': result.get("organic_position"),
+        'promo_position': result.get("promo_position"),
+        'price': result.get("price"),
+        'cpm': result.get("cpm"),
+        'ad_type': result.get("ad_type", "Органика"),
+        'page': result["page"],
+        'position_on_page': result["position_on_page"],
+        'boost_cost': result.get("boost_cost"),
+        'dest': result.get("dest")
+    }
+
+def _save_position_result(result):
+    """
+    Сохраняет найденную позицию из результата поиска в историю
+    
+    Args:
+        result (dict): Результат поиска с found=True
+    """
+    save_position_rows([_position_row(result)])
 
 def save_position_to_csv(sku, query, organic_position, promo_position, price, cpm, ad_type, page, position_on_page, boost_cost):
     """
-    Сохраняет данные о позиции товара в CSV файл
+    Сохраняет данные о позиции товара в историю
+    
+    Имя сохранено для совместимости: запись выполняется в хранилище,
+    выбранное настройкой WB_HISTORY_BACKEND (SQLite или CSV).
     
     Args:
         sku (str): Артикул товара
@@ -206,171 +898,286 @@ def save_position_to_csv(sku, query, organic_position, promo_position, price, cp
     Returns:
         bool: True в случае успеха, False в случае ошибки
     """
-    # Проверяем существование директории
-    os.makedirs("data", exist_ok=True)
+    save_position_rows([{
+        'timestamp': datetime.now(),
+        'sku': sku,
+        'query': query,
+        'organic_position': organic_position,
+        'promo_position': promo_position,
+        'price': price,
+        'cpm': cpm,
+        'ad_type': ad_type,
+        'page': page,
+        'position_on_page': position_on_page,
+        'boost_cost': boost_cost
+    }])
+    return True
+
+def save_position_rows(rows):
+    """
+    Сохраняет пачку записей о позициях в историю
     
-    timestamp = datetime.now()
-    filename = f"data/positions_{sku}.csv"
-    file_exists = os.path.isfile(filename)
+    Записи помещаются в буфер отложенной записи (services/history_writer.py)
+    и сбрасываются в хранилище вместе с часовыми и дневными агрегатами в
+    фоновом потоке, поэтому вызов не ждет диска. При WB_HISTORY_WRITE_BEHIND=0
+    буфер сбрасывается сразу.
+    
+    Args:
+        rows (list): Список записей с полями history_store.HISTORY_FIELDS
+    """
+    if not rows:
+        return
     
     try:
-        with open(filename, 'a', newline='', encoding='utf-8') as csvfile:
-            fieldnames = ['timestamp', 'sku', 'query', 'organic_position', 'promo_position', 
-                          'price', 'cpm', 'ad_type', 'page', 'position_on_page', 'boost_cost']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            
-            if not file_exists:
-                writer.writeheader()
-            
-            writer.writerow({
-                'timestamp': timestamp,
-                'sku': sku,
-                'query': query,
-                'organic_position': organic_position,
-                'promo_position': promo_position,
-                'price': price,
-                'cpm': cpm,
-                'ad_type': ad_type,
-                'page': page,
-                'position_on_page': position_on_page,
-                'boost_cost': boost_cost
-            })
-            return True
+        writer = get_history_writer()
+        writer.add(rows)
+        if not config.HISTORY_WRITE_BEHIND:
+            writer.flush()
     except Exception as e:
-        raise Exception(f"Ошибка при сохранении данных в CSV: {str(e)}")
+        raise Exception(f"Ошибка при сохранении истории позиций: {str(e)}")
 
-def get_position_history_data(sku, query=None, days=30):
+def get_position_history_data(sku, query=None, days=30, limit=None, after=None, dest=None):
     """
-    Получает историю позиций товара из CSV файлов
+    Получает историю позиций товара из хранилища истории
     
     Args:
         sku (str): Артикул товара
         query (str, optional): Поисковый запрос
         days (int): Количество дней для выборки (по умолчанию 30)
+        limit (int, optional): Максимальное количество записей в ответе
+        after (str, optional): Курсор - время последней полученной записи; выбираются записи после него
+        dest (str, optional): Регион выдачи (по умолчанию - все регионы)
         
     Returns:
         dict: Данные истории позиций
     """
-    filename = f"data/positions_{sku}.csv"
-    if not os.path.isfile(filename):
+    # Только что найденные позиции могут еще находиться в буфере записи
+    flush_history()
+    store = get_history_store()
+    if not store.has_history(sku):
         return {"error": "История позиций не найдена"}
     
+    since = _history_since(days, after)
+    
     try:
-        # Загружаем данные из CSV
-        df = pd.read_csv(filename, parse_dates=['timestamp'])
-        
-        # Фильтруем по дате
-        date_limit = datetime.now() - timedelta(days=days)
-        df = df[df['timestamp'] > date_limit]
+        # Выбираем данные за период (для SQLite фильтрация выполняется по индексу в базе);
+        # лишняя запись показывает, есть ли следующая страница
+        with HISTORY_LATENCY.time(operation="read"):
+            df = store.query(sku, query, since=since, limit=limit + 1 if limit else None, dest=dest)
         
-        # Фильтруем по запросу, если указан
-        if query:
-            df = df[df['query'] == query]
+        has_more = bool(limit) and len(df) > limit
+        if has_more:
+            df = df.iloc[:limit]
         
         if df.empty:
             return {"error": "Нет данных за указанный период"}
         
-        # Преобразуем DataFrame в список словарей для ответа API
-        records = []
-        
-        for _, row in df.iterrows():
-            record = {
-                'timestamp': row['timestamp'].isoformat(),
-                'sku': row['sku'],
-                'query': row['query'],
-                'organic_position': row['organic_position'],
-                'promo_position': row['promo_position'],
-                'price': row['price'],
-                'cpm': row['cpm'],
-                'ad_type': row['ad_type'],
-                'page': row['page'],
-                'position_on_page': row['position_on_page'],
-                'boost_cost': row['boost_cost']
-            }
-            records.append(record)
-        
-        # Формируем статистику
+        records = history_records(df)
+        
+        # Формируем статистику (при постраничной выборке - по записям страницы)
         stats = {
-            'min_organic_position': df['organic_position'].min() if 'organic_position' in df.columns and not df['organic_position'].isna().all() else None,
-            'max_organic_position': df['organic_position'].max() if 'organic_position' in df.columns and not df['organic_position'].isna().all() else None,
-            'min_price': df['price'].min() if 'price' in df.columns and not df['price'].isna().all() else None,
-            'max_price': df['price'].max() if 'price' in df.columns and not df['price'].isna().all() else None,
-            'avg_cpm': df['cpm'].mean() if 'cpm' in df.columns and not df['cpm'].isna().all() else None,
+            'min_organic_position': _column_stat(df, 'organic_position', 'min'),
+            'max_organic_position': _column_stat(df, 'organic_position', 'max'),
+            'min_price': _column_stat(df, 'price', 'min'),
+            'max_price': _column_stat(df, 'price', 'max'),
+            'avg_cpm': _column_stat(df, 'cpm', 'mean'),
             'records_count': len(df)
         }
         
-        return {
+        result = {
             'sku': sku,
             'query': query,
+            'dest': dest,
             'days': days,
             'stats': stats,
             'records': records
         }
+        
+        if limit:
+            result['next_cursor'] = records[-1]['timestamp'] if has_more else None
+        
+        return result
     except Exception as e:
         raise Exception(f"Ошибка при получении истории позиций: {str(e)}")
 
-def setup_tracking_job(query, sku, interval=60, interval_type="minutes", max_pages=10):
+def get_position_history_rollup(sku, query=None, bucket="1h", days=30, dest=None):
+    """
+    Получает агрегаты истории позиций товара по часам или дням
+    
+    Args:
+        sku (str): Артикул товара
+        query (str, optional): Поисковый запрос
+        bucket (str): Размер интервала: "1h" или "1d"
+        days (int): Количество дней для выборки (по умолчанию 30)
+        dest (str, optional): Регион выдачи (по умолчанию - все регионы)
+        
+    Returns:
+        dict: Интервалы с минимумом, максимумом и средним органической и рекламной позиций, цены и CPM
+    """
+    since = datetime.now() - timedelta(days=days)
+    flush_history()
+    with HISTORY_LATENCY.time(operation="rollup_read"):
+        buckets = get_rollup_store().query(sku, bucket, query=query, since=since, dest=dest)
+    
+    if not buckets:
+        return {"error": "Нет данных за указанный период"}
+    
+    return {
+        'sku': sku,
+        'query': query,
+        'dest': dest,
+        'bucket': bucket,
+        'days': days,
+        'buckets': buckets
+    }
+
+def iter_position_history_ndjson(sku, query=None, days=30, limit=None, after=None, dest=None):
+    """
+    Выдает историю позиций товара построчно в формате NDJSON
+    
+    История читается из хранилища частями по config.HISTORY_STREAM_CHUNK записей,
+    поэтому расход памяти не зависит от объема истории.
+    
+    Args:
+        sku (str): Артикул товара
+        query (str, optional): Поисковый запрос
+        days (int): Количество дней для выборки (по умолчанию 30)
+        limit (int, optional): Максимальное количество записей
+        after (str, optional): Курсор - время последней полученной записи
+        dest (str, optional): Регион выдачи (по умолчанию - все регионы)
+        
+    Returns:
+        generator: Генератор блоков байтов, по одной JSON-записи на строку
+    """
+    since = _history_since(days, after)
+    flush_history()
+    store = get_history_store()
+    
+    def generate():
+        remaining = limit
+        
+        for chunk in store.iter_query(sku, query, since=since, chunk_size=config.HISTORY_STREAM_CHUNK, dest=dest):
+            if remaining is not None:
+                chunk = chunk.iloc[:remaining]
+                remaining -= len(chunk)
+            
+            lines = [json.dumps(record, ensure_ascii=False) for record in history_records(chunk)]
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            
+            if remaining == 0:
+                return
+    
+    return generate()
+
+def history_records(df):
+    """
+    Преобразует записи истории в список словарей для ответа API
+    
+    Значения извлекаются по колонкам, без построчного обхода DataFrame;
+    пропуски заменяются на None, числа приводятся к типам Python.
+    
+    Args:
+        df (pandas.DataFrame): Записи истории
+        
+    Returns:
+        list: Список записей
+    """
+    columns = []
+    
+    for field in HISTORY_FIELDS:
+        if field == 'timestamp':
+            columns.append(df['timestamp'].dt.strftime('%Y-%m-%dT%H:%M:%S.%f').tolist())
+        else:
+            column = df[field].astype(object)
+            columns.append(column.where(column.notna(), None).tolist())
+    
+    return [dict(zip(HISTORY_FIELDS, values)) for values in zip(*columns)]
+
+def _column_stat(df, column, func):
+    """
+    Вычисляет агрегат колонки истории
+    
+    Args:
+        df (pandas.DataFrame): Записи истории
+        column (str): Имя колонки
+        func (str): Агрегат: "min", "max" или "mean"
+        
+    Returns:
+        Значение агрегата (тип Python) или None, если в колонке нет данных
+    """
+    if column not in df.columns or df[column].isna().all():
+        return None
+    
+    value = getattr(df[column], func)()
+    return value.item() if hasattr(value, 'item') else value
+
+def _history_since(days, after=None):
+    """
+    Определяет нижнюю границу времени выборки истории
+    
+    Args:
+        days (int): Количество дней для выборки
+        after (str, optional): Курсор - время последней полученной записи
+        
+    Returns:
+        datetime: Граница времени (не включительно)
+    """
+    since = datetime.now() - timedelta(days=days)
+    
+    if after:
+        try:
+            cursor = datetime.fromisoformat(after)
+        except ValueError:
+            raise ValueError("Параметр after должен быть временем в формате ISO 8601")
+        since = max(since, cursor)
+    
+    return since
+
+def setup_tracking_job(query, sku, interval=60, interval_type="minutes", max_pages=10, regions=None):
     """
     Настраивает регулярное отслеживание позиций товара
     
+    Задача сохраняется в постоянный реестр (services.tracking_store) и
+    выполняется процессом, удерживающим аренду расписания; первый запуск
+    выполняется сразу после того, как задачу подхватит планировщик.
+    
     Args:
         query (str): Поисковый запрос
         sku (str): Артикул товара
         interval (int): Интервал отслеживания
         interval_type (str): Тип интервала ("minutes" или "hours")
         max_pages (int): Максимальное количество страниц для поиска
+        regions (list or str, optional): Регионы выдачи (по умолчанию config.DEFAULT_DEST)
         
     Returns:
         str: Идентификатор задачи отслеживания
     """
+    regions = normalize_regions(regions)
+    
     # Создаем уникальный идентификатор для задачи
     tracking_id = str(uuid.uuid4())
     
-    # Функция для выполнения отслеживания
-    def tracking_job():
-        try:
-            search_product_position(query, sku, max_pages)
-        except Exception as e:
-            print(f"Ошибка при отслеживании позиции {sku}: {str(e)}")
-    
-    # Настраиваем расписание
-    if interval_type == "minutes":
-        if interval < 1:
-            interval = 1  # Минимальный интервал - 1 минута
-        job = schedule.every(interval).minutes.do(tracking_job)
-    else:
-        job = schedule.every(interval).hours.do(tracking_job)
-    
-    # Запускаем первое отслеживание сразу
-    tracking_job()
+    if interval_type == "minutes" and interval < 1:
+        interval = 1  # Минимальный интервал - 1 минута
     
     # Сохраняем информацию о задаче
-    tracking_jobs[tracking_id] = {
-        'job': job,
+    get_tracking_store().add_job({
+        'tracking_id': tracking_id,
         'query': query,
-        'sku': sku,
+        'sku': str(sku),
         'interval': interval,
         'interval_type': interval_type,
         'max_pages': max_pages,
         'start_time': datetime.now().isoformat(),
+        'regions': regions,
         'active': True
-    }
+    })
     
-    # Запускаем отдельный поток для выполнения задач по расписанию, если это первая задача
-    if len(tracking_jobs) == 1:
-        thread = threading.Thread(target=run_scheduler, daemon=True)
-        thread.start()
+    # Запрашиваем внеочередную сверку, чтобы задача запустилась без ожидания
+    notify_tracker()
     
     return tracking_id
 
-def run_scheduler():
-    """
-    Запускает бесконечный цикл планировщика для выполнения отложенных задач
-    """
-    while True:
-        schedule.run_pending()
-        time.sleep(10)  # Проверяем расписание каждые 10 секунд
-
 def get_active_tracking_jobs():
     """
     Возвращает список активных задач отслеживания
@@ -379,17 +1186,20 @@ def get_active_tracking_jobs():
         list: Список активных задач
     """
     result = []
+    tracker = get_tracker()
     
-    for tracking_id, job_info in tracking_jobs.items():
-        if job_info['active']:
-            result.append({
-                'tracking_id': tracking_id,
-                'query': job_info['query'],
-                'sku': job_info['sku'],
-                'interval': job_info['interval'],
-                'interval_type': job_info['interval_type'],
-                'start_time': job_info['start_time']
-            })
+    for job in get_tracking_store().list_jobs(active_only=True):
+        result.append({
+            'tracking_id': job['tracking_id'],
+            'query': job['query'],
+            'sku': job['sku'],
+            'interval': job['interval'],
+            'interval_type': job['interval_type'],
+            'regions': job['regions'],
+            'start_time': job['start_time'],
+            # Состояние запусков известно только процессу, выполняющему расписание
+            'schedule': tracker.scheduler.job_info(job['tracking_id']) if tracker.is_leader else None
+        })
     
     return result
 
@@ -403,9 +1213,73 @@ def stop_tracking_job(tracking_id):
     Returns:
         bool: True если задача остановлена, False если задача не найдена
     """
-    if tracking_id in tracking_jobs and tracking_jobs[tracking_id]['active']:
-        schedule.cancel_job(tracking_jobs[tracking_id]['job'])
-        tracking_jobs[tracking_id]['active'] = False
+    if get_tracking_store().deactivate_job(tracking_id):
+        notify_tracker()
         return True
     
-    return False 
\ No newline at end of file
+    return False
+
+def stream_tracking_events(tracking_id=None, sku=None, query=None, last_event_id=None):
+    """
+    Выдает результаты задач отслеживания в формате Server-Sent Events
+    
+    Все подключения процесса получают события от одного общего опроса базы
+    событий (services.tracking_events). Пока новых событий нет, раз в
+    config.EVENTS_HEARTBEAT секунд отправляется комментарий keep-alive.
+    
+    Args:
+        tracking_id (str, optional): Только события задачи
+        sku (str, optional): Только события артикула
+        query (str, optional): Только события поискового запроса
+        last_event_id (str, optional): Идентификатор последнего полученного события;
+            поток начинается с пропущенных после него событий
+        
+    Returns:
+        generator: Генератор блоков текста SSE (событие position, данные - результат поиска в JSON)
+    """
+    if last_event_id is not None:
+        try:
+            last_event_id = int(last_event_id)
+        except (TypeError, ValueError):
+            raise ValueError("Last-Event-ID должен быть числом")
+    
+    sku = str(sku) if sku else None
+    query = normalize_query(query) if query else None
+    broadcaster = get_event_broadcaster()
+    
+    def matches(event):
+        return (
+            (tracking_id is None or event["tracking_id"] == tracking_id)
+            and (sku is None or event["sku"] == sku)
+            and (query is None or event["query"] == query)
+        )
+    
+    def generate():
+        cursor = broadcaster.subscribe()
+        if last_event_id is not None:
+            cursor = last_event_id
+        
+        try:
+            yield f"retry: {int(config.EVENTS_POLL_INTERVAL * 1000) + 1000}\n\n"
+            last_sent = time.monotonic()
+            
+            while True:
+                events = broadcaster.events_after(cursor, config.EVENTS_HEARTBEAT)
+                if events:
+                    cursor = events[-1]["id"]
+                
+                chunk = "".join(
+                    f"id: {event['id']}\nevent: position\ndata: {event['data']}\n\n"
+                    for event in events if matches(event)
+                )
+                
+                if chunk:
+                    yield chunk
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= config.EVENTS_HEARTBEAT:
+                    yield ": keep-alive\n\n"
+                    last_sent = time.monotonic()
+        finally:
+            broadcaster.unsubscribe()
+    
+    return generate()
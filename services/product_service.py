@@ -1,13 +1,58 @@
 import requests
 import json
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
-def get_product_details(article_id):
+from services import config
+from services.cache import TTLCache
+from services.http_client import http_get
+from services.rate_limiter import RateLimitExceeded
+from services.stock_store import get_stock_store
+from services.tracker import get_tracker, notify_tracker, stock_job_id
+from services.tracking_store import get_tracking_store
+
+# Кэш отформатированных карточек товаров ((артикул, регион) -> результат format_product_data)
+product_cache = TTLCache(
+    "product",
+    config.PRODUCT_CACHE_TTL,
+    config.PRODUCT_CACHE_MAX_ENTRIES,
+    stale_ttl=config.PRODUCT_CACHE_STALE_TTL
+)
+
+# Общий пул потоков для параллельных запросов пачек карточек
+_card_executor = ThreadPoolExecutor(max_workers=config.CARD_MAX_WORKERS, thread_name_prefix="wb-card")
+
+def normalize_dest(dest):
+    """
+    Проверяет регион выдачи
+    
+    Args:
+        dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+        
+    Returns:
+        str: Регион выдачи
+    """
+    if dest is None or str(dest).strip() == "":
+        return str(config.DEFAULT_DEST)
+    
+    try:
+        return str(int(dest))
+    except (TypeError, ValueError):
+        raise ValueError(f"Регион должен быть числом: {dest}")
+
+def get_product_details(article_id, max_age=None, dest=None):
     """
     Получение детальной информации о товаре по артикулу
     
+    Результат кэшируется на config.PRODUCT_CACHE_TTL секунд. Устаревшая запись
+    еще config.PRODUCT_CACHE_STALE_TTL секунд отдается из кэша, пока одна фоновая
+    загрузка ее обновляет. Время получения данных указано в meta.timestamp.
+    
     Args:
         article_id (str): Артикул товара на Wildberries
+        max_age (float, optional): Максимальный возраст данных из кэша в секундах (0 - всегда свежие)
+        dest (str, optional): Регион, для которого запрашиваются цены и остатки (по умолчанию config.DEFAULT_DEST)
         
     Returns:
         dict: Словарь с детальной информацией о товаре
@@ -18,27 +63,23 @@ def get_product_details(article_id):
     except ValueError:
         raise ValueError("Артикул должен быть числом")
     
-    # URL для запроса информации о товаре
-    url = f"https://card.wb.ru/cards/detail?appType=0&curr=rub&dest=-1257786&spp=30&nm={article_id}"
+    dest = normalize_dest(dest)
     
     try:
-        # Выполняем запрос к API
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        
-        # Парсим ответ в JSON
-        data = response.json()
+        product = product_cache.get_or_load(
+            (article_id, dest),
+            lambda: _load_product(article_id, dest),
+            max_age=max_age
+        )
         
         # Проверяем, что продукт найден
-        if not data.get('data') or not data['data'].get('products') or len(data['data']['products']) == 0:
+        if product is None:
             return {"error": "Товар не найден"}
         
-        # Получаем данные о первом продукте (всегда должен быть один, т.к. запрос по конкретному артикулу)
-        product = data['data']['products'][0]
-        
-        # Формируем и возвращаем обогащенный объект товара
-        return format_product_data(product)
+        return product
     
+    except RateLimitExceeded:
+        raise
     except requests.exceptions.RequestException as e:
         raise Exception(f"Ошибка при запросе к API: {str(e)}")
     except json.JSONDecodeError:
@@ -46,6 +87,325 @@ def get_product_details(article_id):
     except Exception as e:
         raise Exception(f"Непредвиденная ошибка: {str(e)}")
 
+def _load_product(article_id, dest):
+    """
+    Запрашивает и форматирует карточку одного товара
+    
+    Args:
+        article_id (str): Артикул товара
+        dest (str): Регион выдачи
+        
+    Returns:
+        dict: Обогащенный объект товара или None, если товар не найден
+    """
+    products = _fetch_cards([article_id], dest)
+    
+    if not products:
+        return None
+    
+    # Получаем данные о первом продукте (всегда должен быть один, т.к. запрос по конкретному артикулу)
+    return format_product_data(products[0])
+
+def get_products_details(article_ids, dest=None):
+    """
+    Получение детальной информации о нескольких товарах
+    
+    Артикулы разбиваются на пачки по config.CARD_BATCH_SIZE, каждая пачка
+    запрашивается одним запросом к API карточек, пачки запрашиваются параллельно.
+    
+    Args:
+        article_ids (list): Список артикулов товаров
+        dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+        
+    Returns:
+        dict: Найденные товары в порядке запроса и список ненайденных артикулов
+    """
+    ids = normalize_article_ids(article_ids)
+    dest = normalize_dest(dest)
+    batch_size = max(1, config.CARD_BATCH_SIZE)
+    chunks = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+    
+    try:
+        found = {}
+        for products in _card_executor.map(lambda chunk: _fetch_cards(chunk, dest), chunks):
+            for product in products:
+                found.setdefault(str(product.get('id')), product)
+    except requests.exceptions.RequestException as e:
+        raise Exception(f"Ошибка при запросе к API: {str(e)}")
+    except json.JSONDecodeError:
+        raise Exception("Ошибка при парсинге ответа")
+    
+    products = []
+    for article_id in ids:
+        if article_id in found:
+            product = format_product_data(found[article_id])
+            product_cache.set((article_id, dest), product)
+            products.append(product)
+    
+    return {
+        "dest": dest,
+        "requested": len(ids),
+        "found_count": len(products),
+        "requests": len(chunks),
+        "products": products,
+        "missing": [article_id for article_id in ids if article_id not in found]
+    }
+
+def normalize_article_ids(article_ids):
+    """
+    Проверяет список артикулов и убирает повторы
+    
+    Args:
+        article_ids (list): Список артикулов
+        
+    Returns:
+        list: Артикулы (строки с числами) в порядке первого упоминания
+    """
+    ids = []
+    seen = set()
+    for article_id in article_ids:
+        try:
+            article_id = str(int(article_id))  # Проверка, что это число
+        except (TypeError, ValueError):
+            raise ValueError(f"Артикул должен быть числом: {article_id}")
+        if article_id not in seen:
+            seen.add(article_id)
+            ids.append(article_id)
+    
+    if not ids:
+        raise ValueError("Список артикулов не может быть пустым")
+    
+    return ids
+
+def snapshot_products_stock(article_ids, dest=None, deadline=None):
+    """
+    Запрашивает карточки товаров и сохраняет изменения остатков и цен
+    
+    Карточки запрашиваются пачками, как в get_products_details; снимок
+    сохраняется частями по config.CARD_BATCH_SIZE * config.CARD_MAX_WORKERS
+    товаров, поэтому при прерывании по deadline сохраненные части не теряются.
+    
+    Args:
+        article_ids (list): Список артикулов товаров
+        dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+        deadline (float, optional): Момент time.monotonic(), после которого снимок прерывается
+        
+    Returns:
+        dict: Запрошено и найдено товаров, товаров с изменениями, записанных изменений
+            остатков и цен, признак полного снимка
+    """
+    dest = normalize_dest(dest)
+    result = {
+        "dest": dest, "requested": 0, "found_count": 0, "changed": 0,
+        "stock_changes": 0, "price_changes": 0, "complete": True
+    }
+    if not article_ids:
+        return result
+    
+    ids = normalize_article_ids(article_ids)
+    step = max(1, config.CARD_BATCH_SIZE) * max(1, config.CARD_MAX_WORKERS)
+    store = get_stock_store()
+    
+    for start in range(0, len(ids), step):
+        if deadline is not None and time.monotonic() > deadline:
+            result["complete"] = False
+            break
+        
+        details = get_products_details(ids[start:start + step], dest=dest)
+        try:
+            recorded = store.add(dest, details["products"])
+        except Exception as e:
+            raise Exception(f"Ошибка при сохранении снимка остатков: {str(e)}")
+        
+        result["requested"] += details["requested"]
+        result["found_count"] += details["found_count"]
+        for key in ("changed", "stock_changes", "price_changes"):
+            result[key] += recorded[key]
+    
+    return result
+
+def setup_stock_tracking(article_ids, dest=None, interval=None):
+    """
+    Включает регулярные снимки остатков и цен товаров
+    
+    Товары с одинаковыми регионом и интервалом снимаются одной задачей
+    процесса, удерживающего аренду расписания; первый снимок выполняется
+    сразу после того, как задачу подхватит планировщик.
+    
+    Args:
+        article_ids (list): Список артикулов товаров
+        dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+        interval (int, optional): Интервал снимков в минутах (по умолчанию config.STOCK_TRACKING_INTERVAL)
+        
+    Returns:
+        dict: Регион, интервал и артикулы, поставленные на отслеживание
+    """
+    ids = normalize_article_ids(article_ids)
+    dest = normalize_dest(dest)
+    
+    try:
+        interval = max(1, int(interval if interval is not None else config.STOCK_TRACKING_INTERVAL))
+    except (TypeError, ValueError):
+        raise ValueError("interval должен быть числом минут")
+    
+    get_tracking_store().add_stock_items(ids, dest, interval)
+    
+    # Запрашиваем внеочередную сверку, чтобы первый снимок выполнился без ожидания
+    notify_tracker()
+    
+    return {"dest": dest, "interval": interval, "count": len(ids), "skus": ids}
+
+def get_stock_tracking():
+    """
+    Возвращает отслеживаемые товары и задачи снимков по регионам и интервалам
+    
+    Returns:
+        dict: Количество и список товаров, задачи снимков
+    """
+    items = get_tracking_store().list_stock_items()
+    tracker = get_tracker()
+    
+    counts = {}
+    for item in items:
+        bucket = (item['dest'], item['interval'])
+        counts[bucket] = counts.get(bucket, 0) + 1
+    
+    return {
+        "total": len(items),
+        "items": items,
+        "jobs": [
+            {
+                "dest": dest,
+                "interval": interval,
+                "skus": count,
+                # Состояние запусков известно только процессу, выполняющему расписание
+                "schedule": tracker.scheduler.job_info(stock_job_id(dest, interval)) if tracker.is_leader else None
+            }
+            for (dest, interval), count in sorted(counts.items())
+        ]
+    }
+
+def stop_stock_tracking(article_id, dest=None):
+    """
+    Останавливает снимки остатков и цен товара
+    
+    Args:
+        article_id (str): Артикул товара
+        dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+        
+    Returns:
+        bool: True если отслеживание остановлено, False если товар не отслеживался
+    """
+    if get_tracking_store().deactivate_stock_item(normalize_article_ids([article_id])[0], normalize_dest(dest)):
+        notify_tracker()
+        return True
+    
+    return False
+
+def get_stock_history(article_id, at=None, dest=None):
+    """
+    Восстанавливает остатки и цены товара на момент времени по сохраненным изменениям
+    
+    Args:
+        article_id (str): Артикул товара
+        at (str, optional): Момент времени в формате ISO 8601 (по умолчанию - текущий)
+        dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+        
+    Returns:
+        dict: Цены и остатки (в структуре карточки товара), время последнего
+            изменения не позже at; found = False, если до at снимков не было
+    """
+    article_id = normalize_article_ids([article_id])[0]
+    dest = normalize_dest(dest)
+    at_time = _parse_stock_time(at, "at") if at else datetime.now()
+    
+    try:
+        state = get_stock_store().state_at(article_id, dest, at_time.timestamp())
+    except Exception as e:
+        raise Exception(f"Ошибка при восстановлении остатков товара: {str(e)}")
+    
+    result = {"id": int(article_id), "dest": dest, "at": at_time.isoformat(), "found": state is not None}
+    if state is not None:
+        result.update(state)
+        result["changed_at"] = datetime.fromtimestamp(state["changed_at"]).isoformat()
+        if state["first_checked_at"] is not None:
+            result["first_checked_at"] = datetime.fromtimestamp(state["first_checked_at"]).isoformat()
+    
+    return result
+
+def get_stock_changes(article_id, days=7, dest=None):
+    """
+    Возвращает изменения остатков и цен товара за период
+    
+    Args:
+        article_id (str): Артикул товара
+        days (float): Количество дней для выборки (по умолчанию 7)
+        dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+        
+    Returns:
+        dict: Изменения по возрастанию времени; в каждом - изменившиеся цены
+            и остатки (склад, размер, новое количество; 0 - остаток закончился)
+    """
+    article_id = normalize_article_ids([article_id])[0]
+    dest = normalize_dest(dest)
+    since = datetime.now() - timedelta(days=days)
+    
+    try:
+        changes = get_stock_store().changes(article_id, dest, since=since.timestamp())
+    except Exception as e:
+        raise Exception(f"Ошибка при получении изменений остатков товара: {str(e)}")
+    
+    changes = [
+        {"timestamp": datetime.fromtimestamp(change.pop("fetched_at")).isoformat(), **change}
+        for change in changes
+    ]
+    
+    return {"id": int(article_id), "dest": dest, "days": days, "changes": changes}
+
+def _parse_stock_time(value, name):
+    """
+    Разбирает момент времени запроса остатков
+    
+    Args:
+        value (str): Время в формате ISO 8601
+        name (str): Имя параметра для сообщения об ошибке
+        
+    Returns:
+        datetime: Момент времени
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Параметр {name} должен быть временем в формате ISO 8601")
+
+def _fetch_cards(article_ids, dest=None):
+    """
+    Запрашивает карточки товаров одним запросом к API
+    
+    Args:
+        article_ids (list): Список артикулов (строки с числами)
+        dest (str, optional): Регион выдачи (по умолчанию config.DEFAULT_DEST)
+        
+    Returns:
+        list: Сырые данные найденных товаров
+    """
+    dest = dest or config.DEFAULT_DEST
+    
+    # URL для запроса информации о товарах; артикулы перечисляются через ";"
+    url = f"{config.CARD_API_URL}?appType=0&curr=rub&dest={dest}&spp=30&nm={';'.join(article_ids)}"
+    
+    # Выполняем запрос к API
+    response = http_get(url)
+    response.raise_for_status()
+    
+    # Парсим ответ в JSON
+    data = response.json()
+    
+    if not data.get('data') or not data['data'].get('products'):
+        return []
+    
+    return data['data']['products']
+
 def generate_image_url(article_id):
     """
     Генерация URL изображения товара на основе артикула
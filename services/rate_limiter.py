@@ -0,0 +1,409 @@
+# Адаптивное ограничение частоты запросов к API Wildberries
+#
+# Для каждого хоста (search.wb.ru, card.wb.ru) ведется корзина токенов,
+# общая для всех потоков процесса, а при заданном WB_RATE_LIMIT_DB_PATH -
+# и для всех процессов (воркеров gunicorn) через общий файл SQLite.
+#
+# Скорость подбирается по принципу AIMD: каждая секунда успешных запросов
+# прибавляет к ней WB_RATE_LIMIT_INCREASE запросов в секунду, а ответ
+# 429/5xx умножает ее на WB_RATE_LIMIT_DECREASE. Ошибки запросов, отправленных
+# до предыдущего снижения, скорость повторно не снижают, поэтому пачка
+# одновременных отказов уменьшает ее один раз. Заголовок Retry-After
+# приостанавливает выдачу токенов хоста на указанное время.
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from services import config
+from services.db import get_connection
+
+# Статусы ответа, при которых скорость снижается
+THROTTLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# Поля состояния корзины хоста
+STATE_FIELDS = ['rate', 'tokens', 'updated_at', 'blocked_until', 'decreased_at']
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+class RateLimitExceeded(Exception):
+    """Запрос к хосту не может быть выполнен в пределах допустимого ожидания"""
+
+    def __init__(self, host, retry_after):
+        """
+        Args:
+            host (str): Хост API
+            retry_after (float): Через сколько секунд имеет смысл повторить запрос
+        """
+        self.host = host
+        self.retry_after = max(float(retry_after or 0), 0.0)
+        super().__init__(
+            f"Превышен лимит запросов к {host}, повторите через {self.retry_after:.0f} с"
+        )
+
+
+class _LocalState:
+    """Состояния корзин в памяти процесса"""
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def transact(self, host, new_state, func):
+        """
+        Выполняет func над состоянием корзины хоста под блокировкой
+
+        Args:
+            host (str): Хост API
+            new_state (callable): Создает состояние новой корзины
+            func (callable): Изменяет состояние на месте и возвращает результат
+
+        Returns:
+            Результат func
+        """
+        with self._lock:
+            state = self._states.get(host)
+            if state is None:
+                state = new_state()
+                self._states[host] = state
+            return func(state)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Копии состояний корзин по хостам
+        """
+        with self._lock:
+            return {host: dict(state) for host, state in self._states.items()}
+
+
+class _SqliteState:
+    """Состояния корзин в общем файле SQLite, доступные всем процессам"""
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Путь к файлу базы
+        """
+        self.path = path
+        self._initialized_pid = None
+        self._init_lock = threading.Lock()
+
+    def _connect(self):
+        connection = get_connection(self.path)
+
+        pid = os.getpid()
+        if self._initialized_pid != pid:
+            with self._init_lock:
+                if self._initialized_pid != pid:
+                    with connection:
+                        connection.execute("""
+                            CREATE TABLE IF NOT EXISTS rate_limits (
+                                host TEXT PRIMARY KEY,
+                                rate REAL NOT NULL,
+                                tokens REAL NOT NULL,
+                                updated_at REAL NOT NULL,
+                                blocked_until REAL NOT NULL,
+                                decreased_at REAL NOT NULL
+                            )
+                        """)
+                    self._initialized_pid = pid
+
+        return connection
+
+    def transact(self, host, new_state, func):
+        """
+        Выполняет func над состоянием корзины хоста в транзакции с блокировкой записи
+
+        Args:
+            host (str): Хост API
+            new_state (callable): Создает состояние новой корзины
+            func (callable): Изменяет состояние на месте и возвращает результат
+
+        Returns:
+            Результат func
+        """
+        connection = self._connect()
+
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                f"SELECT {', '.join(STATE_FIELDS)} FROM rate_limits WHERE host = ?", (host,)
+            ).fetchone()
+            state = dict(zip(STATE_FIELDS, row)) if row else new_state()
+
+            result = func(state)
+
+            connection.execute(
+                f"INSERT OR REPLACE INTO rate_limits (host, {', '.join(STATE_FIELDS)}) "
+                f"VALUES (?, {', '.join('?' * len(STATE_FIELDS))})",
+                [host] + [state[field] for field in STATE_FIELDS]
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        return result
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Состояния корзин по хостам
+        """
+        rows = self._connect().execute(
+            f"SELECT host, {', '.join(STATE_FIELDS)} FROM rate_limits"
+        ).fetchall()
+        return {row[0]: dict(zip(STATE_FIELDS, row[1:])) for row in rows}
+
+
+class RateLimiter:
+    """Корзины токенов по хостам с адаптивной скоростью (AIMD)"""
+
+    def __init__(self, backend, initial_rate, min_rate, max_rate, burst, increase, decrease, max_wait):
+        """
+        Args:
+            backend: Хранилище состояний корзин (_LocalState или _SqliteState)
+            initial_rate (float): Начальная скорость, запросов в секунду
+            min_rate (float): Нижняя граница скорости
+            max_rate (float): Верхняя граница скорости
+            burst (float): Емкость корзины - запросов, которые можно отправить подряд
+            increase (float): Прирост скорости за секунду успешных запросов
+            decrease (float): Множитель скорости при ответе 429/5xx
+            max_wait (float): Максимальное ожидание токена в секундах
+        """
+        self.backend = backend
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, min_rate)
+        self.burst = max(burst, 1.0)
+        self.increase = increase
+        self.decrease = decrease
+        self.max_wait = max_wait
+
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    def _new_state(self):
+        return {
+            'rate': min(max(self.initial_rate, self.min_rate), self.max_rate),
+            'tokens': self.burst,
+            'updated_at': time.time(),
+            'blocked_until': 0.0,
+            'decreased_at': 0.0
+        }
+
+    def _count(self, host, name, value=1):
+        with self._stats_lock:
+            stats = self._stats.setdefault(host, {
+                "acquired": 0,
+                "waited_seconds": 0.0,
+                "throttled": 0,
+                "decreases": 0,
+                "rejected": 0
+            })
+            stats[name] += value
+
+    def acquire(self, host):
+        """
+        Ждет токен корзины хоста
+
+        Токен берется только в момент отправки: ожидающий поток спит до
+        расчетного появления токена и проверяет корзину заново. Поэтому
+        снижение скорости или Retry-After сразу действуют и на уже ждущие
+        запросы, а не только на новые.
+
+        Args:
+            host (str): Хост API
+
+        Returns:
+            float: Время отправки запроса (time.time()), передается в record()
+
+        Raises:
+            RateLimitExceeded: Если токена пришлось бы ждать дольше max_wait
+        """
+        def take(state):
+            now = time.time()
+
+            # Пока действует Retry-After, updated_at находится в будущем и корзина не пополняется
+            elapsed = now - state['updated_at']
+            if elapsed > 0:
+                state['tokens'] = min(self.burst, state['tokens'] + elapsed * state['rate'])
+                state['updated_at'] = now
+
+            if state['updated_at'] <= now and state['tokens'] >= 1:
+                state['tokens'] -= 1
+                return 0.0
+
+            return max(state['updated_at'] - now, 0.0) + max(1 - state['tokens'], 0.0) / state['rate']
+
+        deadline = time.monotonic() + self.max_wait
+        waited = 0.0
+
+        while True:
+            wait = self.backend.transact(host, self._new_state, take)
+            if wait <= 0:
+                break
+
+            if time.monotonic() + wait > deadline:
+                self._count(host, "rejected")
+                raise RateLimitExceeded(host, wait)
+
+            # Небольшой разброс, чтобы ждущие потоки не проверяли корзину одновременно
+            wait += random.uniform(0, wait * 0.1)
+            time.sleep(wait)
+            waited += wait
+
+        if waited:
+            self._count(host, "waited_seconds", waited)
+        self._count(host, "acquired")
+        return time.time()
+
+    def record(self, host, status, started_at, retry_after=None):
+        """
+        Учитывает ответ хоста при подборе скорости
+
+        Args:
+            host (str): Хост API
+            status (int): HTTP-статус ответа
+            started_at (float): Время отправки запроса, полученное от acquire()
+            retry_after (float, optional): Значение заголовка Retry-After в секундах
+        """
+        throttled = status in THROTTLE_STATUSES
+
+        def update(state):
+            now = time.time()
+
+            if not throttled:
+                # Аддитивный рост: при скорости r за секунду набирается примерно increase
+                state['rate'] = min(self.max_rate, state['rate'] + self.increase / state['rate'])
+                return False
+
+            decreased = False
+            # Запросы, отправленные до предыдущего снижения, шли на старой скорости
+            if started_at >= state['decreased_at']:
+                state['rate'] = max(self.min_rate, state['rate'] * self.decrease)
+                state['decreased_at'] = now
+                state['tokens'] = 0.0
+                decreased = True
+
+            if retry_after:
+                blocked_until = now + retry_after
+                if blocked_until > state['blocked_until']:
+                    state['blocked_until'] = blocked_until
+                    state['tokens'] = 0.0
+                    state['updated_at'] = max(state['updated_at'], blocked_until)
+
+            return decreased
+
+        decreased = self.backend.transact(host, self._new_state, update)
+
+        if throttled:
+            self._count(host, "throttled")
+        if decreased:
+            self._count(host, "decreases")
+
+    def retry_after(self, host):
+        """
+        Возвращает, через сколько секунд у хоста появится свободный токен
+
+        Args:
+            host (str): Хост API
+
+        Returns:
+            float: Время ожидания в секундах
+        """
+        state = self.backend.snapshot().get(host)
+        if state is None:
+            return 0.0
+
+        now = time.time()
+        tokens = state['tokens'] + max(now - state['updated_at'], 0.0) * state['rate']
+        wait = max(state['updated_at'] - now, 0.0)
+        if tokens < 1:
+            wait += (1 - tokens) / state['rate']
+        return wait
+
+    def stats(self):
+        """
+        Возвращает текущую скорость и счетчики по хостам
+
+        Returns:
+            dict: Статистика по хостам
+        """
+        now = time.time()
+        with self._stats_lock:
+            counters = {host: dict(stats) for host, stats in self._stats.items()}
+
+        result = {}
+        for host, state in self.backend.snapshot().items():
+            tokens = state['tokens'] + max(now - state['updated_at'], 0.0) * state['rate']
+            item = {
+                "rate": round(state['rate'], 3),
+                "tokens": round(min(tokens, self.burst), 3),
+                "blocked_for": round(max(state['blocked_until'] - now, 0.0), 3)
+            }
+            item.update(counters.get(host, {}))
+            if "waited_seconds" in item:
+                item["waited_seconds"] = round(item["waited_seconds"], 3)
+            result[host] = item
+
+        return result
+
+
+def parse_retry_after(value):
+    """
+    Разбирает заголовок Retry-After
+
+    Args:
+        value (str): Значение заголовка: число секунд или HTTP-дата
+
+    Returns:
+        float: Задержка в секундах или None, если заголовок отсутствует или некорректен
+    """
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_rate_limiter():
+    """
+    Возвращает ограничитель частоты запросов процесса
+
+    Returns:
+        RateLimiter: Ограничитель с настройками из config
+    """
+    global _limiter
+
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                if config.RATE_LIMIT_DB_PATH:
+                    backend = _SqliteState(config.RATE_LIMIT_DB_PATH)
+                else:
+                    backend = _LocalState()
+
+                _limiter = RateLimiter(
+                    backend,
+                    initial_rate=config.RATE_LIMIT_INITIAL_RATE,
+                    min_rate=config.RATE_LIMIT_MIN_RATE,
+                    max_rate=config.RATE_LIMIT_MAX_RATE,
+                    burst=config.RATE_LIMIT_BURST,
+                    increase=config.RATE_LIMIT_INCREASE,
+                    decrease=config.RATE_LIMIT_DECREASE,
+                    max_wait=config.RATE_LIMIT_MAX_WAIT
+                )
+
+    return _limiter
@@ -0,0 +1,386 @@
+# Предварительные агрегаты истории позиций по часам и дням
+#
+# Агрегаты обновляются при каждой записи в историю (save_position_rows),
+# поэтому графики за длительный период читают сотни готовых интервалов
+# вместо всех исходных записей.
+#
+# Пересчет агрегатов по всей истории (например, после импорта из CSV):
+#   python -m services.rollups --rebuild
+import argparse
+import os
+import threading
+from datetime import datetime
+
+from services import config
+from services.db import get_connection, table_columns
+
+# Размеры интервалов агрегации
+BUCKETS = ("1h", "1d")
+
+# Агрегируемые показатели: имя в ответе API -> поле записи истории
+METRICS = {
+    "organic_position": "organic_position",
+    "promo_position": "promo_position",
+    "price": "price",
+    "cpm": "cpm"
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def bucket_start(timestamp, bucket):
+    """
+    Возвращает начало интервала агрегации, в который попадает момент времени
+
+    Args:
+        timestamp (datetime): Момент времени
+        bucket (str): Размер интервала: "1h" или "1d"
+
+    Returns:
+        datetime: Начало интервала
+    """
+    if bucket == "1h":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    if bucket == "1d":
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    raise ValueError(f"Размер интервала должен быть одним из: {', '.join(BUCKETS)}")
+
+
+def _number(value):
+    # Приводит показатель к числу; пустые и нечисловые значения не учитываются
+    if value is None or value == '':
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if number != number else number  # NaN
+
+
+def _parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+
+class RollupStore:
+    """Агрегаты истории позиций в SQLite: количество, сумма, минимум и максимум по интервалам"""
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Путь к файлу базы
+        """
+        self.path = path
+        self._initialized_pid = None
+        self._init_lock = threading.Lock()
+
+    def _connect(self):
+        connection = get_connection(self.path)
+
+        pid = os.getpid()
+        if self._initialized_pid != pid:
+            with self._init_lock:
+                if self._initialized_pid != pid:
+                    self._create_schema(connection)
+                    self._initialized_pid = pid
+
+        return connection
+
+    @staticmethod
+    def _table_sql(table):
+        metric_columns = ",\n".join(
+            f"{name}_count INTEGER NOT NULL DEFAULT 0, {name}_sum REAL NOT NULL DEFAULT 0, "
+            f"{name}_min REAL, {name}_max REAL"
+            for name in METRICS
+        )
+        return f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                sku INTEGER NOT NULL,
+                query TEXT NOT NULL,
+                dest TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                bucket_start TEXT NOT NULL,
+                samples INTEGER NOT NULL DEFAULT 0,
+                {metric_columns},
+                PRIMARY KEY (sku, query, dest, bucket, bucket_start)
+            )
+        """
+
+    def _create_schema(self, connection):
+        # Агрегаты, созданные до появления регионов, переносятся в таблицу с колонкой dest
+        # (регион по умолчанию). Ключ таблицы меняется, поэтому она пересоздается
+        # в одной транзакции под блокировкой записи
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            columns = table_columns(connection, "position_rollups")
+            if columns and 'dest' not in columns:
+                connection.execute("ALTER TABLE position_rollups RENAME TO position_rollups_legacy")
+                connection.execute(self._table_sql("position_rollups"))
+                copied = sorted(columns)
+                connection.execute(
+                    f"INSERT INTO position_rollups ({', '.join(copied)}, dest) "
+                    f"SELECT {', '.join(copied)}, ? FROM position_rollups_legacy",
+                    (str(config.DEFAULT_DEST),)
+                )
+                connection.execute("DROP TABLE position_rollups_legacy")
+            else:
+                connection.execute(self._table_sql("position_rollups"))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def add(self, rows):
+        """
+        Учитывает новые записи истории в агрегатах
+
+        Записи сначала сворачиваются по интервалам в памяти, затем каждый
+        интервал обновляется одним UPSERT в общей транзакции.
+
+        Args:
+            rows (list): Записи истории (словари с полями history_store.HISTORY_FIELDS)
+        """
+        partials = {}
+
+        for row in rows:
+            timestamp = _parse_timestamp(row['timestamp'])
+
+            dest = str(row.get('dest') or config.DEFAULT_DEST)
+            for bucket in BUCKETS:
+                key = (int(row['sku']), row['query'], dest, bucket, bucket_start(timestamp, bucket).isoformat(sep=' '))
+                partial = partials.get(key)
+                if partial is None:
+                    partial = {"samples": 0}
+                    for name in METRICS:
+                        partial[name] = [0, 0.0, None, None]
+                    partials[key] = partial
+
+                partial["samples"] += 1
+                for name, field in METRICS.items():
+                    value = _number(row.get(field))
+                    if value is None:
+                        continue
+                    aggregate = partial[name]
+                    aggregate[0] += 1
+                    aggregate[1] += value
+                    aggregate[2] = value if aggregate[2] is None else min(aggregate[2], value)
+                    aggregate[3] = value if aggregate[3] is None else max(aggregate[3], value)
+
+        if not partials:
+            return
+
+        columns = ["sku", "query", "dest", "bucket", "bucket_start", "samples"]
+        updates = ["samples = samples + excluded.samples"]
+        for name in METRICS:
+            columns += [f"{name}_count", f"{name}_sum", f"{name}_min", f"{name}_max"]
+            updates += [
+                f"{name}_count = {name}_count + excluded.{name}_count",
+                f"{name}_sum = {name}_sum + excluded.{name}_sum",
+                f"{name}_min = min(coalesce({name}_min, excluded.{name}_min), coalesce(excluded.{name}_min, {name}_min))",
+                f"{name}_max = max(coalesce({name}_max, excluded.{name}_max), coalesce(excluded.{name}_max, {name}_max))"
+            ]
+
+        values = []
+        for key, partial in partials.items():
+            value = list(key) + [partial["samples"]]
+            for name in METRICS:
+                value += partial[name]
+            values.append(value)
+
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                f"INSERT INTO position_rollups ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT (sku, query, dest, bucket, bucket_start) DO UPDATE SET {', '.join(updates)}",
+                values
+            )
+
+    def query(self, sku, bucket, query=None, since=None, until=None, dest=None):
+        """
+        Выбирает агрегаты товара по интервалам
+
+        Если запрос или регион не указаны, интервалы разных запросов и регионов объединяются.
+
+        Args:
+            sku (str): Артикул товара
+            bucket (str): Размер интервала: "1h" или "1d"
+            query (str, optional): Поисковый запрос
+            dest (str, optional): Регион выдачи
+            since (datetime, optional): Нижняя граница времени
+            until (datetime, optional): Верхняя граница времени
+
+        Returns:
+            list: Интервалы в порядке времени
+        """
+        if bucket not in BUCKETS:
+            raise ValueError(f"Размер интервала должен быть одним из: {', '.join(BUCKETS)}")
+
+        conditions = ["sku = ?", "bucket = ?"]
+        params = [int(sku), bucket]
+
+        if query:
+            conditions.append("query = ?")
+            params.append(query)
+        if dest:
+            conditions.append("dest = ?")
+            params.append(str(dest))
+        if since is not None:
+            conditions.append("bucket_start >= ?")
+            params.append(bucket_start(since, bucket).isoformat(sep=' '))
+        if until is not None:
+            conditions.append("bucket_start <= ?")
+            params.append(until.isoformat(sep=' '))
+
+        selects = ["bucket_start", "SUM(samples)"]
+        for name in METRICS:
+            selects += [f"SUM({name}_count)", f"SUM({name}_sum)", f"MIN({name}_min)", f"MAX({name}_max)"]
+
+        rows = self._connect().execute(
+            f"SELECT {', '.join(selects)} FROM position_rollups "
+            f"WHERE {' AND '.join(conditions)} GROUP BY bucket_start ORDER BY bucket_start",
+            params
+        ).fetchall()
+
+        result = []
+        for row in rows:
+            item = {
+                "bucket_start": row[0].replace(' ', 'T'),
+                "samples": row[1]
+            }
+            for index, name in enumerate(METRICS):
+                count, total, minimum, maximum = row[2 + index * 4:6 + index * 4]
+                item[name] = {
+                    "min": minimum,
+                    "max": maximum,
+                    "avg": total / count if count else None,
+                    "count": count
+                }
+            result.append(item)
+
+        return result
+
+    def clear(self, sku=None, since=None):
+        """
+        Удаляет агрегаты товара или все агрегаты
+
+        Args:
+            sku (str, optional): Артикул товара; если не указан, удаляются все агрегаты
+            since (datetime, optional): Удалить только интервалы, начавшиеся не раньше этого момента
+        """
+        conditions = []
+        params = []
+        if sku is not None:
+            conditions.append("sku = ?")
+            params.append(int(sku))
+        if since is not None:
+            conditions.append("bucket_start >= ?")
+            params.append(since.isoformat(sep=' '))
+
+        sql = "DELETE FROM position_rollups"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+
+        connection = self._connect()
+        with connection:
+            connection.execute(sql, params)
+
+    def prune(self, before):
+        """
+        Удаляет интервалы, начавшиеся раньше указанного момента
+
+        Args:
+            before (datetime): Граница срока хранения
+
+        Returns:
+            int: Количество удаленных интервалов
+        """
+        connection = self._connect()
+        with connection:
+            cursor = connection.execute(
+                "DELETE FROM position_rollups WHERE bucket_start < ?", (before.isoformat(sep=' '),)
+            )
+        return cursor.rowcount
+
+
+def get_rollup_store():
+    """
+    Возвращает хранилище агрегатов процесса
+
+    Returns:
+        RollupStore: Хранилище агрегатов
+    """
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = RollupStore(config.ROLLUP_DB_PATH)
+
+    return _store
+
+
+def rebuild_rollups(history_store, skus=None, chunk_size=10000):
+    """
+    Пересчитывает агрегаты по записям хранилища истории
+
+    Пересчитываются только интервалы, начиная с дня самой старой сохранившейся
+    записи товара: агрегаты за период, исходные записи которого уже удалены
+    сроком хранения (WB_HISTORY_RAW_RETENTION_DAYS), остаются без изменений.
+    Разделы удаляются целыми месяцами, поэтому день самой старой записи
+    сохранился полностью.
+
+    Args:
+        history_store: Хранилище истории
+        skus (list, optional): Артикулы для пересчета (по умолчанию все)
+        chunk_size (int): Количество записей, обрабатываемых за раз
+
+    Returns:
+        int: Количество учтенных записей
+    """
+    rollup_store = get_rollup_store()
+    total = 0
+
+    for sku in skus or history_store.list_skus():
+        cleared = False
+
+        for chunk in history_store.iter_query(sku, chunk_size=chunk_size):
+            if chunk.empty:
+                continue
+
+            if not cleared:
+                # Записи выбираются в порядке времени: первая часть содержит самую старую
+                oldest = chunk['timestamp'].min().to_pydatetime()
+                rollup_store.clear(sku, since=bucket_start(oldest, "1d"))
+                cleared = True
+
+            rows = chunk.to_dict('records')
+            for row in rows:
+                row['timestamp'] = row['timestamp'].to_pydatetime()
+            rollup_store.add(rows)
+            total += len(rows)
+
+    return total
+
+
+def main():
+    from services.history_store import get_history_store
+
+    parser = argparse.ArgumentParser(description="Агрегаты истории позиций")
+    parser.add_argument("--rebuild", action="store_true", help="Пересчитать агрегаты по всей истории")
+    parser.add_argument("--sku", action="append", help="Артикул для пересчета (можно указать несколько раз)")
+    args = parser.parse_args()
+
+    if not args.rebuild:
+        parser.print_help()
+        return
+
+    total = rebuild_rollups(get_history_store(), args.sku)
+    print(f"Агрегаты пересчитаны, учтено записей: {total}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+# Планировщик задач отслеживания
+# Очередь следующих запусков на куче, ограниченный пул исполнителей,
+# таймауты, случайный сдвиг запусков, запрет перекрывающихся запусков одной задачи
+# и объединение одновременно наступивших задач одной группы в один запуск
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from services import config
+from services.metrics import Counter, Histogram, register_collector
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_LAG = Histogram(
+    "wb_scheduler_lag_seconds",
+    "Задержка запуска задачи относительно расписания",
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+)
+SCHEDULER_RUNS = Counter(
+    "wb_scheduler_runs_total",
+    "Запуски задач отслеживания по результату (ok, error, timeout, skipped)",
+    ("result",)
+)
+
+
+class _ScheduledJob:
+    """Задача планировщика и ее счетчики"""
+
+    def __init__(self, job_id, func, interval, group=None, payload=None):
+        self.job_id = job_id
+        self.func = func
+        self.interval = interval
+        self.group = group
+        self.payload = payload
+        self.planned = None  # плановое время запуска без случайного сдвига
+        self.next_run = None
+        self.running = False
+        self.removed = False
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.skipped = 0
+
+
+class TrackingScheduler:
+    """
+    Планировщик периодических задач
+
+    Задачи выполняются в пуле из max_workers потоков. Функция задачи получает
+    deadline (значение time.monotonic()), после которого должна прерваться;
+    работа, завершившаяся позже, учитывается как таймаут. Если предыдущий
+    запуск задачи еще не завершен, очередной запуск пропускается.
+
+    Задачи с одинаковой группой (group), наступившие в пределах coalesce_window
+    секунд, выполняются одним вызовом group_runner(group, payloads, deadline)
+    и дальше планируются синхронно. Случайный сдвиг задач одной группы
+    одинаков, чтобы он не разводил их запуски.
+    """
+
+    def __init__(self, max_workers, job_timeout, max_jitter, coalesce_window=0, group_runner=None):
+        """
+        Args:
+            max_workers (int): Максимальное количество одновременно выполняемых задач
+            job_timeout (float): Время на один запуск задачи в секундах
+            max_jitter (float): Максимальный случайный сдвиг запуска в секундах
+            coalesce_window (float): Окно объединения задач одной группы в секундах
+            group_runner (callable, optional): Функция запуска группы задач
+        """
+        self.max_workers = max_workers
+        self.job_timeout = job_timeout
+        self.max_jitter = max_jitter
+        self.coalesce_window = coalesce_window
+        self.group_runner = group_runner
+
+        self._jobs = {}
+        self._heap = []  # (время запуска, порядковый номер, задача)
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self._stopping = False
+        self._pending = 0  # запуски, переданные в пул, но еще не начатые
+        self._stats = {
+            "dispatched": 0,
+            "batches": 0,
+            "coalesced": 0,
+            "lag_last": 0.0,
+            "lag_max": 0.0,
+            "lag_total": 0.0
+        }
+
+    def add_job(self, job_id, func, interval, run_now=True, group=None, payload=None):
+        """
+        Добавляет периодическую задачу и запускает планировщик, если он еще не запущен
+
+        Args:
+            job_id (str): Идентификатор задачи
+            func (callable): Функция задачи, принимает deadline
+            interval (float): Интервал между запусками в секундах
+            run_now (bool): Выполнить первый запуск сразу, иначе через interval
+            group (hashable, optional): Группа для объединения одновременных запусков
+            payload (optional): Данные задачи, передаваемые group_runner
+        """
+        job = _ScheduledJob(job_id, func, interval, group, payload)
+        planned = time.monotonic() + (0 if run_now else interval)
+
+        with self._cond:
+            previous = self._jobs.get(job_id)
+            if previous is not None:
+                previous.removed = True
+
+            self._jobs[job_id] = job
+            self._push(job, planned, jitter=not run_now)
+            self._cond.notify()
+
+        self.start()
+
+    def remove_job(self, job_id):
+        """
+        Удаляет задачу; уже выполняющийся запуск завершается
+
+        Args:
+            job_id (str): Идентификатор задачи
+
+        Returns:
+            bool: True, если задача была в планировщике
+        """
+        with self._cond:
+            job = self._jobs.pop(job_id, None)
+            if job is None:
+                return False
+
+            job.removed = True
+            self._cond.notify()
+            return True
+
+    def has_job(self, job_id):
+        """
+        Проверяет, есть ли задача в планировщике
+
+        Args:
+            job_id (str): Идентификатор задачи
+
+        Returns:
+            bool: True, если задача есть
+        """
+        with self._cond:
+            return job_id in self._jobs
+
+    def job_info(self, job_id):
+        """
+        Возвращает состояние задачи
+
+        Args:
+            job_id (str): Идентификатор задачи
+
+        Returns:
+            dict: Время следующего и последнего запуска, счетчики; None, если задачи нет
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+
+            now = time.monotonic()
+            return {
+                "next_run_in": round(max(job.next_run - now, 0), 3) if job.next_run is not None else None,
+                "running": job.running,
+                "last_run": job.last_run,
+                "last_duration": job.last_duration,
+                "last_error": job.last_error,
+                "runs": job.runs,
+                "failures": job.failures,
+                "timeouts": job.timeouts,
+                "skipped": job.skipped
+            }
+
+    def start(self):
+        """Запускает поток планировщика, если он еще не запущен"""
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            self._stopping = False
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="wb-tracking"
+                )
+            self._thread = threading.Thread(target=self._loop, name="wb-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self, wait=True):
+        """
+        Останавливает планировщик
+
+        Args:
+            wait (bool): Дождаться завершения выполняющихся задач
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+            executor = self._executor
+            self._executor = None
+
+        if thread is not None:
+            thread.join()
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def stats(self):
+        """
+        Возвращает показатели работы планировщика
+
+        Returns:
+            dict: Количество задач, длина очереди, задержка запусков и счетчики
+        """
+        with self._cond:
+            now = time.monotonic()
+            jobs = list(self._jobs.values())
+            due = sum(1 for job in jobs if not job.running and job.next_run is not None and job.next_run <= now)
+            stats = {
+                "active_jobs": len(jobs),
+                "running": sum(1 for job in jobs if job.running),
+                "queue_depth": due + self._pending,
+                "max_workers": self.max_workers,
+                "dispatched": self._stats["dispatched"],
+                "batches": self._stats["batches"],
+                "coalesced": self._stats["coalesced"],
+                "lag_last": round(self._stats["lag_last"], 3),
+                "lag_max": round(self._stats["lag_max"], 3),
+                "lag_avg": round(self._stats["lag_total"] / self._stats["dispatched"], 3)
+                if self._stats["dispatched"] else None,
+                "runs": sum(job.runs for job in jobs),
+                "failures": sum(job.failures for job in jobs),
+                "timeouts": sum(job.timeouts for job in jobs),
+                "skipped": sum(job.skipped for job in jobs)
+            }
+        return stats
+
+    def _jitter(self, job):
+        # Случайный сдвиг не больше 10% интервала и не больше max_jitter;
+        # для задач группы сдвиг одинаков, чтобы не разводить их запуски
+        limit = min(self.max_jitter, job.interval * 0.1)
+        if job.group is None:
+            return random.uniform(0, limit)
+        return random.Random(repr(job.group)).uniform(0, limit)
+
+    def _push(self, job, planned, jitter=True):
+        # Вызывается под блокировкой
+        job.planned = planned
+        job.next_run = planned + (self._jitter(job) if jitter else 0)
+        heapq.heappush(self._heap, (job.next_run, next(self._sequence), job))
+
+    def _pop_valid(self):
+        # Вызывается под блокировкой; удаленные задачи и устаревшие записи очереди пропускаются
+        while self._heap and (self._heap[0][2].removed or self._heap[0][2].next_run != self._heap[0][0]):
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def _take_due(self, now):
+        # Вызывается под блокировкой; забирает из очереди наступившую задачу
+        # и задачи ее группы, наступающие в пределах окна объединения
+        _, _, first = heapq.heappop(self._heap)
+        batch = [first]
+
+        if first.group is not None and self.coalesce_window > 0:
+            horizon = now + self.coalesce_window
+            postponed = []
+
+            while True:
+                entry = self._pop_valid()
+                if entry is None or entry[0] > horizon:
+                    break
+                heapq.heappop(self._heap)
+                if entry[2].group == first.group:
+                    batch.append(entry[2])
+                else:
+                    postponed.append(entry)
+
+            for entry in postponed:
+                heapq.heappush(self._heap, entry)
+
+        return batch
+
+    def _reschedule(self, batch, now):
+        # Вызывается под блокировкой; следующий запуск отсчитывается от планового
+        # времени, а не от завершения. Задачи группы с одинаковым интервалом
+        # получают общее плановое время (в том числе с уже запланированными
+        # задачами группы), поэтому дальше наступают одновременно
+        aligned = {}
+        in_batch = set(id(job) for job in batch)
+
+        for job in batch:
+            planned = job.planned + job.interval
+            while planned <= now:
+                planned += job.interval
+
+            if job.group is not None:
+                key = (job.group, job.interval)
+                if key not in aligned:
+                    for other in self._jobs.values():
+                        if (id(other) not in in_batch and other.group == job.group
+                                and other.interval == job.interval and now < other.planned <= now + job.interval):
+                            planned = other.planned
+                            break
+                    aligned[key] = planned
+                planned = aligned[key]
+
+            self._push(job, planned)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+
+                    entry = self._pop_valid()
+                    if entry is None:
+                        self._cond.wait()
+                        continue
+
+                    now = time.monotonic()
+                    if entry[0] > now:
+                        self._cond.wait(entry[0] - now)
+                        continue
+                    break
+
+                batch = self._take_due(now)
+                lags = [max(now - job.next_run, 0) for job in batch]
+                self._reschedule(batch, now)
+
+                ready = []
+                for job, lag in zip(batch, lags):
+                    if job.running:
+                        job.skipped += 1
+                        SCHEDULER_RUNS.inc(result="skipped")
+                        logger.warning(f"Задача {job.job_id} еще выполняется, запуск пропущен")
+                        continue
+
+                    self._stats["dispatched"] += 1
+                    self._stats["lag_last"] = lag
+                    self._stats["lag_max"] = max(self._stats["lag_max"], lag)
+                    self._stats["lag_total"] += lag
+                    SCHEDULER_LAG.observe(lag)
+                    ready.append(job)
+
+                if not ready:
+                    continue
+
+                for job in ready:
+                    job.running = True
+
+                self._stats["batches"] += 1
+                self._stats["coalesced"] += len(ready) - 1
+                self._pending += 1
+                try:
+                    self._executor.submit(self._execute, ready)
+                except RuntimeError:
+                    # Пул остановлен (завершение процесса)
+                    for job in ready:
+                        job.running = False
+                    self._pending -= 1
+                    return
+
+    def _execute(self, batch):
+        with self._cond:
+            self._pending -= 1
+
+        started = time.monotonic()
+        deadline = started + self.job_timeout
+        error = None
+
+        try:
+            if len(batch) > 1 and self.group_runner is not None:
+                self.group_runner(batch[0].group, [job.payload for job in batch], deadline)
+            else:
+                for job in batch:
+                    job.func(deadline)
+        except Exception as e:
+            error = str(e)
+            logger.error(f"Ошибка при выполнении задач {', '.join(job.job_id for job in batch)}: {error}")
+
+        finished = time.monotonic()
+
+        if error is not None:
+            result = "error"
+        elif finished > deadline:
+            result = "timeout"
+        else:
+            result = "ok"
+        SCHEDULER_RUNS.inc(len(batch), result=result)
+
+        with self._cond:
+            for job in batch:
+                job.running = False
+                job.runs += 1
+                job.last_run = time.time()
+                job.last_duration = round(finished - started, 3)
+                job.last_error = error
+                if error is not None:
+                    job.failures += 1
+                if finished > deadline:
+                    job.timeouts += 1
+                    logger.warning(f"Задача {job.job_id} превысила таймаут {self.job_timeout} с")
+
+
+_scheduler = None
+_scheduler_pid = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Возвращает планировщик задач отслеживания процесса
+
+    После fork создается новый планировщик: потоки и пул родителя в дочернем процессе не работают.
+
+    Returns:
+        TrackingScheduler: Планировщик
+    """
+    global _scheduler, _scheduler_pid
+
+    pid = os.getpid()
+    if _scheduler is None or _scheduler_pid != pid:
+        with _scheduler_lock:
+            if _scheduler is None or _scheduler_pid != pid:
+                _scheduler_pid = pid
+                _scheduler = TrackingScheduler(
+                    max_workers=config.SCHEDULER_MAX_WORKERS,
+                    job_timeout=config.SCHEDULER_JOB_TIMEOUT,
+                    max_jitter=config.SCHEDULER_MAX_JITTER,
+                    coalesce_window=config.SCHEDULER_COALESCE_WINDOW
+                )
+
+    return _scheduler
+
+
+def _collect_scheduler_metrics():
+    stats = get_scheduler().stats()
+    return [
+        ("wb_scheduler_active_jobs", "gauge", "Задач в планировщике процесса", [({}, stats["active_jobs"])]),
+        ("wb_scheduler_running_jobs", "gauge", "Выполняемых запусков", [({}, stats["running"])]),
+        ("wb_scheduler_queue_depth", "gauge", "Наступивших, но еще не начатых запусков", [({}, stats["queue_depth"])])
+    ]
+
+
+register_collector(_collect_scheduler_metrics)
@@ -0,0 +1,168 @@
+# Компактное представление страницы поисковой выдачи
+#
+# Ответ API поиска содержит по 100 товаров с десятками полей, но для
+# определения позиции нужны только порядок артикулов и несколько полей
+# найденного товара (реклама, цена, бренд, название). Страница разбирается
+# один раз (orjson из requirements.txt; без него - стандартный json), после чего от нее остаются кортеж
+# артикулов и короткие записи товаров; исходные словари не хранятся ни в
+# кэше выдачи, ни в окне параллельного обхода.
+import json
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+class SerpPage:
+    """Страница выдачи: артикулы в порядке выдачи и поля, нужные для расчета позиции"""
+
+    __slots__ = ("ids", "_records", "_positions")
+
+    def __init__(self, ids, records):
+        """
+        Args:
+            ids (tuple): Артикулы товаров в порядке выдачи
+            records (tuple): Записи товаров (brand, name, price_u, log) в том же порядке
+        """
+        self.ids = ids
+        self._records = records
+        self._positions = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __bool__(self):
+        return bool(self.ids)
+
+    def position(self, sku):
+        """
+        Возвращает позицию товара на странице
+
+        Args:
+            sku (str): Артикул товара
+
+        Returns:
+            int: Позиция, начиная с 1 (при повторах - первое вхождение), или 0, если товара нет
+        """
+        positions = self._positions
+        if positions is None:
+            positions = {}
+            for position, product_id in enumerate(self.ids, start=1):
+                positions.setdefault(product_id, position)
+            self._positions = positions
+
+        try:
+            return positions.get(int(sku), 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def product(self, position):
+        """
+        Возвращает товар на позиции в формате ответа API (только используемые поля)
+
+        Args:
+            position (int): Позиция, начиная с 1
+
+        Returns:
+            dict: Товар с полями id, brand, name, salePriceU и log (если товар рекламный)
+        """
+        brand, name, price_u, log = self._records[position - 1]
+
+        product = {"id": self.ids[position - 1], "brand": brand, "name": name}
+        if price_u is not None:
+            product["salePriceU"] = price_u
+        if log:
+            product["log"] = log
+        return product
+
+    def ad_columns(self):
+        """
+        Возвращает рекламные показатели товаров страницы по колонкам
+
+        Returns:
+            tuple: Списки (органическая позиция, рекламная позиция, CPM) в порядке
+                выдачи; 0 - товар не рекламный или показатель отсутствует
+        """
+        organic = []
+        promo = []
+        cpm = []
+
+        for _, _, _, log in self._records:
+            log = log or {}
+            organic.append(_int(log.get('position')))
+            promo.append(_int(log.get('promoPosition')))
+            cpm.append(_int(log.get('cpm')))
+
+        return organic, promo, cpm
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _price_u(product):
+    # Цена в копейках с тем же приоритетом полей, что и при расчете позиции
+    if 'salePriceU' in product:
+        return product['salePriceU']
+
+    sizes = product.get('sizes')
+    if sizes:
+        price = sizes[0].get('price') or {}
+        if 'total' in price:
+            return price['total']
+        if 'basic' in price:
+            return price['basic']
+
+    return None
+
+
+def _compact_log(log):
+    # Из рекламного блока нужны тип кампании, позиции и ставка
+    compact = {key: log[key] for key in ('tp', 'position', 'promoPosition', 'cpm') if key in log}
+    return compact or {'tp': None}
+
+
+def parse_search_page(raw):
+    """
+    Разбирает ответ API поиска в компактную страницу выдачи
+
+    Args:
+        raw (bytes): Тело ответа API поиска
+
+    Returns:
+        SerpPage: Страница выдачи (пустая, если в ответе нет товаров)
+    """
+    data = _loads(raw)
+    return compact_search_page(data)
+
+
+def compact_search_page(data):
+    """
+    Преобразует разобранный ответ API поиска в компактную страницу выдачи
+
+    Args:
+        data (dict): Ответ API поиска
+
+    Returns:
+        SerpPage: Страница выдачи
+    """
+    products = ((data or {}).get('data') or {}).get('products') or []
+
+    ids = []
+    records = []
+    for product in products:
+        ids.append(product.get('id'))
+        log = product.get('log')
+        records.append((
+            product.get('brand', ''),
+            product.get('name', ''),
+            _price_u(product),
+            _compact_log(log) if log else None
+        ))
+
+    return SerpPage(tuple(ids), tuple(records))
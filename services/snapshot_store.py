@@ -0,0 +1,224 @@
+# Снимки страниц поисковой выдачи
+#
+# Каждая загруженная у API страница выдачи сохраняется компактно: артикулы
+# товаров и органическая позиция, рекламная позиция и CPM в массивах
+# фиксированной ширины (около 2 КБ на страницу из 100 товаров). По снимкам
+# можно определить позицию любого артикула, в том числе конкурента, в
+# момент сканирования без повторных запросов к Wildberries.
+#
+# Снимки старше WB_SNAPSHOT_RETENTION_DAYS удаляются при записи (не чаще
+# раза в час) или вручную:
+#   python -m services.snapshot_store --prune
+import argparse
+import os
+import sys
+import threading
+import time
+from array import array
+
+from services import config
+from services.db import get_connection
+
+# Интервал между автоматическими очистками устаревших снимков, секунды
+PRUNE_INTERVAL = 3600
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def _pack(values, typecode):
+    # Массив фиксированной ширины в порядке байтов little-endian
+    packed = array(typecode, values)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack(data, typecode):
+    unpacked = array(typecode)
+    unpacked.frombytes(data)
+    if sys.byteorder != "little":
+        unpacked.byteswap()
+    return unpacked
+
+
+class SnapshotStore:
+    """Снимки страниц выдачи в SQLite"""
+
+    def __init__(self, path, retention_days):
+        """
+        Args:
+            path (str): Путь к файлу базы
+            retention_days (float): Срок хранения снимков в днях
+        """
+        self.path = path
+        self.retention_days = retention_days
+        self._initialized_pid = None
+        self._init_lock = threading.Lock()
+        self._last_prune = 0.0
+
+    def _connect(self):
+        connection = get_connection(self.path)
+
+        pid = os.getpid()
+        if self._initialized_pid != pid:
+            with self._init_lock:
+                if self._initialized_pid != pid:
+                    self._create_schema(connection)
+                    self._initialized_pid = pid
+
+        return connection
+
+    def _create_schema(self, connection):
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS serp_snapshots (
+                    query TEXT NOT NULL,
+                    dest TEXT NOT NULL,
+                    sort TEXT NOT NULL,
+                    page INTEGER NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    ids BLOB NOT NULL,
+                    organic BLOB NOT NULL,
+                    promo BLOB NOT NULL,
+                    cpm BLOB NOT NULL,
+                    PRIMARY KEY (query, dest, sort, page, fetched_at)
+                )
+            """)
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_serp_snapshots_fetched_at ON serp_snapshots (fetched_at)"
+            )
+
+    def add(self, query, dest, sort, page, serp, fetched_at=None):
+        """
+        Сохраняет снимок страницы выдачи
+
+        Args:
+            query (str): Нормализованный поисковый запрос
+            dest (str): Регион выдачи
+            sort (str): Сортировка выдачи
+            page (int): Номер страницы
+            serp (SerpPage): Страница выдачи
+            fetched_at (float, optional): Время загрузки (time.time()), по умолчанию текущее
+        """
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        organic, promo, cpm = serp.ad_columns()
+
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO serp_snapshots "
+                "(query, dest, sort, page, fetched_at, ids, organic, promo, cpm) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    query, str(dest), sort, int(page), fetched_at,
+                    _pack([product_id or 0 for product_id in serp.ids], 'q'),
+                    _pack(organic, 'i'),
+                    _pack(promo, 'i'),
+                    _pack(cpm, 'i')
+                )
+            )
+
+        if fetched_at - self._last_prune > PRUNE_INTERVAL:
+            self._last_prune = fetched_at
+            self.prune()
+
+    def latest_pages(self, query, dest, sort, at, max_age):
+        """
+        Возвращает последние снимки каждой страницы на момент времени
+
+        Args:
+            query (str): Нормализованный поисковый запрос
+            dest (str): Регион выдачи
+            sort (str): Сортировка выдачи
+            at (float): Момент времени (time.time())
+            max_age (float): Максимальный возраст снимка относительно at в секундах
+
+        Returns:
+            list: Снимки по возрастанию номера страницы: словари page, fetched_at,
+                ids, organic, promo, cpm (массивы array)
+        """
+        rows = self._connect().execute(
+            "SELECT page, fetched_at, ids, organic, promo, cpm FROM serp_snapshots "
+            "WHERE query = ? AND dest = ? AND sort = ? AND fetched_at <= ? AND fetched_at >= ? "
+            "ORDER BY page, fetched_at DESC",
+            (query, str(dest), sort, at, at - max_age)
+        ).fetchall()
+
+        pages = []
+        for page, fetched_at, ids, organic, promo, cpm in rows:
+            if pages and pages[-1]["page"] == page:
+                continue
+            pages.append({
+                "page": page,
+                "fetched_at": fetched_at,
+                "ids": _unpack(ids, 'q'),
+                "organic": _unpack(organic, 'i'),
+                "promo": _unpack(promo, 'i'),
+                "cpm": _unpack(cpm, 'i')
+            })
+
+        return pages
+
+    def prune(self, before=None):
+        """
+        Удаляет устаревшие снимки
+
+        Args:
+            before (float, optional): Удалить снимки старше этого момента
+                (по умолчанию - старше срока хранения)
+
+        Returns:
+            int: Количество удаленных снимков
+        """
+        if before is None:
+            before = time.time() - self.retention_days * 86400
+
+        connection = self._connect()
+        with connection:
+            cursor = connection.execute("DELETE FROM serp_snapshots WHERE fetched_at < ?", (before,))
+        return cursor.rowcount
+
+    def stats(self):
+        """
+        Returns:
+            dict: Количество снимков, запросов и границы времени
+        """
+        count, queries, oldest, newest = self._connect().execute(
+            "SELECT COUNT(*), COUNT(DISTINCT query), MIN(fetched_at), MAX(fetched_at) FROM serp_snapshots"
+        ).fetchone()
+        return {"snapshots": count, "queries": queries, "oldest": oldest, "newest": newest}
+
+
+def get_snapshot_store():
+    """
+    Возвращает хранилище снимков выдачи процесса
+
+    Returns:
+        SnapshotStore: Хранилище снимков
+    """
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SnapshotStore(config.SNAPSHOT_DB_PATH, config.SNAPSHOT_RETENTION_DAYS)
+
+    return _store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Снимки страниц поисковой выдачи")
+    parser.add_argument("--prune", action="store_true", help="Удалить снимки старше срока хранения")
+    args = parser.parse_args()
+
+    store = get_snapshot_store()
+
+    if args.prune:
+        print(f"Удалено снимков: {store.prune()}")
+
+    print(store.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+# Снимки остатков и цен товаров с дельта-кодированием
+#
+# Задачи отслеживания остатков регулярно запрашивают карточки товаров
+# (services.product_service.snapshot_products_stock). Снимок не хранится
+# целиком: в stock_changes записываются только пары (склад, размер), у которых
+# изменилось количество (0 - остаток закончился), в price_changes - только
+# изменившиеся цены. Последнее состояние товара хранится в stock_heads и
+# служит основой для сравнения, поэтому снимок без изменений не добавляет
+# строк, а лишь обновляет время последней проверки.
+#
+# Состояние на любой момент восстанавливается по последнему изменению каждой
+# пары (склад, размер) и цены не позже этого момента - выборкой по первичному
+# ключу, без перебора снимков.
+import json
+import os
+import threading
+import time
+
+from services import config
+from services.db import get_connection
+from services.metrics import Counter
+
+# Артикулов в одном условии IN при чтении и обновлении последних состояний
+HEADS_CHUNK = 500
+
+STOCK_CHANGES = Counter(
+    "wb_stock_changes_total",
+    "Записанных изменений остатков и цен по виду (stock, price)",
+    ("kind",)
+)
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def _warehouse_id(value):
+    # Склады хранятся строкой; числовые идентификаторы возвращаются числом, как в карточке
+    return int(value) if value.isdigit() else value
+
+
+def product_state(product):
+    """
+    Извлекает из карточки товара цены и остатки по складам и размерам
+
+    Args:
+        product (dict): Карточка товара (результат format_product_data)
+
+    Returns:
+        tuple: Цены [current, original, discount] и словарь (склад, размер) -> количество
+            (только ненулевые остатки)
+    """
+    prices = product.get("prices") or {}
+    stocks = {}
+
+    for warehouse in product.get("availability", {}).get("warehouses", []):
+        for size, qty in warehouse.get("sizes", {}).items():
+            if qty:
+                key = (str(warehouse["id"]), str(size))
+                stocks[key] = stocks.get(key, 0) + qty
+
+    return [prices.get("current"), prices.get("original"), prices.get("discount")], stocks
+
+
+def build_availability(stocks):
+    """
+    Собирает остатки в структуру availability карточки товара
+
+    Args:
+        stocks (dict): (склад, размер) -> количество
+
+    Returns:
+        dict: total_quantity, остатки по размерам и склады по убыванию остатка
+    """
+    sizes = {}
+    warehouses = {}
+
+    for (warehouse, size), qty in sorted(stocks.items()):
+        sizes[size] = sizes.get(size, 0) + qty
+        entry = warehouses.setdefault(warehouse, {"id": _warehouse_id(warehouse), "total": 0, "sizes": {}})
+        entry["total"] += qty
+        entry["sizes"][size] = qty
+
+    return {
+        "total_quantity": sum(sizes.values()),
+        "sizes": sizes,
+        "warehouses": sorted(warehouses.values(), key=lambda x: x["total"], reverse=True)
+    }
+
+
+class StockStore:
+    """Изменения остатков и цен товаров в SQLite"""
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Путь к файлу базы
+        """
+        self.path = path
+        self._initialized_pid = None
+        self._init_lock = threading.Lock()
+
+    def _connect(self):
+        connection = get_connection(self.path)
+
+        pid = os.getpid()
+        if self._initialized_pid != pid:
+            with self._init_lock:
+                if self._initialized_pid != pid:
+                    self._create_schema(connection)
+                    self._initialized_pid = pid
+
+        return connection
+
+    def _create_schema(self, connection):
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS stock_heads (
+                    sku INTEGER NOT NULL,
+                    dest TEXT NOT NULL,
+                    first_checked_at REAL NOT NULL,
+                    checked_at REAL NOT NULL,
+                    changed_at REAL NOT NULL,
+                    prices TEXT NOT NULL,
+                    stocks TEXT NOT NULL,
+                    PRIMARY KEY (sku, dest)
+                )
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS stock_changes (
+                    sku INTEGER NOT NULL,
+                    dest TEXT NOT NULL,
+                    warehouse TEXT NOT NULL,
+                    size TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    qty INTEGER NOT NULL,
+                    PRIMARY KEY (sku, dest, warehouse, size, fetched_at)
+                ) WITHOUT ROWID
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS price_changes (
+                    sku INTEGER NOT NULL,
+                    dest TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    current REAL,
+                    original REAL,
+                    discount REAL,
+                    PRIMARY KEY (sku, dest, fetched_at)
+                ) WITHOUT ROWID
+            """)
+
+    def add(self, dest, products, fetched_at=None):
+        """
+        Сохраняет снимок остатков и цен товаров как изменения относительно предыдущего
+
+        Args:
+            dest (str): Регион выдачи
+            products (list): Карточки товаров (результаты format_product_data)
+            fetched_at (float, optional): Время снимка (time.time()), по умолчанию текущее
+
+        Returns:
+            dict: Количество товаров, товаров с изменениями и записанных изменений остатков и цен
+        """
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        dest = str(dest)
+        states = {}
+        for product in products:
+            if product.get("id") is not None and "error" not in product:
+                states[int(product["id"])] = product_state(product)
+
+        result = {"products": len(states), "changed": 0, "stock_changes": 0, "price_changes": 0}
+        if not states:
+            return result
+
+        stock_rows = []
+        price_rows = []
+        head_rows = []
+        unchanged = []
+
+        connection = self._connect()
+        # Последние состояния читаются в транзакции записи: параллельный снимок не потеряет изменения
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            heads = self._heads(connection, dest, list(states))
+
+            for sku, (prices, stocks) in states.items():
+                head = heads.get(sku)
+                previous_prices, previous_stocks = (head[1], head[2]) if head else (None, {})
+
+                changes = [
+                    (sku, dest, warehouse, size, fetched_at, qty)
+                    for (warehouse, size), qty in stocks.items()
+                    if previous_stocks.get((warehouse, size)) != qty
+                ]
+                changes.extend(
+                    (sku, dest, warehouse, size, fetched_at, 0)
+                    for warehouse, size in previous_stocks
+                    if (warehouse, size) not in stocks
+                )
+                price_changed = previous_prices != prices
+
+                if not changes and not price_changed:
+                    unchanged.append(sku)
+                    continue
+
+                stock_rows.extend(changes)
+                if price_changed:
+                    price_rows.append((sku, dest, fetched_at, *prices))
+                head_rows.append((
+                    sku, dest, head[0] if head else fetched_at, fetched_at, fetched_at,
+                    json.dumps(prices),
+                    json.dumps([[warehouse, size, qty] for (warehouse, size), qty in sorted(stocks.items())],
+                               ensure_ascii=False)
+                ))
+
+            connection.executemany(
+                "INSERT OR REPLACE INTO stock_changes (sku, dest, warehouse, size, fetched_at, qty) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                stock_rows
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO price_changes (sku, dest, fetched_at, current, original, discount) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                price_rows
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO stock_heads "
+                "(sku, dest, first_checked_at, checked_at, changed_at, prices, stocks) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                head_rows
+            )
+            for start in range(0, len(unchanged), HEADS_CHUNK):
+                chunk = unchanged[start:start + HEADS_CHUNK]
+                connection.execute(
+                    f"UPDATE stock_heads SET checked_at = ? WHERE dest = ? AND sku IN ({', '.join('?' * len(chunk))})",
+                    [fetched_at, dest] + chunk
+                )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        if stock_rows:
+            STOCK_CHANGES.inc(len(stock_rows), kind="stock")
+        if price_rows:
+            STOCK_CHANGES.inc(len(price_rows), kind="price")
+
+        result.update(changed=len(head_rows), stock_changes=len(stock_rows), price_changes=len(price_rows))
+        return result
+
+    @staticmethod
+    def _heads(connection, dest, skus):
+        # sku -> (first_checked_at, цены, остатки) последних сохраненных состояний
+        heads = {}
+        for start in range(0, len(skus), HEADS_CHUNK):
+            chunk = skus[start:start + HEADS_CHUNK]
+            rows = connection.execute(
+                f"SELECT sku, first_checked_at, prices, stocks FROM stock_heads "
+                f"WHERE dest = ? AND sku IN ({', '.join('?' * len(chunk))})",
+                [dest] + chunk
+            ).fetchall()
+            for sku, first_checked_at, prices, stocks in rows:
+                heads[sku] = (
+                    first_checked_at,
+                    json.loads(prices),
+                    {(warehouse, size): qty for warehouse, size, qty in json.loads(stocks)}
+                )
+        return heads
+
+    def state_at(self, sku, dest, at=None):
+        """
+        Восстанавливает остатки и цены товара на момент времени
+
+        Args:
+            sku (str): Артикул товара
+            dest (str): Регион выдачи
+            at (float, optional): Момент времени (time.time()), по умолчанию текущий
+
+        Returns:
+            dict: Цены, остатки (availability), время последнего изменения не позже at
+                и первой проверки товара или None, если до at снимков товара не было
+        """
+        at = time.time() if at is None else at
+        connection = self._connect()
+        params = (int(sku), str(dest), at)
+
+        price = connection.execute(
+            "SELECT fetched_at, current, original, discount FROM price_changes "
+            "WHERE sku = ? AND dest = ? AND fetched_at <= ? ORDER BY fetched_at DESC LIMIT 1",
+            params
+        ).fetchone()
+        if price is None:
+            return None
+
+        # Для каждой пары (склад, размер) SQLite возвращает qty строки с наибольшим fetched_at
+        rows = connection.execute(
+            "SELECT warehouse, size, qty, MAX(fetched_at) FROM stock_changes "
+            "WHERE sku = ? AND dest = ? AND fetched_at <= ? GROUP BY warehouse, size",
+            params
+        ).fetchall()
+        first = connection.execute(
+            "SELECT first_checked_at FROM stock_heads WHERE sku = ? AND dest = ?", params[:2]
+        ).fetchone()
+
+        return {
+            "changed_at": max([price[0]] + [row[3] for row in rows]),
+            "first_checked_at": first[0] if first else None,
+            "prices": {"current": price[1], "original": price[2], "discount": price[3]},
+            "availability": build_availability({(row[0], row[1]): row[2] for row in rows if row[2]})
+        }
+
+    def changes(self, sku, dest, since=None, until=None):
+        """
+        Возвращает изменения остатков и цен товара за период
+
+        Args:
+            sku (str): Артикул товара
+            dest (str): Регион выдачи
+            since (float, optional): Нижняя граница времени (не включительно)
+            until (float, optional): Верхняя граница времени (включительно)
+
+        Returns:
+            list: Изменения по возрастанию времени: словари fetched_at, prices
+                (если цены изменились) и stocks - список изменившихся остатков
+                (склад, размер, новое количество)
+        """
+        connection = self._connect()
+        params = (int(sku), str(dest), -1.0 if since is None else since, time.time() if until is None else until)
+        changes = {}
+
+        for fetched_at, current, original, discount in connection.execute(
+            "SELECT fetched_at, current, original, discount FROM price_changes "
+            "WHERE sku = ? AND dest = ? AND fetched_at > ? AND fetched_at <= ?",
+            params
+        ):
+            changes.setdefault(fetched_at, {"fetched_at": fetched_at, "stocks": []})["prices"] = {
+                "current": current, "original": original, "discount": discount
+            }
+
+        for fetched_at, warehouse, size, qty in connection.execute(
+            "SELECT fetched_at, warehouse, size, qty FROM stock_changes "
+            "WHERE sku = ? AND dest = ? AND fetched_at > ? AND fetched_at <= ? ORDER BY warehouse, size",
+            params
+        ):
+            changes.setdefault(fetched_at, {"fetched_at": fetched_at, "stocks": []})["stocks"].append(
+                {"warehouse": _warehouse_id(warehouse), "size": size, "qty": qty}
+            )
+
+        return [changes[fetched_at] for fetched_at in sorted(changes)]
+
+    def stats(self):
+        """
+        Returns:
+            dict: Количество отслеживаемых товаров и записанных изменений остатков и цен
+        """
+        connection = self._connect()
+        return {
+            "products": connection.execute("SELECT COUNT(*) FROM stock_heads").fetchone()[0],
+            "stock_changes": connection.execute("SELECT COUNT(*) FROM stock_changes").fetchone()[0],
+            "price_changes": connection.execute("SELECT COUNT(*) FROM price_changes").fetchone()[0]
+        }
+
+
+def get_stock_store():
+    """
+    Возвращает хранилище остатков и цен процесса
+
+    Returns:
+        StockStore: Хранилище остатков и цен
+    """
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = StockStore(config.STOCK_DB_PATH)
+
+    return _store
+
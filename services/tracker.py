@@ -0,0 +1,534 @@
+# Координатор задач отслеживания
+#
+# Каждый процесс запускает координатор, но расписание выполняет только тот,
+# кто удерживает аренду в реестре задач. Владелец аренды периодически
+# продлевает ее и сверяет задачи планировщика с реестром: добавляет новые
+# задачи и снимает остановленные. Если владелец завершился, после истечения
+# аренды расписание подхватывает другой процесс.
+#
+# При WB_TRACKER_MODE=external координатор в процессах веб-сервера не
+# запускается: воркеры только добавляют и останавливают задачи в реестре, а
+# расписание выполняет отдельный процесс, который сверяется с реестром каждые
+# WB_TRACKER_POLL_INTERVAL секунд:
+#   python -m services.tracker [--metrics-port 9100]
+import argparse
+import atexit
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from services import config
+from services.scheduler import get_scheduler
+from services.tracking_events import publish_events
+from services.tracking_store import get_tracking_store
+
+logger = logging.getLogger(__name__)
+
+# Имя аренды права запуска расписания
+LEASE_NAME = "tracking-scheduler"
+
+# Где выполняется расписание: в процессах веб-сервера или в отдельном процессе
+TRACKER_MODES = ("embedded", "external")
+
+# Идентификатор задачи уплотнения истории в планировщике владельца аренды
+COMPACTION_JOB = "history-compaction"
+
+# Префикс задач снимков остатков и цен: одна задача на регион и интервал
+STOCK_JOB_PREFIX = "stock"
+
+
+class TrackerCoordinator:
+    """Удерживает аренду расписания и синхронизирует планировщик с реестром задач"""
+
+    def __init__(self, store, scheduler, lease_ttl, poll_interval=None):
+        """
+        Args:
+            store (TrackingStore): Реестр задач отслеживания
+            scheduler (TrackingScheduler): Планировщик процесса
+            lease_ttl (float): Срок аренды в секундах; продление выполняется втрое чаще
+            poll_interval (float, optional): Интервал сверки с реестром в секундах
+                (по умолчанию - при каждом продлении аренды)
+        """
+        self.store = store
+        self.scheduler = scheduler
+        self.scheduler.group_runner = run_tracking_group
+        self.lease_ttl = lease_ttl
+        self.poll_interval = min(poll_interval or lease_ttl / 3, lease_ttl / 3)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+
+        self._scheduled = {}  # tracking_id -> задача, добавленная в планировщик
+        self._compaction_scheduled = False
+        self._stock_scheduled = set()  # (регион, интервал) задач снимков остатков
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Запускает поток координатора"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._thread = threading.Thread(target=self._loop, name="wb-tracker", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Останавливает координатор и освобождает аренду"""
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.lease_ttl)
+
+        with self._lock:
+            if self.is_leader:
+                self._unschedule_all()
+                self.is_leader = False
+                try:
+                    self.store.release_lease(LEASE_NAME, self.owner)
+                except Exception as e:
+                    logger.error(f"Не удалось освободить аренду расписания: {str(e)}")
+
+    def wake(self):
+        """Запрашивает внеочередную сверку с реестром (например, после добавления задачи)"""
+        self._wake.set()
+
+    def run_forever(self):
+        """Выполняет цикл координатора в текущем потоке до остановки"""
+        self._loop()
+
+    def shutdown(self):
+        """Запрашивает завершение цикла координатора (безопасно вызывать из обработчика сигнала)"""
+        self._stopping.set()
+        self._wake.set()
+
+    def tick(self):
+        """
+        Продлевает аренду и сверяет планировщик с реестром задач
+
+        Returns:
+            bool: True, если процесс выполняет расписание
+        """
+        with self._lock:
+            try:
+                leader = self.store.acquire_lease(LEASE_NAME, self.owner, self.lease_ttl)
+            except Exception as e:
+                logger.error(f"Ошибка при продлении аренды расписания: {str(e)}")
+                leader = False
+
+            if leader and not self.is_leader:
+                logger.info(f"Процесс {self.owner} выполняет расписание отслеживания")
+            elif not leader and self.is_leader:
+                logger.warning(f"Процесс {self.owner} потерял аренду расписания")
+                self._unschedule_all()
+
+            self.is_leader = leader
+            if leader:
+                # Ошибка чтения реестра (например, занятая база) не должна останавливать
+                # цикл координатора: аренда продлевается, сверка повторится на следующем шаге
+                try:
+                    self._sync()
+                except Exception as e:
+                    logger.error(f"Ошибка при сверке задач отслеживания с реестром: {str(e)}")
+
+            return leader
+
+    def sync(self):
+        """Сверяет планировщик с реестром задач без продления аренды, если процесс - владелец"""
+        with self._lock:
+            if not self.is_leader:
+                return
+            try:
+                self._sync()
+            except Exception as e:
+                logger.error(f"Ошибка при сверке задач отслеживания с реестром: {str(e)}")
+
+    def _loop(self):
+        lease_interval = self.lease_ttl / 3
+        next_tick = 0.0
+        woken = False
+
+        while not self._stopping.is_set():
+            # Аренда продлевается втрое чаще срока, а сверка с реестром - каждые poll_interval
+            if woken or time.monotonic() >= next_tick:
+                self.tick()
+                next_tick = time.monotonic() + lease_interval
+            else:
+                self.sync()
+
+            woken = self._wake.wait(min(self.poll_interval, max(next_tick - time.monotonic(), 0.0)))
+            self._wake.clear()
+
+    def _sync(self):
+        # Вызывается под блокировкой владельцем аренды
+        if config.HISTORY_COMPACT_INTERVAL > 0 and not self._compaction_scheduled:
+            self.scheduler.add_job(COMPACTION_JOB, run_history_compaction, config.HISTORY_COMPACT_INTERVAL)
+            self._compaction_scheduled = True
+
+        jobs = {job['tracking_id']: job for job in self.store.list_jobs(active_only=True)}
+
+        for tracking_id in list(self._scheduled):
+            if tracking_id not in jobs:
+                self.scheduler.remove_job(tracking_id)
+                del self._scheduled[tracking_id]
+
+        for tracking_id, job in jobs.items():
+            if tracking_id not in self._scheduled:
+                self.scheduler.add_job(
+                    tracking_id,
+                    build_tracking_job(job),
+                    tracking_interval_seconds(job['interval'], job['interval_type']),
+                    run_now=True,
+                    group=tracking_group(job),
+                    payload=job
+                )
+                self._scheduled[tracking_id] = job
+
+        buckets = set(self.store.stock_buckets())
+
+        for bucket in self._stock_scheduled - buckets:
+            self.scheduler.remove_job(stock_job_id(*bucket))
+        for dest, interval in buckets - self._stock_scheduled:
+            self.scheduler.add_job(
+                stock_job_id(dest, interval),
+                build_stock_job(dest, interval),
+                tracking_interval_seconds(interval, "minutes"),
+                run_now=True
+            )
+        self._stock_scheduled = buckets
+
+    def _unschedule_all(self):
+        # Вызывается под блокировкой
+        for tracking_id in list(self._scheduled):
+            self.scheduler.remove_job(tracking_id)
+        self._scheduled.clear()
+
+        if self._compaction_scheduled:
+            self.scheduler.remove_job(COMPACTION_JOB)
+            self._compaction_scheduled = False
+
+        for bucket in self._stock_scheduled:
+            self.scheduler.remove_job(stock_job_id(*bucket))
+        self._stock_scheduled = set()
+
+
+def tracking_interval_seconds(interval, interval_type):
+    """
+    Переводит интервал задачи в секунды
+
+    Args:
+        interval (int): Интервал отслеживания
+        interval_type (str): Тип интервала ("minutes" или "hours")
+
+    Returns:
+        int: Интервал в секундах
+    """
+    if interval_type == "minutes":
+        return max(int(interval), 1) * 60
+    return int(interval) * 3600
+
+
+def tracking_group(job):
+    """
+    Возвращает ключ группы задачи: задачи одной группы, наступившие
+    одновременно, выполняются одним обходом выдачи
+
+    Args:
+        job (dict): Задача из реестра
+
+    Returns:
+        tuple: Кортеж (запрос, max_pages, регионы)
+    """
+    # Запрос берется в написании задачи, а не нормализованным: пакетный обход
+    # сохраняет историю всех артикулов группы под одним запросом
+    return (job['query'], int(job['max_pages']), tuple(job['regions']))
+
+
+def run_tracking_group(group, jobs, deadline):
+    """
+    Выполняет задачи одной группы одним обходом выдачи
+
+    Позиции всех артикулов определяются пакетным поиском; запись
+    в историю по-прежнему сохраняется для каждого артикула отдельно.
+    Регионы группы обходятся одновременно, страницы - в порядке
+    WB_TRACKING_SCAN_STRATEGY (по умолчанию - от последних известных страниц товаров).
+    Результат каждой задачи в каждом регионе публикуется в поток событий.
+
+    Args:
+        group (tuple): Ключ группы
+        jobs (list): Задачи из реестра
+        deadline (float): Момент time.monotonic(), после которого обход прерывается
+    """
+    from services.position_service import normalize_query, search_products_positions_regions
+
+    query_key = normalize_query(group[0])
+
+    try:
+        result = search_products_positions_regions(
+            group[0],
+            [job['sku'] for job in jobs],
+            list(group[2]),
+            group[1],
+            deadline=deadline,
+            strategy=config.TRACKING_SCAN_STRATEGY
+        )
+    except Exception as e:
+        _publish_results(jobs, query_key, [{"dest": dest, "error": str(e)} for dest in group[2]])
+        raise
+
+    for job in jobs:
+        sku = str(int(job['sku']))
+        _publish_results([job], query_key, [
+            region["results"][sku] if "results" in region else region
+            for region in result["regions"]
+        ])
+
+
+def run_history_compaction(deadline):
+    """
+    Уплотняет историю позиций (задача планировщика владельца аренды)
+
+    Перенос, не завершенный до deadline, продолжается при следующем запуске.
+
+    Args:
+        deadline (float): Момент time.monotonic(), после которого перенос прерывается
+    """
+    from services.history_archive import compact_history
+
+    result = compact_history(deadline=deadline)
+    if result["moved_rows"] or result["partitions_deleted"] or result["rollups_deleted"]:
+        logger.info(f"Уплотнение истории позиций: {result}")
+
+
+def build_tracking_job(job):
+    """
+    Создает функцию запуска задачи отслеживания для планировщика
+
+    Args:
+        job (dict): Задача из реестра
+
+    Returns:
+        callable: Функция, принимающая deadline
+    """
+    from services.position_service import normalize_query, search_product_position_regions
+
+    def tracking_job(deadline):
+        try:
+            result = search_product_position_regions(
+                job['query'], job['sku'], job['regions'], job['max_pages'],
+                deadline=deadline, strategy=config.TRACKING_SCAN_STRATEGY
+            )
+        except Exception as e:
+            _publish_results([job], normalize_query(job['query']), [
+                {"dest": dest, "error": str(e)} for dest in job['regions']
+            ])
+            raise
+
+        _publish_results([job], normalize_query(job['query']), result["regions"])
+
+    return tracking_job
+
+
+def stock_job_id(dest, interval):
+    """
+    Args:
+        dest (str): Регион выдачи
+        interval (int): Интервал снимков в минутах
+
+    Returns:
+        str: Идентификатор задачи снимков остатков в планировщике
+    """
+    return f"{STOCK_JOB_PREFIX}:{dest}:{interval}"
+
+
+def build_stock_job(dest, interval):
+    """
+    Создает функцию снимка остатков и цен товаров региона с заданным интервалом
+
+    Список товаров читается из реестра при каждом запуске, поэтому добавленный
+    товар попадает в ближайший снимок без перепланирования задачи.
+
+    Args:
+        dest (str): Регион выдачи
+        interval (int): Интервал снимков в минутах
+
+    Returns:
+        callable: Функция, принимающая deadline
+    """
+    from services.product_service import snapshot_products_stock
+
+    def stock_job(deadline):
+        skus = [item['sku'] for item in get_tracking_store().list_stock_items(dest=dest, interval=interval)]
+        result = snapshot_products_stock(skus, dest, deadline=deadline)
+        if not result["complete"]:
+            logger.warning(f"Снимок остатков региона {dest} прерван по таймауту: {result}")
+
+    return stock_job
+
+
+def _publish_results(jobs, query_key, results):
+    """
+    Публикует результаты задач в поток событий отслеживания
+
+    Ошибка публикации записывается в лог и не влияет на результат задачи.
+
+    Args:
+        jobs (list): Задачи из реестра
+        query_key (str): Нормализованный запрос задач
+        results (list): Результаты поиска по регионам (для региона с ошибкой - dest и error)
+    """
+    timestamp = datetime.now().isoformat()
+    events = []
+
+    for job in jobs:
+        for result in results:
+            data = {"tracking_id": job['tracking_id'], "query": job['query'], "sku": str(job['sku'])}
+            data.update(result)
+            data.setdefault("timestamp", timestamp)
+            events.append({
+                "tracking_id": job['tracking_id'],
+                "sku": str(job['sku']),
+                "query": query_key,
+                "dest": result["dest"],
+                "data": data
+            })
+
+    try:
+        publish_events(events)
+    except Exception as e:
+        logger.error(f"Ошибка при публикации событий отслеживания: {str(e)}")
+
+
+_coordinator = None
+_coordinator_pid = None
+_coordinator_lock = threading.Lock()
+
+
+def get_tracker():
+    """
+    Возвращает координатор задач отслеживания процесса
+
+    После fork (воркеры gunicorn с --preload) создается новый координатор,
+    так как потоки родительского процесса в дочернем не работают.
+
+    Returns:
+        TrackerCoordinator: Координатор процесса
+    """
+    global _coordinator, _coordinator_pid
+
+    pid = os.getpid()
+    if _coordinator is None or _coordinator_pid != pid:
+        with _coordinator_lock:
+            if _coordinator is None or _coordinator_pid != pid:
+                _coordinator = TrackerCoordinator(
+                    get_tracking_store(),
+                    get_scheduler(),
+                    config.TRACKER_LEASE_TTL,
+                    config.TRACKER_POLL_INTERVAL
+                )
+                _coordinator_pid = pid
+
+    return _coordinator
+
+
+def start_tracker():
+    """
+    Запускает координатор задач отслеживания в фоновом потоке процесса
+
+    Returns:
+        TrackerCoordinator: Запущенный координатор
+    """
+    tracker = get_tracker()
+    tracker.start()
+    return tracker
+
+
+def tracker_mode():
+    """
+    Возвращает режим выполнения расписания
+
+    Returns:
+        str: "embedded" (в процессах веб-сервера) или "external" (в процессе python -m services.tracker)
+    """
+    mode = config.TRACKER_MODE
+    if mode not in TRACKER_MODES:
+        raise ValueError(f"WB_TRACKER_MODE должен быть одним из: {', '.join(TRACKER_MODES)}")
+    return mode
+
+
+def notify_tracker():
+    """
+    Сообщает координатору об изменении реестра задач
+
+    Во встроенном режиме координатор процесса запускается (если еще не запущен)
+    и сразу сверяется с реестром. Во внешнем режиме изменения подхватит процесс
+    отслеживания при следующей сверке.
+    """
+    if tracker_mode() == "embedded":
+        start_tracker().wake()
+
+
+def _serve_metrics(port):
+    from services.metrics import render_metrics
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="wb-tracker-metrics", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Процесс отслеживания позиций: выполняет расписание задач из реестра")
+    parser.add_argument("--metrics-port", type=int, default=config.TRACKER_METRICS_PORT,
+                        help="Порт /metrics процесса отслеживания (0 - не запускать)")
+    parser.add_argument("--log-level", default="INFO", help="Уровень логирования")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=args.log_level.upper(),
+        format="[%(asctime)s] %(levelname)s in %(module)s: %(message)s"
+    )
+
+    tracker = get_tracker()
+    signal.signal(signal.SIGTERM, lambda signum, frame: tracker.shutdown())
+    signal.signal(signal.SIGINT, lambda signum, frame: tracker.shutdown())
+
+    if args.metrics_port:
+        _serve_metrics(args.metrics_port)
+        logger.info(f"Метрики процесса отслеживания: http://0.0.0.0:{args.metrics_port}/metrics")
+
+    logger.info(f"Процесс отслеживания {tracker.owner} запущен")
+    try:
+        tracker.run_forever()
+    finally:
+        # Аренда освобождается сразу, выполняющиеся обходы дописывают историю
+        tracker.stop()
+        tracker.scheduler.stop(wait=True)
+        logger.info(f"Процесс отслеживания {tracker.owner} остановлен")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+# События отслеживания для потока Server-Sent Events
+#
+# Результаты задач отслеживания записываются в таблицу tracking_events
+# процессом, выполняющим расписание (воркер - владелец аренды или
+# python -m services.tracker). В каждом веб-процессе один фоновый поток
+# проверяет таблицу раз в WB_EVENTS_POLL_INTERVAL секунд, пока к процессу
+# подключен хотя бы один клиент потока, и будит ожидающие подключения.
+# Последние события хранятся в памяти процесса уже сериализованными в JSON,
+# поэтому число подключений не увеличивает число запросов к базе.
+#
+# Идентификаторы событий возрастают и не переиспользуются (AUTOINCREMENT):
+# клиент, переподключившийся с Last-Event-ID, получает пропущенные события
+# за последние WB_EVENTS_RETENTION_HOURS часов.
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from services import config
+from services.db import get_connection
+from services.metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+# Интервал между автоматическими очистками устаревших событий, секунды
+PRUNE_INTERVAL = 3600
+
+STREAM_SUBSCRIBERS = Gauge(
+    "wb_tracking_stream_subscribers",
+    "Подключений к потоку результатов отслеживания"
+)
+
+_store = None
+_store_lock = threading.Lock()
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+
+class TrackingEventStore:
+    """События результатов отслеживания в SQLite"""
+
+    def __init__(self, path, retention_hours):
+        """
+        Args:
+            path (str): Путь к файлу базы
+            retention_hours (float): Срок хранения событий в часах
+        """
+        self.path = path
+        self.retention_hours = retention_hours
+        self._initialized_pid = None
+        self._init_lock = threading.Lock()
+        self._last_prune = 0.0
+
+    def _connect(self):
+        connection = get_connection(self.path)
+
+        pid = os.getpid()
+        if self._initialized_pid != pid:
+            with self._init_lock:
+                if self._initialized_pid != pid:
+                    self._create_schema(connection)
+                    self._initialized_pid = pid
+
+        return connection
+
+    def _create_schema(self, connection):
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS tracking_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at REAL NOT NULL,
+                    tracking_id TEXT NOT NULL,
+                    sku TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    dest TEXT NOT NULL,
+                    data TEXT NOT NULL
+                )
+            """)
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_tracking_events_created_at ON tracking_events (created_at)"
+            )
+
+    def add(self, events):
+        """
+        Сохраняет события
+
+        Args:
+            events (list): Словари tracking_id, sku, query (нормализованный запрос),
+                dest и data (результат поиска для ответа клиенту)
+        """
+        if not events:
+            return
+
+        created_at = time.time()
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT INTO tracking_events (created_at, tracking_id, sku, query, dest, data) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        created_at, event['tracking_id'], str(event['sku']), event['query'], str(event['dest']),
+                        json.dumps(event['data'], ensure_ascii=False)
+                    )
+                    for event in events
+                ]
+            )
+
+        if created_at - self._last_prune > PRUNE_INTERVAL:
+            self._last_prune = created_at
+            self.prune()
+
+    def since(self, last_id, limit=None):
+        """
+        Выбирает события после указанного
+
+        Args:
+            last_id (int): Идентификатор последнего полученного события
+            limit (int, optional): Максимальное количество событий
+
+        Returns:
+            list: События по возрастанию id: словари id, tracking_id, sku, query,
+                dest и data (строка JSON)
+        """
+        sql = "SELECT id, tracking_id, sku, query, dest, data FROM tracking_events WHERE id > ? ORDER BY id"
+        params = [last_id]
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        return [
+            {"id": row[0], "tracking_id": row[1], "sku": row[2], "query": row[3], "dest": row[4], "data": row[5]}
+            for row in self._connect().execute(sql, params).fetchall()
+        ]
+
+    def last_id(self):
+        """
+        Returns:
+            int: Идентификатор последнего события (0, если событий нет)
+        """
+        row = self._connect().execute("SELECT MAX(id) FROM tracking_events").fetchone()
+        return row[0] or 0
+
+    def prune(self, before=None):
+        """
+        Удаляет устаревшие события
+
+        Args:
+            before (float, optional): Удалить события старше этого момента
+                (по умолчанию - старше срока хранения)
+
+        Returns:
+            int: Количество удаленных событий
+        """
+        if before is None:
+            before = time.time() - self.retention_hours * 3600
+
+        connection = self._connect()
+        with connection:
+            cursor = connection.execute("DELETE FROM tracking_events WHERE created_at < ?", (before,))
+        return cursor.rowcount
+
+
+class EventBroadcaster:
+    """Общий для подключений процесса опрос новых событий"""
+
+    def __init__(self, store, poll_interval, buffer_size):
+        """
+        Args:
+            store (TrackingEventStore): Хранилище событий
+            poll_interval (float): Интервал проверки новых событий, секунды
+            buffer_size (int): Количество последних событий в памяти
+        """
+        self.store = store
+        self.poll_interval = poll_interval
+        self.buffer_size = max(1, buffer_size)
+
+        self._condition = threading.Condition()
+        self._wake = threading.Event()
+        self._events = deque(maxlen=self.buffer_size)
+        # В буфере есть все события с id больше _floor
+        self._floor = 0
+        self._last_id = 0
+        self._subscribers = 0
+        self._pid = None
+        self._thread = None
+
+    def subscribe(self):
+        """
+        Регистрирует подключение
+
+        Returns:
+            int: Идентификатор последнего события - начало потока нового подключения
+        """
+        with self._condition:
+            self._ensure_thread()
+            if self._subscribers == 0:
+                # Пока подключений не было, буфер не обновлялся
+                self._last_id = self._floor = self.store.last_id()
+                self._events.clear()
+            self._subscribers += 1
+            STREAM_SUBSCRIBERS.set(self._subscribers)
+            self._condition.notify_all()
+            return self._last_id
+
+    def unsubscribe(self):
+        """Снимает регистрацию подключения"""
+        with self._condition:
+            self._subscribers = max(0, self._subscribers - 1)
+            STREAM_SUBSCRIBERS.set(self._subscribers)
+
+    def wake(self):
+        """Запрашивает внеочередную проверку новых событий (после записи в этом процессе)"""
+        self._wake.set()
+
+    def events_after(self, cursor, timeout):
+        """
+        Возвращает события после cursor, при их отсутствии ожидает до timeout секунд
+
+        Args:
+            cursor (int): Идентификатор последнего полученного события
+            timeout (float): Максимальное время ожидания, секунды
+
+        Returns:
+            list: События по возрастанию id (пустой список, если новых событий нет)
+        """
+        with self._condition:
+            if cursor >= self._floor:
+                if self._last_id <= cursor:
+                    self._condition.wait(timeout)
+                return [event for event in self._events if event["id"] > cursor]
+
+        # Подключение отстало от буфера (возобновление по Last-Event-ID) - догоняет по базе
+        return self.store.since(cursor, limit=self.buffer_size)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Количество подключений, событий в буфере и последний id
+        """
+        with self._condition:
+            return {"subscribers": self._subscribers, "buffered": len(self._events), "last_id": self._last_id}
+
+    def _ensure_thread(self):
+        # Вызывается под self._condition. После fork поток родителя не наследуется
+        pid = os.getpid()
+        if self._pid != pid:
+            self._thread = None
+            self._subscribers = 0
+            STREAM_SUBSCRIBERS.set(0)
+            self._pid = pid
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="wb-events", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._subscribers == 0:
+                    self._condition.wait()
+                last_id = self._last_id
+
+            try:
+                events = self.store.since(last_id, limit=self.buffer_size)
+            except Exception as e:
+                logger.error(f"Ошибка при чтении событий отслеживания: {str(e)}")
+                events = []
+
+            if events:
+                with self._condition:
+                    if self._last_id == last_id:
+                        for event in events:
+                            if len(self._events) == self._events.maxlen:
+                                self._floor = self._events[0]["id"]
+                            self._events.append(event)
+                        self._last_id = events[-1]["id"]
+                        self._condition.notify_all()
+
+            if len(events) < self.buffer_size:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+
+def get_event_store():
+    """
+    Возвращает хранилище событий отслеживания процесса
+
+    Returns:
+        TrackingEventStore: Хранилище событий
+    """
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = TrackingEventStore(config.EVENTS_DB_PATH, config.EVENTS_RETENTION_HOURS)
+
+    return _store
+
+
+def get_event_broadcaster():
+    """
+    Возвращает общий опрос событий процесса
+
+    Returns:
+        EventBroadcaster: Опрос событий
+    """
+    global _broadcaster
+
+    if _broadcaster is None:
+        with _broadcaster_lock:
+            if _broadcaster is None:
+                _broadcaster = EventBroadcaster(
+                    get_event_store(), config.EVENTS_POLL_INTERVAL, config.EVENTS_BUFFER_SIZE
+                )
+
+    return _broadcaster
+
+
+def publish_events(events):
+    """
+    Сохраняет события и будит опрос процесса, если к нему подключены клиенты
+
+    Args:
+        events (list): События (см. TrackingEventStore.add)
+    """
+    get_event_store().add(events)
+
+    if _broadcaster is not None:
+        _broadcaster.wake()
@@ -0,0 +1,331 @@
+# Постоянный реестр задач отслеживания и аренда права запуска расписания
+#
+# Задачи хранятся в SQLite, поэтому переживают перезапуск и видны всем
+# воркерам gunicorn. Расписание выполняет только процесс, удерживающий
+# аренду (lease) - запись с владельцем и временем истечения.
+#
+# Отслеживаемые остатки и цены хранятся в stock_tracking по одной записи на
+# товар и регион: товары с одинаковыми регионом и интервалом снимаются одной
+# задачей планировщика пачками карточек.
+import os
+import threading
+import time
+from datetime import datetime
+
+from services import config
+from services.db import get_connection, table_columns
+
+# Поля задачи отслеживания (active - последнее)
+JOB_FIELDS = ['tracking_id', 'query', 'sku', 'interval', 'interval_type', 'max_pages', 'start_time',
+              'regions', 'active']
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class TrackingStore:
+    """Реестр задач отслеживания и аренды планировщика в SQLite"""
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Путь к файлу базы
+        """
+        self.path = path
+        self._initialized_pid = None
+        self._init_lock = threading.Lock()
+
+    def _connect(self):
+        connection = get_connection(self.path)
+
+        pid = os.getpid()
+        if self._initialized_pid != pid:
+            with self._init_lock:
+                if self._initialized_pid != pid:
+                    self._create_schema(connection)
+                    self._initialized_pid = pid
+
+        return connection
+
+    def _create_schema(self, connection):
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS tracking_jobs (
+                    tracking_id TEXT PRIMARY KEY,
+                    query TEXT NOT NULL,
+                    sku TEXT NOT NULL,
+                    interval INTEGER NOT NULL,
+                    interval_type TEXT NOT NULL,
+                    max_pages INTEGER NOT NULL,
+                    start_time TEXT NOT NULL,
+                    regions TEXT,
+                    active INTEGER NOT NULL DEFAULT 1,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS stock_tracking (
+                    sku TEXT NOT NULL,
+                    dest TEXT NOT NULL,
+                    interval INTEGER NOT NULL,
+                    start_time TEXT NOT NULL,
+                    active INTEGER NOT NULL DEFAULT 1,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (sku, dest)
+                )
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS scheduler_leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+
+        # Задачи, созданные до появления регионов, выполняются в регионе по умолчанию (regions = NULL)
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if 'regions' not in table_columns(connection, "tracking_jobs"):
+                connection.execute("ALTER TABLE tracking_jobs ADD COLUMN regions TEXT")
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def add_job(self, job):
+        """
+        Сохраняет задачу отслеживания
+
+        Args:
+            job (dict): Задача с полями JOB_FIELDS; regions - список регионов выдачи
+                (если не указан - регион по умолчанию)
+        """
+        job = dict(job, regions=",".join(job.get('regions') or []) or None)
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO tracking_jobs ({', '.join(JOB_FIELDS)}, updated_at) "
+                f"VALUES ({', '.join('?' * len(JOB_FIELDS))}, ?)",
+                [job[field] for field in JOB_FIELDS[:-1]] + [1 if job.get('active', True) else 0, time.time()]
+            )
+
+    def get_job(self, tracking_id):
+        """
+        Возвращает задачу отслеживания
+
+        Args:
+            tracking_id (str): Идентификатор задачи
+
+        Returns:
+            dict: Задача или None, если задача не найдена
+        """
+        row = self._connect().execute(
+            f"SELECT {', '.join(JOB_FIELDS)} FROM tracking_jobs WHERE tracking_id = ?",
+            (tracking_id,)
+        ).fetchone()
+        return self._to_job(row) if row else None
+
+    def list_jobs(self, active_only=True):
+        """
+        Возвращает задачи отслеживания
+
+        Args:
+            active_only (bool): Только активные задачи
+
+        Returns:
+            list: Задачи в порядке создания
+        """
+        sql = f"SELECT {', '.join(JOB_FIELDS)} FROM tracking_jobs"
+        if active_only:
+            sql += " WHERE active = 1"
+        sql += " ORDER BY start_time"
+
+        return [self._to_job(row) for row in self._connect().execute(sql).fetchall()]
+
+    def deactivate_job(self, tracking_id):
+        """
+        Помечает задачу остановленной
+
+        Args:
+            tracking_id (str): Идентификатор задачи
+
+        Returns:
+            bool: True, если активная задача была остановлена
+        """
+        connection = self._connect()
+        with connection:
+            cursor = connection.execute(
+                "UPDATE tracking_jobs SET active = 0, updated_at = ? WHERE tracking_id = ? AND active = 1",
+                (time.time(), tracking_id)
+            )
+        return cursor.rowcount > 0
+
+    def add_stock_items(self, skus, dest, interval):
+        """
+        Включает отслеживание остатков и цен товаров
+
+        Товар, уже отслеживаемый в регионе, получает новый интервал.
+
+        Args:
+            skus (list): Артикулы товаров
+            dest (str): Регион выдачи
+            interval (int): Интервал снимков в минутах
+        """
+        now = time.time()
+        start_time = datetime.now().isoformat()
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO stock_tracking (sku, dest, interval, start_time, active, updated_at) "
+                "VALUES (?, ?, ?, ?, 1, ?)",
+                [(str(sku), str(dest), int(interval), start_time, now) for sku in skus]
+            )
+
+    def list_stock_items(self, dest=None, interval=None):
+        """
+        Возвращает отслеживаемые товары
+
+        Args:
+            dest (str, optional): Только товары региона
+            interval (int, optional): Только товары с интервалом (минуты)
+
+        Returns:
+            list: Словари sku, dest, interval, start_time в порядке артикулов
+        """
+        conditions = ["active = 1"]
+        params = []
+        if dest is not None:
+            conditions.append("dest = ?")
+            params.append(str(dest))
+        if interval is not None:
+            conditions.append("interval = ?")
+            params.append(int(interval))
+
+        rows = self._connect().execute(
+            f"SELECT sku, dest, interval, start_time FROM stock_tracking WHERE {' AND '.join(conditions)} "
+            f"ORDER BY CAST(sku AS INTEGER), dest",
+            params
+        ).fetchall()
+        return [{"sku": row[0], "dest": row[1], "interval": row[2], "start_time": row[3]} for row in rows]
+
+    def stock_buckets(self):
+        """
+        Returns:
+            list: Пары (регион, интервал в минутах) отслеживаемых товаров
+        """
+        return [
+            (row[0], row[1]) for row in self._connect().execute(
+                "SELECT DISTINCT dest, interval FROM stock_tracking WHERE active = 1"
+            ).fetchall()
+        ]
+
+    def deactivate_stock_item(self, sku, dest):
+        """
+        Останавливает отслеживание остатков и цен товара
+
+        Args:
+            sku (str): Артикул товара
+            dest (str): Регион выдачи
+
+        Returns:
+            bool: True, если отслеживание было включено
+        """
+        connection = self._connect()
+        with connection:
+            cursor = connection.execute(
+                "UPDATE stock_tracking SET active = 0, updated_at = ? WHERE sku = ? AND dest = ? AND active = 1",
+                (time.time(), str(sku), str(dest))
+            )
+        return cursor.rowcount > 0
+
+    def acquire_lease(self, name, owner, ttl):
+        """
+        Захватывает или продлевает аренду
+
+        Аренда достается владельцу, если она свободна, истекла или уже
+        принадлежит ему. Проверка и запись выполняются в одной
+        транзакции с блокировкой записи, поэтому владелец всегда один.
+
+        Args:
+            name (str): Имя аренды
+            owner (str): Идентификатор претендента
+            ttl (float): Срок аренды в секундах
+
+        Returns:
+            bool: True, если аренда принадлежит owner
+        """
+        connection = self._connect()
+        now = time.time()
+
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT owner, expires_at FROM scheduler_leases WHERE name = ?", (name,)
+            ).fetchone()
+
+            acquired = row is None or row[0] == owner or row[1] <= now
+            if acquired:
+                connection.execute(
+                    "INSERT OR REPLACE INTO scheduler_leases (name, owner, expires_at) VALUES (?, ?, ?)",
+                    (name, owner, now + ttl)
+                )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+        return acquired
+
+    def release_lease(self, name, owner):
+        """
+        Освобождает аренду, если она принадлежит owner
+
+        Args:
+            name (str): Имя аренды
+            owner (str): Идентификатор владельца
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "DELETE FROM scheduler_leases WHERE name = ? AND owner = ?", (name, owner)
+            )
+
+    def lease_owner(self, name):
+        """
+        Возвращает текущего владельца аренды
+
+        Args:
+            name (str): Имя аренды
+
+        Returns:
+            dict: Владелец и время истечения или None, если аренда свободна
+        """
+        row = self._connect().execute(
+            "SELECT owner, expires_at FROM scheduler_leases WHERE name = ? AND expires_at > ?",
+            (name, time.time())
+        ).fetchone()
+        return {"owner": row[0], "expires_at": row[1]} if row else None
+
+    @staticmethod
+    def _to_job(row):
+        job = dict(zip(JOB_FIELDS, row))
+        job['regions'] = job['regions'].split(",") if job['regions'] else [str(config.DEFAULT_DEST)]
+        job['active'] = bool(job['active'])
+        return job
+
+
+def get_tracking_store():
+    """
+    Возвращает реестр задач отслеживания процесса
+
+    Returns:
+        TrackingStore: Реестр задач
+    """
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = TrackingStore(config.TRACKING_DB_PATH)
+
+    return _store
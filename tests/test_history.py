@@ -0,0 +1,115 @@
+import threading
+from datetime import datetime
+
+import pytest
+
+from services import config
+from services.history_archive import ArchivedHistoryStore, HistoryArchive, compact_history
+from services.history_store import CsvHistoryStore, SqliteHistoryStore
+from services.history_writer import HistoryWriter
+from services.rollups import RollupStore
+
+
+def make_row(sku, timestamp, position=3):
+    return {
+        'timestamp': timestamp, 'sku': str(sku), 'query': 'платье', 'organic_position': position,
+        'promo_position': '', 'price': 1000, 'cpm': '', 'ad_type': '', 'page': 1,
+        'position_on_page': position, 'boost_cost': '', 'dest': '-1'
+    }
+
+
+def make_writer(history_store, rollup_store):
+    # Фоновый поток не сбрасывает буфер сам: тесты вызывают flush() явно
+    return HistoryWriter(history_store, rollup_store, flush_rows=1000, flush_interval=3600, max_rows=10000)
+
+
+def test_duplicate_rows_are_not_counted_in_rollups(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    rollups = RollupStore(path)
+    writer = make_writer(SqliteHistoryStore(path, fsync=False), rollups)
+    row = make_row(1, '2024-01-01 10:00:00')
+
+    try:
+        writer.add([dict(row)])
+        assert writer.flush() == 1
+        # Повтор той же записи (например, после повторной отправки) пропускается INSERT OR IGNORE
+        writer.add([dict(row)])
+        writer.flush()
+    finally:
+        writer.close()
+
+    for bucket in ("1h", "1d"):
+        result = rollups.query(1, bucket)
+        assert len(result) == 1
+        assert result[0]["samples"] == 1
+        assert result[0]["organic_position"]["count"] == 1
+
+
+def test_partial_csv_failure_requeues_only_unwritten_rows(tmp_path):
+    store = CsvHistoryStore(str(tmp_path), fsync=False)
+    rollups = RollupStore(str(tmp_path / "rollups.sqlite3"))
+    writer = make_writer(store, rollups)
+
+    append_sku = store._append_sku
+    failing = {"sku": "2"}
+
+    def flaky_append(sku, rows):
+        if sku == failing["sku"]:
+            raise OSError("No space left on device")
+        append_sku(sku, rows)
+
+    store._append_sku = flaky_append
+
+    try:
+        writer.add([make_row(sku, '2024-01-01 10:00:00') for sku in (1, 2, 3)])
+        with pytest.raises(Exception):
+            writer.flush()
+
+        # Товар 1 записан, товар 2 не записан, до товара 3 запись не дошла
+        assert writer.stats()["pending"] == 2
+        assert [len(store.query(sku)) for sku in (1, 2, 3)] == [1, 0, 0]
+        assert [len(rollups.query(sku, "1h")) for sku in (1, 2, 3)] == [1, 0, 0]
+
+        failing["sku"] = None
+        assert writer.flush() == 2
+    finally:
+        writer.close()
+
+    # Повторный сброс дописывает только возвращенные в буфер записи, без дублей
+    assert [len(store.query(sku)) for sku in (1, 2, 3)] == [1, 1, 1]
+    assert [rollups.query(sku, "1h")[0]["samples"] for sku in (1, 2, 3)] == [1, 1, 1]
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "csv"])
+def test_iteration_during_compaction_sees_each_row_once(tmp_path, monkeypatch, backend):
+    monkeypatch.setattr(config, "HISTORY_HOT_DAYS", 30.0)
+    monkeypatch.setattr(config, "HISTORY_RAW_RETENTION_DAYS", 0.0)
+    monkeypatch.setattr(config, "HISTORY_ROLLUP_RETENTION_DAYS", 0.0)
+
+    if backend == "sqlite":
+        hot = SqliteHistoryStore(str(tmp_path / "history.sqlite3"), fsync=False)
+    else:
+        hot = CsvHistoryStore(str(tmp_path / "csv"), fsync=False)
+    store = ArchivedHistoryStore(hot, HistoryArchive(str(tmp_path / "archive"), fsync=False))
+    store.append([make_row(7, f'2024-0{month}-01 10:00:00', position=month) for month in range(1, 7)])
+
+    chunks = store.iter_query('7', chunk_size=1)
+    first = next(chunks)
+
+    # Уплотнение переносит январь-апрель в разделы, пока чтение не завершено
+    result = {}
+    compaction = threading.Thread(
+        target=lambda: result.update(compact_history(store, RollupStore(str(tmp_path / "rollups.sqlite3")),
+                                                     now=datetime(2024, 5, 15)))
+    )
+    compaction.start()
+    compaction.join(timeout=10)
+    assert not compaction.is_alive()
+    assert result["moved_rows"] == 4
+
+    positions = [int(chunk['organic_position'].iloc[0]) for chunk in [first] + list(chunks)]
+    assert positions == [1, 2, 3, 4, 5, 6]
+
+    after = store.query('7')
+    assert sorted(after['organic_position'].astype(int)) == [1, 2, 3, 4, 5, 6]
+    assert len(store.hot.query('7')) == 2
@@ -0,0 +1,39 @@
+import time
+
+from services.tracking_store import TrackingStore
+
+LEASE = "tracking-scheduler"
+
+
+def test_lease_has_single_owner_until_released(tmp_path):
+    store = TrackingStore(str(tmp_path / "tracking.sqlite3"))
+
+    assert store.acquire_lease(LEASE, "worker-a", ttl=60)
+    assert not store.acquire_lease(LEASE, "worker-b", ttl=60)
+    # Владелец продлевает аренду
+    assert store.acquire_lease(LEASE, "worker-a", ttl=60)
+
+    # Чужой release не снимает аренду
+    store.release_lease(LEASE, "worker-b")
+    assert store.lease_owner(LEASE)["owner"] == "worker-a"
+
+    store.release_lease(LEASE, "worker-a")
+    assert store.lease_owner(LEASE) is None
+    assert store.acquire_lease(LEASE, "worker-b", ttl=60)
+    assert store.lease_owner(LEASE)["owner"] == "worker-b"
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    path = str(tmp_path / "tracking.sqlite3")
+    store = TrackingStore(path)
+    other = TrackingStore(path)
+
+    assert store.acquire_lease(LEASE, "worker-a", ttl=0.2)
+    assert not other.acquire_lease(LEASE, "worker-b", ttl=60)
+
+    # Владелец перестал продлевать аренду (процесс завис или завершился)
+    time.sleep(0.3)
+    assert store.lease_owner(LEASE) is None
+    assert other.acquire_lease(LEASE, "worker-b", ttl=60)
+    assert not store.acquire_lease(LEASE, "worker-a", ttl=0.2)
+    assert store.lease_owner(LEASE)["owner"] == "worker-b"